@@ -6,33 +6,33 @@ from organizations.models import OrganizationUser
 def list_roles(request):
     """Lists all roles for all users."""
 
-    users = OrganizationUser.objects.order_by('username').all()
+    # the roles are loaded for a few hundred users at a time, and the response
+    # is streamed as the users are loaded
+    users = OrganizationUser.objects.with_role_matrix().order_by('username')
 
-    out = []
+    def render():
+        # list the super roles and organization roles of each user
+        for user in users.iterator():
+            superroles = []
+            organizations = []
 
-    # build a dictionary for each user that lists their super roles and
-    # organization roles
-    for user in users:
-        superroles = []
-        organizations = []
+            yield "<h1>User: {0}</h1>".format(user)
 
-        out.append("<h1>User: {0}</h1>".format(user))
+            for role in user.super_role_list:
+                superroles.append('<li>{0}</li>'.format(role.name))
 
-        for role in user.super_roles.all():
-            superroles.append('<li>{0}</li>'.format(role.name))
+            yield '<h2>Super Roles</h2>'
+            yield '<ul>{0}</ul>'.format("\n".join(superroles))
 
-        out.append('<h2>Super Roles</h2>')
-        out.append('<ul>{0}</ul>'.format("\n".join(superroles)))
+            for org, org_roles in user.role_matrix:
+                roles = []
+                for role in org_roles:
+                    roles.append('<li>{0}</li>'.format(role.name))
 
-        for org in user.get_all_organizations():
-            roles = []
-            for role in user.roles.filter(organization=org):
-                roles.append('<li>{0}</li>'.format(role.name))
+                organizations.append('<h3>{0}</h3>'.format(org.name))
+                organizations.append('<ul>{0}</ul>'.format("\n".join(roles)))
 
-            organizations.append('<h3>{0}</h3>'.format(org.name))
-            organizations.append('<ul>{0}</ul>'.format("\n".join(roles)))
+            yield '<h2>Organizations</h2>'
+            yield "\n".join(organizations)
 
-        out.append('<h2>Organizations</h2>')
-        out.append("\n".join(organizations))
-
-    return HttpResponse(out)
+    return HttpResponse(render())
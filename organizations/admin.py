@@ -1,13 +1,58 @@
+import json
+import operator
+
 from django import forms
 from django.contrib import admin
+from django.contrib.admin.helpers import ActionForm
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
-from django.contrib.auth.models import User, Group
+from django.contrib.auth.models import User, Group, Permission
+from django.core.exceptions import PermissionDenied
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError
+from django.db.models import Q
+from django.http import Http404, HttpResponse
+from django.utils.encoding import force_unicode
+
+from .cache import commit_on_success
+from .models import Organization, OrganizationUser, SuperRole, Role, \
+        RoleClosure
+from .widgets import AutocompleteSelectMultiple
+
+
+# the number of results in each page of autocomplete lookups
+AUTOCOMPLETE_PAGE_SIZE = 20
+
+
+class _UsernameKeyForm(object):
+    """
+    Checks that the username is unique within the organization regardless of
+    case, which model validation can't, since `username_key` isn't editable.
+    """
+
+    def clean(self):
+        cleaned_data = super(_UsernameKeyForm, self).clean()
+
+        organization = cleaned_data.get('organization')
+        username = cleaned_data.get('username')
+        if organization is None or not username:
+            return cleaned_data
 
-from .models import Organization, OrganizationUser, SuperRole, Role
+        users = OrganizationUser.objects.filter(
+            organization=organization, username_key=username.lower())
+        if self.instance.pk is not None:
+            users = users.exclude(pk=self.instance.pk)
 
+        if users.exists():
+            self._errors['username'] = self.error_class(
+                ['A user with that username already exists in %s.'
+                 % organization])
+            del cleaned_data['username']
 
-class OrganizationUserCreationForm(UserCreationForm):
+        return cleaned_data
+
+
+class OrganizationUserCreationForm(_UsernameKeyForm, UserCreationForm):
 
     username = forms.RegexField(label='Username', max_length=70,
                                 regex=r'^[\w.@+-]+$',
@@ -18,7 +63,7 @@ class OrganizationUserCreationForm(UserCreationForm):
         fields = ("organization", "username")
 
 
-class OrganizationUserChangeForm(UserChangeForm):
+class OrganizationUserChangeForm(_UsernameKeyForm, UserChangeForm):
 
     username = forms.RegexField(label='Username', max_length=70,
                                 regex=r'^[\w.@+-]+$',
@@ -32,7 +77,7 @@ class OrganizationUserChangeForm(UserChangeForm):
         f = self.fields.get('roles', None)
         if f is not None:
             qs = f.queryset
-            orgs = self.instance.get_all_organizations()
+            orgs = self.instance.organization_ids
 
             qs = qs.filter(organization__in=orgs)
             f.queryset = qs
@@ -41,12 +86,87 @@ class OrganizationUserChangeForm(UserChangeForm):
         # organizations
         f = self.fields.get('organizations', None)
         if f is not None:
-            f.queryset = f.queryset.exclude(code=self.instance.organization.code)
+            f.queryset = f.queryset.exclude(pk=self.instance.organization_id)
+
+        # autocomplete lookups are limited the same way, through this form
+        for f in self.fields.values():
+            widget = getattr(f.widget, 'widget', f.widget)
+            if isinstance(widget, AutocompleteSelectMultiple):
+                widget.params['user'] = self.instance.pk
 
     class Meta:
         model = OrganizationUser
 
 
+class OrganizationUserActionForm(ActionForm):
+    """
+    The targets of the bulk actions, given by name, since there can be too
+    many to list.
+    """
+
+    organization = forms.CharField(label='Organization code:', required=False)
+    role = forms.CharField(label='Role:', required=False)
+    super_role = forms.CharField(label='Super role:', required=False)
+
+    def get_organization(self):
+        code = self.cleaned_data.get('organization', '')
+        try:
+            return Organization.objects.get(code_key=code.strip().lower())
+        except Organization.DoesNotExist:
+            raise forms.ValidationError('Enter the code of an organization.')
+
+    def get_role(self):
+        org = self.get_organization()
+        try:
+            return Role.objects.get(organization=org,
+                                    name=self.cleaned_data.get('role', ''))
+        except Role.DoesNotExist:
+            raise forms.ValidationError('Enter the name of a role of the '
+                                        'organization.')
+
+    def get_super_role(self):
+        try:
+            return SuperRole.objects.get(
+                name=self.cleaned_data.get('super_role', ''))
+        except SuperRole.DoesNotExist:
+            raise forms.ValidationError('Enter the name of a super role.')
+
+
+def _bulk_action(method, target, description, message):
+    """
+    Returns an admin action that applies a bulk change of
+    `OrganizationUserManager` to the selected users, in one transaction.
+    """
+
+    def action(modeladmin, request, queryset):
+        form = modeladmin.action_form(request.POST)
+        form.fields['action'].choices = modeladmin.get_action_choices(request)
+        if not form.is_valid():
+            return
+
+        try:
+            obj = getattr(form, 'get_%s' % target)()
+        except forms.ValidationError as e:
+            modeladmin.message_user(request, ' '.join(e.messages))
+            return
+
+        manager = OrganizationUser.objects
+        try:
+            count = commit_on_success()(getattr(manager, method))(
+                queryset, obj)
+        except IntegrityError:
+            modeladmin.message_user(request, 'Some of the users have the '
+                                    'same username as a member of %s.' % obj)
+            return
+
+        modeladmin.message_user(request, message % {'count': count,
+                                                    'target': obj})
+
+    action.__name__ = method
+    action.short_description = description
+    return action
+
+
 class OrganizationUserAdmin(UserAdmin):
     add_form = OrganizationUserCreationForm
 
@@ -69,13 +189,179 @@ class OrganizationUserAdmin(UserAdmin):
 
     list_display = ('username', 'organization', 'first_name', 'last_name',
                     'is_staff')
-    list_filter = ('organization', 'is_staff', 'is_superuser', 'is_active')
+    list_filter = ('is_staff', 'is_superuser', 'is_active')
+    list_select_related = True
+    search_fields = ('username', 'first_name', 'last_name', 'email',
+                     'organization__code')
+    raw_id_fields = ('organization',)
+
+    action_form = OrganizationUserActionForm
+    actions = [
+        _bulk_action('grant_role', 'role',
+                     'Grant the role to the selected users',
+                     'Granted %(target)s to %(count)d users.'),
+        _bulk_action('revoke_role', 'role',
+                     'Revoke the role from the selected users',
+                     'Revoked %(target)s from %(count)d users.'),
+        _bulk_action('grant_super_role', 'super_role',
+                     'Grant the super role to the selected users',
+                     'Granted %(target)s to %(count)d users.'),
+        _bulk_action('revoke_super_role', 'super_role',
+                     'Revoke the super role from the selected users',
+                     'Revoked %(target)s from %(count)d users.'),
+        _bulk_action('add_organization', 'organization',
+                     'Add the selected users to the organization',
+                     'Added %(count)d users to %(target)s.'),
+        _bulk_action('move_organization', 'organization',
+                     'Move the selected users to the organization',
+                     'Moved %(count)d users to %(target)s.'),
+    ]
+
+    # many to many fields that are picked through autocomplete lookups,
+    # with the fields to search and order the results by
+    autocomplete_fields = {
+        'organizations': ('code', 'name'),
+        'roles': ('organization__code', 'name'),
+        'super_roles': ('name',),
+    }
+
+    def queryset(self, request):
+        qs = super(OrganizationUserAdmin, self).queryset(request)
+        return qs.select_related('organization')
+
+    def formfield_for_manytomany(self, db_field, request=None, **kwargs):
+        if db_field.name in self.autocomplete_fields:
+            url = reverse('admin:organizations_organizationuser_autocomplete',
+                          args=(db_field.name,),
+                          current_app=self.admin_site.name)
+            kwargs['widget'] = AutocompleteSelectMultiple(url)
+
+        return super(OrganizationUserAdmin, self).formfield_for_manytomany(
+            db_field, request, **kwargs)
+
+    def get_urls(self):
+        from django.conf.urls.defaults import patterns, url
+
+        urls = patterns('',
+            url(r'^autocomplete/(\w+)/$',
+                self.admin_site.admin_view(self.autocomplete_view),
+                name='organizations_organizationuser_autocomplete'),
+        )
+        return urls + super(OrganizationUserAdmin, self).get_urls()
+
+    def autocomplete_view(self, request, field_name):
+        """
+        Returns a page of the choices of one of the `autocomplete_fields` for
+        the user given in the query string, as JSON.
+        """
+
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+
+        search_fields = self.autocomplete_fields.get(field_name)
+        if search_fields is None:
+            raise Http404
+
+        try:
+            user = self.queryset(request).get(pk=request.GET.get('user'))
+            page = max(int(request.GET.get('page', 1)), 1)
+        except (OrganizationUser.DoesNotExist, ValueError):
+            raise Http404
+
+        # the change form limits the choices
+        qs = self.form(instance=user).fields[field_name].queryset
+
+        for bit in request.GET.get('q', '').split():
+            qs = qs.filter(reduce(operator.or_, [
+                Q(**{'%s__icontains' % name: bit}) for name in search_fields]))
+
+        qs = qs.select_related().order_by(*search_fields + ('pk',))
+
+        # fetch one more row to know if there is a next page, without counting
+        start = (page - 1) * AUTOCOMPLETE_PAGE_SIZE
+        objs = list(qs[start:start + AUTOCOMPLETE_PAGE_SIZE + 1])
+
+        data = {
+            'results': [{'id': obj.pk, 'text': force_unicode(obj)}
+                        for obj in objs[:AUTOCOMPLETE_PAGE_SIZE]],
+            'more': len(objs) > AUTOCOMPLETE_PAGE_SIZE,
+        }
+        return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+class OrganizationAdmin(admin.ModelAdmin):
+    list_display = ('code', 'name', 'parent')
+    search_fields = ('code', 'name')
+    raw_id_fields = ('parent',)
+
+    def queryset(self, request):
+        # the parent is nullable, so select_related() alone skips it
+        qs = super(OrganizationAdmin, self).queryset(request)
+        return qs.select_related('parent')
+
+
+class SuperRoleAdmin(admin.ModelAdmin):
+    list_display = ('name',)
+    search_fields = ('name',)
+    filter_horizontal = ('permissions',)
+
+    def formfield_for_manytomany(self, db_field, request=None, **kwargs):
+        # permissions are labelled with their content type
+        if db_field.name == 'permissions':
+            kwargs['queryset'] = Permission.objects.select_related(
+                'content_type')
+
+        return super(SuperRoleAdmin, self).formfield_for_manytomany(
+            db_field, request, **kwargs)
+
+
+class RoleForm(forms.ModelForm):
+
+    def __init__(self, *args, **kwargs):
+        super(RoleForm, self).__init__(*args, **kwargs)
+
+        # only offer roles of the same organization that don't already
+        # include this one, which would make a cycle
+        f = self.fields.get('includes', None)
+        if f is not None:
+            if self.instance.pk is None:
+                f.queryset = f.queryset.none()
+            else:
+                ancestors = RoleClosure.objects.filter(
+                    descendant=self.instance).values('ancestor')
+                f.queryset = f.queryset.filter(
+                    organization=self.instance.organization_id) \
+                    .exclude(pk__in=ancestors)
+
+    class Meta:
+        model = Role
+
+
+class RoleAdmin(SuperRoleAdmin):
+    form = RoleForm
+    list_display = ('name', 'organization', 'applies_to_descendants')
+    list_select_related = True
+    search_fields = ('name', 'organization__code', 'organization__name')
+    raw_id_fields = ('organization',)
+    filter_horizontal = ('permissions', 'includes')
+
+    def queryset(self, request):
+        qs = super(RoleAdmin, self).queryset(request)
+        return qs.select_related('organization')
+
+    def formfield_for_manytomany(self, db_field, request=None, **kwargs):
+        # included roles are labelled with their organization
+        if db_field.name == 'includes':
+            kwargs['queryset'] = Role.objects.select_related('organization')
+
+        return super(RoleAdmin, self).formfield_for_manytomany(
+            db_field, request, **kwargs)
 
 
 admin.site.register(OrganizationUser, OrganizationUserAdmin)
-admin.site.register(Organization)
-admin.site.register(SuperRole)
-admin.site.register(Role)
+admin.site.register(Organization, OrganizationAdmin)
+admin.site.register(SuperRole, SuperRoleAdmin)
+admin.site.register(Role, RoleAdmin)
 
 # Unregister the default django admins for user and groups
 admin.site.unregister(User)
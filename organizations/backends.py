@@ -1,52 +1,318 @@
+from django.conf import settings
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import Permission
+from django.db import connections
+from django.db.models import ForeignKey, Q
+from django.db.models.fields import FieldDoesNotExist
+
+from . import instrumentation
+from .cache import cache, get_permission_key, get_permission_version, \
+        get_user_snapshot, set_user_snapshot
+from .instrumentation import count_cache, instrumented
+from .models import Membership, Organization, OrganizationClosure, \
+        OrganizationUser, Role, RoleClosure, SuperRole
+from .permissions import PermissionSet, permission_index
+from .throttling import login_throttle
+
+
+# memo key for permissions that aren't limited to a single organization
+_ALL_ORGANIZATIONS = 'all'
+
+# (model, attribute name) -> foreign key to Organization, or None
+_organization_fields = {}
+
+
+class _DigestMemo(dict):
+    """
+    A memo of compiled permission sets, like `_get_permissions` keeps on user
+    objects, filled in from a permission digest as organizations are looked
+    up.
+    """
+
+    def __init__(self, digest, compile_permissions):
+        super(_DigestMemo, self).__init__()
+        self.digest = digest
+        self.compile_permissions = compile_permissions
+
+    def __missing__(self, key):
+        if key == _ALL_ORGANIZATIONS:
+            mask = self.digest['all']
+        else:
+            # only the super roles apply to objects without an organization,
+            # and to organizations the user isn't a member of, which the
+            # digest leaves out along with those that get nothing more
+            index = self.digest['organizations'].get(key)
+            if index is None:
+                mask = self.digest['super_roles']
+            else:
+                mask = self.digest['masks'][index]
+
+        if self.compile_permissions:
+            value = mask
+        else:
+            value = permission_index.names(mask)
 
-from .models import Organization, OrganizationUser
+        self[key] = value
+        return value
 
 
 class OrganizationBackend(ModelBackend):
 
     supports_object_permissions = True
 
-    def authenticate(self, organization=None, username=None, password=None):
+    # Store computed permission sets in the cache framework, so they are
+    # shared between requests and processes. See `organizations.cache`.
+    cache_permissions = getattr(settings, 'ORGANIZATIONS_CACHE_PERMISSIONS',
+                                False)
+    permission_cache_timeout = getattr(settings,
+                                       'ORGANIZATIONS_PERMISSION_CACHE_TIMEOUT',
+                                       None)
+
+    # Reject logins for organization/username pairs and clients with too
+    # many failed attempts, before hashing the password. See
+    # `organizations.throttling`.
+    throttle_logins = getattr(settings, 'ORGANIZATIONS_THROTTLE_LOGINS', False)
+
+    # How `get_user` loads the user on every request: the relations to
+    # select along with it, and the columns to leave out.
+    user_select_related = getattr(settings,
+                                  'ORGANIZATIONS_USER_SELECT_RELATED',
+                                  ('organization',))
+    user_defer = getattr(settings, 'ORGANIZATIONS_USER_DEFER', ())
+
+    # Keep a copy of every user loaded by `get_user` in the cache framework,
+    # dropped whenever the user or any organization is saved.
+    cache_users = getattr(settings, 'ORGANIZATIONS_CACHE_USERS', False)
+    user_cache_timeout = getattr(settings, 'ORGANIZATIONS_USER_CACHE_TIMEOUT',
+                                 None)
+
+    # Store computed permission sets as integer bitmasks instead of sets of
+    # strings. See `organizations.permissions`.
+    compile_permissions = getattr(settings,
+                                  'ORGANIZATIONS_COMPILE_PERMISSIONS', False)
+
+    # Report the timings and counters of every call of the hot paths to
+    # these collectors. See `organizations.instrumentation`.
+    collectors = getattr(settings, 'ORGANIZATIONS_BACKEND_COLLECTORS', ())
+
+    @instrumented('authenticate')
+    def authenticate(self, organization=None, username=None, password=None,
+                     client=None):
+        """
+        Authenticates a user by organization code, username and password.
+        `client` identifies where the login comes from, usually the remote
+        address, and is only used to throttle failed logins.
+        """
 
-        if organization is None:
+        if organization is None or username is None:
             return None
 
-        try:
-            organization = Organization.objects.get(code__iexact=organization)
-        except Organization.DoesNotExist:
+        if self.throttle_logins and \
+                login_throttle.is_throttled(organization, username, client):
             return None
 
+        # Look the user up through the lowercased organization code and
+        # username, which are indexed, in a single query.
+        users = OrganizationUser.objects.select_related('organization')
+
         try:
-            user = OrganizationUser.objects.get(organization=organization,
-                                                username__iexact=username,
-                                                user__is_active=True)
+            user = users.get(organization__code_key=organization.lower(),
+                             username_key=username.lower(),
+                             is_active=True)
             if user.check_password(password):
+                if self.throttle_logins:
+                    login_throttle.reset(organization, username)
                 return user
 
         except OrganizationUser.DoesNotExist:
-            return None
+            pass
+
+        if self.throttle_logins:
+            login_throttle.record_failure(organization, username, client)
+
+        return None
 
     def _create_permission_set(self, perms=None):
         """
         Expects a queryset of permissions, returns a formatted
         set.
+
+        Permission strings come from the in-process permission index, so
+        only the primary keys are fetched.
         """
 
         if perms is None:
             return set()
 
         if isinstance(perms, (list, tuple)):
-            perms = [(perm.content_type.app_label, perm.codename)
-                     for perm in perms]
+            ids = [perm.pk for perm in perms]
 
         else:
-            perms = perms.values_list('content_type__app_label',
-                                        'codename').order_by()
+            ids = perms.values_list('pk', flat=True).order_by()
+
+        return set(permission_index.names_for_ids(ids))
+
+    def _compile_permissions(self, perms):
+        """
+        Expects a queryset of permissions, returns either a frozenset of
+        permission strings or, if `compile_permissions` is set, a bitmask.
+        """
+
+        ids = perms.values_list('pk', flat=True).order_by()
+
+        if self.compile_permissions:
+            return permission_index.mask(ids)
+
+        return permission_index.names_for_ids(ids)
+
+    def _get_permission_names(self, compiled):
+        """
+        Returns the set of permission strings of a compiled permission set.
+        """
+
+        if isinstance(compiled, frozenset):
+            return compiled
+
+        return permission_index.names(compiled)
 
-        return set(['%s.%s' % (ct, name) for ct, name in perms])
+    def _has_permission(self, compiled, perm):
+        """
+        Returns whether a compiled permission set contains the given
+        permission string.
+        """
+
+        if isinstance(compiled, frozenset):
+            return perm in compiled
+
+        return permission_index.has(compiled, perm)
+
+    def _has_module(self, compiled, app_label):
+        """
+        Returns whether a compiled permission set contains any permission of
+        the given app, through the app label index of the set.
+        """
+
+        if isinstance(compiled, PermissionSet):
+            return compiled.has_module(app_label)
+
+        if isinstance(compiled, frozenset):
+            # an empty set, or a set cached by an older version
+            prefix = app_label + '.'
+            return any(perm.startswith(prefix) for perm in compiled)
+
+        return permission_index.has_module(compiled, app_label)
+
+    def _get_organization_field(self, model, attname):
+        """
+        Returns the foreign key to `Organization` named `attname` on the given
+        model class, or None if there is no such field.
+        """
+
+        try:
+            return _organization_fields[model, attname]
+        except KeyError:
+            pass
+
+        field = None
+        opts = getattr(model, '_meta', None)
+
+        if opts is not None:
+            try:
+                field = opts.get_field(attname)
+            except FieldDoesNotExist:
+                pass
 
+            if not isinstance(field, ForeignKey) or \
+                    not issubclass(field.rel.to, Organization):
+                field = None
+
+        _organization_fields[model, attname] = field
+        return field
+
+    def _get_organization_key(self, obj):
+        """
+        Returns the primary key of the organization that owns the supplied
+        object.
+
+        Returns _ALL_ORGANIZATIONS if no object was supplied or the object
+        doesn't have an organization attribute, and None if the attribute is
+        empty or doesn't hold an `Organization` object.
+        """
+
+        if isinstance(obj, Organization):
+            return obj.pk
+
+        attname = getattr(obj, '_ORGANIZATION_ATTRIBUTE', 'organization')
+
+        # read the foreign key column when there is one, so we don't have to
+        # fetch the organization itself
+        field = self._get_organization_field(obj.__class__, attname)
+        if field is not None:
+            return getattr(obj, field.attname)
+
+        if obj is None or not hasattr(obj, attname):
+            return _ALL_ORGANIZATIONS
+
+        object_org = getattr(obj, attname, None)
+
+        # anything that isn't an actual organization can't grant any role
+        # permissions, which is the same as not having an organization
+        if not isinstance(object_org, Organization):
+            return None
+
+        return object_org.pk
+
+    def _get_resolution_branch(self, user_obj, obj, key):
+        """
+        Returns the instrumentation branch for a permission check of the
+        given object, which resolved to the given organization key, from what
+        the user and the object already hold, without any query.
+        """
+
+        if user_obj.is_superuser:
+            return instrumentation.SUPERUSER
+
+        if key == _ALL_ORGANIZATIONS or key is None:
+            return instrumentation.NONE
+
+        if not isinstance(user_obj, OrganizationUser):
+            return instrumentation.NON_MEMBER
+
+        if isinstance(obj, Organization):
+            branch, org = instrumentation.ORGANIZATION, obj
+        else:
+            attname = getattr(obj, '_ORGANIZATION_ATTRIBUTE', 'organization')
+            field = self._get_organization_field(obj.__class__, attname)
+            if field is not None:
+                org = getattr(obj, field.get_cache_name(), None)
+            else:
+                org = getattr(obj, attname, None)
+            branch = instrumentation.ATTRIBUTE
+
+        if key == user_obj.organization_id:
+            return branch
+
+        # other memberships are resolved by the permission query itself, so
+        # they are only told apart once they are loaded on the user object,
+        # which `get_user` does for users of a single organization
+        member_ids = getattr(user_obj, '_organization_ids', None)
+        if member_ids is None:
+            return instrumentation.UNKNOWN
+        if key in member_ids:
+            return branch
+
+        # roles of the organizations above can apply as well, as far as the
+        # parents of the organization are loaded
+        while org is not None:
+            if org.parent_id is None:
+                return instrumentation.NON_MEMBER
+            if org.parent_id in member_ids:
+                return branch
+            org = getattr(org, '_parent_cache', None)
+
+        return instrumentation.UNKNOWN
+
+    @instrumented('get_group_permissions')
     def get_group_permissions(self, user_obj, obj=None):
         """
         Returns a set of all permission strings that this user has through
@@ -79,68 +345,307 @@ class OrganizationBackend(ModelBackend):
         object, nor does it have an attribute that points to an `Organization`
         object, then return all available permissions (as if the supplied object
         was None)
+
+        The result is memoized on the user object, keyed by the organization
+        that owns the object, so repeated checks against objects of the same
+        organization don't hit the database again. Use
+        `clear_permission_cache` after changing the user's roles. If
+        `cache_permissions` is set, results are also shared through the cache
+        framework.
+        """
+
+        compiled = self._get_object_permissions(user_obj, obj)
+        return self._get_permission_names(compiled)
+
+    def _get_object_permissions(self, user_obj, obj):
+        """
+        Returns the compiled permission set for the given user and object.
         """
 
-        # superusers get all permissions, like usual
         if user_obj.is_superuser:
-            perms = Permission.objects.all()
-            return self._create_permission_set(perms)
+            # superusers get the same permissions regardless of the object
+            key = _ALL_ORGANIZATIONS
+        else:
+            key = self._get_organization_key(obj)
+
+        perms = self._get_permissions(user_obj, key)
+
+        if self.collectors:
+            call = instrumentation.get_current_call()
+            if call is not None and call.branch is None:
+                call.branch = self._get_resolution_branch(user_obj, obj, key)
+
+        return perms
+
+    def _get_permissions(self, user_obj, key):
+        """
+        Returns the compiled permission set for the given user and
+        organization key, from the memo on the user object if possible.
+        """
+
+        if user_obj.is_superuser:
+            # superusers get all permissions, like usual. The set is shared
+            # by every superuser and only rebuilt when permissions change.
+            if self.compile_permissions:
+                return permission_index.all_mask()
+            return permission_index.all_names()
 
-        # if the user is not an OrganizationUser, they get no permissions
         if not isinstance(user_obj, OrganizationUser):
-            return set()
+            # if the user is not an OrganizationUser, they get no permissions
+            return frozenset()
 
-        # if the user is not in any roles, they get no permissions
-        if not any([user_obj.super_roles.count(), user_obj.roles.count()]):
-            return set()
+        if not hasattr(user_obj, '_org_perm_cache'):
+            user_obj._org_perm_cache = {}
+
+        try:
+            perms = user_obj._org_perm_cache[key]
+        except KeyError:
+            pass
+        else:
+            if self.collectors:
+                count_cache(True)
+            return perms
 
-        # at this point, they should have some permissions
+        if self.cache_permissions:
+            perms = self._get_cached_permissions(user_obj, key)
+        else:
+            if self.collectors:
+                count_cache(False)
+            perms = self._get_group_permissions(user_obj, key)
+
+        user_obj._org_perm_cache[key] = perms
+        return perms
+
+    def _get_cached_permissions(self, user_obj, key):
+        """
+        Returns the permission set for the given user and organization from
+        the cache framework, computing and storing it if needed.
+        """
+
+        cache_key = get_permission_key(user_obj.pk, key)
+        perms = cache.get(cache_key)
+
+        if self.collectors:
+            count_cache(perms is not None)
+
+        if perms is None:
+            perms = self._get_group_permissions(user_obj, key)
+            cache.set(cache_key, perms, self.permission_cache_timeout)
+
+        return perms
+
+    def _get_group_permissions(self, user_obj, key):
+        """
+        Computes the compiled permission set for the given user and the
+        organization key returned by `_get_organization_key`.
+
+        Everything, including the membership check, is resolved in a single
+        query.
+        """
+
+        # filter on the primary key, looking up a user object would fetch its
+        # parent User row first
+        user_id = user_obj.pk
 
         # start off with the set of super role permissions
-        perms = Permission.objects.filter(superrole__organizationuser=user_obj)
+        super_role_perms = SuperRole.permissions.through.objects.filter(
+            superrole__organizationuser=user_id)
+        query = Q(pk__in=super_role_perms.values('permission'))
+
+        # If the value of the organization attribute is None, then only the
+        # super role permissions apply
+        if key is None:
+            return self._compile_permissions(Permission.objects.filter(query))
+
+        # next, add the permissions provided by the regular roles
+        roles = Role.objects.filter(organizationuser=user_id)
+
+        # if no object was passed in, or the object doesn't have an
+        # organization attribute, include all permissions from all roles.
+        # Otherwise, only include the roles of the organization that owns the
+        # object, and only if the user is a member of that organization.
+        # Roles of the organizations above it that apply to their descendants
+        # count as well, found through the organization closure.
+        if key != _ALL_ORGANIZATIONS:
+            roles = roles.filter(
+                Q(organization__descendant_links__depth=0) |
+                Q(applies_to_descendants=True),
+                organization__descendant_links__descendant=key)
+
+            if key != user_obj.organization_id:
+                roles = roles.filter(organization__memberships__user=user_id)
+            else:
+                # inherited roles still need a membership in their own
+                # organization
+                member_of = Membership.objects.filter(user=user_id)
+                roles = roles.filter(
+                    Q(organization=key) |
+                    Q(organization__in=member_of.values('organization')))
+
+        # and the roles they include, through the role closure. The roles the
+        # user holds decide where the permissions apply, not the roles they
+        # include.
+        included = RoleClosure.objects.filter(ancestor__in=roles)
+        role_perms = Role.permissions.through.objects.filter(
+            role__in=included.values('descendant'))
+
+        query = query | Q(pk__in=role_perms.values('permission'))
+
+        return self._compile_permissions(Permission.objects.filter(query))
+
+    def get_membership_permissions(self, users):
+        """
+        Returns the permission strings of many users at once, as a dict of
+        {user pk: {organization pk: set of permission strings}} covering every
+        organization each user is a member of, and the organizations below
+        them that inherit some of their roles. The sets are the same as
+        `get_group_permissions` returns for those organizations, but they are
+        computed with a fixed number of queries for all of the users.
+        """
 
-        # next, get the set of permissions provided by the regular roles
+        users = list(users)
+        perms = self._get_membership_permission_ids([user.pk for user in users])
 
-        if isinstance(obj, Organization):
-            # if the supplied object is an `Organization` object
-            object_org = obj
-        else:
-            # check the object's organization
-            attname = getattr(obj, '_ORGANIZATION_ATTRIBUTE', 'organization')
+        result = {}
+        for user in users:
+            orgs = result[user.pk] = {}
+            for org_id, ids in perms[user.pk][2].items():
+                if user.is_superuser:
+                    orgs[org_id] = permission_index.all_names()
+                else:
+                    orgs[org_id] = permission_index.names_for_ids(ids)
 
-            # if no object was passed in, or the object doesn't have an
-            # organization attribute, include all permissions from all roles
-            if obj is None or not hasattr(obj, attname):
-                roles = user_obj.roles.all()
-                perms = perms | Permission.objects.filter(role__in=roles)
+        return result
 
-                # done calculating at this point, return early
-                return self._create_permission_set(perms)
+    def _get_membership_permission_ids(self, user_ids):
+        """
+        Returns {user pk: (super role permission ids, role permission ids,
+        {organization pk: permission ids})} for the given users, the last
+        covering the organizations each user is a member of and those that
+        inherit their roles, with three queries, or four when some roles
+        apply to descendant organizations.
+        """
 
-            # At this point, we know the object is not None and the object
-            # has an organization attribute, so fetch the value of the
-            # organization
-            object_org = getattr(obj, attname, None)
+        result = dict((user_id, (set(), set(), {})) for user_id in user_ids)
+
+        memberships = Membership.objects.filter(user__in=user_ids) \
+                                        .values_list('user', 'organization')
+        for user_id, org_id in memberships:
+            result[user_id][2][org_id] = set()
+
+        super_role_perms = SuperRole.permissions.through.objects.filter(
+            superrole__organizationuser__in=user_ids).values_list(
+            'superrole__organizationuser', 'permission')
+
+        # the roles the user holds decide where the permissions of the roles
+        # they include apply
+        role_perms = Role.permissions.through.objects.filter(
+            role__ancestor_links__ancestor__organizationuser__in=user_ids) \
+            .values_list('role__ancestor_links__ancestor__organizationuser',
+                         'role__ancestor_links__ancestor__organization',
+                         'role__ancestor_links__ancestor__'
+                         'applies_to_descendants',
+                         'permission')
+
+        # (user pk, organization pk) -> permission ids of the roles that
+        # apply to the descendants of the organization
+        inherited = {}
+
+        for user_id, org_id, applies, perm_id in role_perms:
+            result[user_id][1].add(perm_id)
+
+            # roles of organizations the user isn't a member of don't count
+            if org_id in result[user_id][2]:
+                result[user_id][2][org_id].add(perm_id)
+                if applies:
+                    inherited.setdefault((user_id, org_id), set()).add(perm_id)
+
+        if inherited:
+            descendants = {}
+            for ancestor, descendant in OrganizationClosure.objects.filter(
+                    ancestor__in=set([org_id for user_id, org_id in inherited]),
+                    depth__gt=0).values_list('ancestor', 'descendant'):
+                descendants.setdefault(ancestor, []).append(descendant)
+
+            for (user_id, org_id), ids in inherited.items():
+                orgs = result[user_id][2]
+                for descendant in descendants.get(org_id, ()):
+                    orgs.setdefault(descendant, set()).update(ids)
+
+        # super role permissions apply everywhere
+        for user_id, perm_id in super_role_perms:
+            result[user_id][0].add(perm_id)
+            for ids in result[user_id][2].values():
+                ids.add(perm_id)
+
+        return result
+
+    def get_permission_digest(self, user_obj):
+        """
+        Returns a compact digest of all of the permissions of the given user,
+        as bitmasks stamped with the current permission version, to store in
+        the session at login. See `load_permission_digest`.
+
+        Bitmasks are as long as the largest permission primary key, so every
+        distinct mask is stored once, organizations refer to it by index, and
+        organizations that only get the super role permissions are left out.
+        """
 
-        # If the value of the organization attribute is None, then return
-        # the currently collected permissions
-        if object_org is None:
-            return self._create_permission_set(perms)
+        # take the version first, so changes made while the permissions are
+        # loaded make the digest stale
+        version = get_permission_version(user_obj.pk)
 
-        # Finally, collect the permissions this user has on this object, based
-        # off of the set of organizations they are a member of
+        super_ids, role_ids, orgs = self._get_membership_permission_ids(
+            [user_obj.pk])[user_obj.pk]
 
-        # If the user is not a member of the organization attached to this
-        # object, then return the collected permissions
-        if object_org not in user_obj.get_all_organizations():
-            return self._create_permission_set(perms)
+        super_mask = permission_index.mask(super_ids)
 
-        # The user is in the organization that owns this object, so collect
-        # all of the permissions this user has for this organization
-        roles = user_obj.roles.filter(organization=object_org)
-        perms = perms | Permission.objects.filter(role__in=roles)
+        masks = {}
+        organizations = {}
+        for org_id, ids in orgs.items():
+            mask = permission_index.mask(ids)
+            if mask != super_mask:
+                organizations[org_id] = masks.setdefault(mask, len(masks))
 
-        return self._create_permission_set(perms)
+        return {
+            'user': user_obj.pk,
+            'version': version,
+            'super_roles': super_mask,
+            'all': permission_index.mask(super_ids | role_ids),
+            'masks': sorted(masks, key=masks.get),
+            'organizations': organizations,
+        }
+
+    def load_permission_digest(self, user_obj, digest, check_version=True):
+        """
+        Answers permission checks for the given user from a digest returned by
+        `get_permission_digest`, instead of the database. Returns False,
+        without using the digest, if it belongs to another user, if
+        permissions have changed since it was computed, or if it was computed
+        in an older layout.
+        """
+
+        if digest.get('user') != user_obj.pk or 'masks' not in digest:
+            return False
+
+        if check_version and \
+                digest.get('version') != get_permission_version(user_obj.pk):
+            return False
+
+        user_obj._org_perm_cache = _DigestMemo(digest, self.compile_permissions)
+        return True
+
+    def clear_permission_cache(self, user_obj):
+        """
+        Forgets the permissions memoized on the given user. Call this after
+        changing the roles or organizations of a user that has already been
+        checked.
+        """
+
+        try:
+            del user_obj._org_perm_cache
+        except AttributeError:
+            pass
 
     def get_all_permissions(self, user_obj, obj=None):
         if user_obj.is_anonymous():
@@ -149,24 +654,176 @@ class OrganizationBackend(ModelBackend):
         # we don't support user permissions
         return self.get_group_permissions(user_obj, obj=obj)
 
+    @instrumented('has_perm')
     def has_perm(self, user_obj, perm, obj=None):
         if not user_obj.is_active:
             return False
 
-        return perm in self.get_all_permissions(user_obj, obj=obj)
+        # active superusers have every permission, without looking them up
+        if user_obj.is_superuser:
+            return True
+
+        if user_obj.is_anonymous():
+            return False
+
+        compiled = self._get_object_permissions(user_obj, obj)
+        return self._has_permission(compiled, perm)
+
+    def has_perm_for_objects(self, user_obj, perm, objs):
+        """
+        Returns a list of booleans, one for each of the supplied objects,
+        telling whether the user has the given permission on that object.
+
+        The objects are grouped by the organization that owns them, so the
+        permissions for each distinct organization are only resolved once.
+        """
+
+        objs = list(objs)
+
+        if not user_obj.is_active or user_obj.is_anonymous():
+            return [False] * len(objs)
+
+        if user_obj.is_superuser:
+            return [True] * len(objs)
+
+        results = {}
+        allowed = []
+
+        for obj in objs:
+            key = self._get_organization_key(obj)
+
+            try:
+                result = results[key]
+            except KeyError:
+                compiled = self._get_permissions(user_obj, key)
+                result = self._has_permission(compiled, perm)
+                results[key] = result
+
+            allowed.append(result)
+
+        return allowed
+
+    def get_permitted_organizations(self, user_obj, perm):
+        """
+        Returns the primary keys of the organizations in which the user has
+        the given permission through one of his/her roles, including the
+        organizations that inherit those roles, as a queryset that can be
+        used in an `__in` lookup.
+
+        Returns None if the user has the permission regardless of the
+        organization, either as a superuser or through a super role, and an
+        empty list if the user can't have the permission at all.
+        """
+
+        if not user_obj.is_active or user_obj.is_anonymous():
+            return []
+
+        if user_obj.is_superuser:
+            return None
+
+        if not isinstance(user_obj, OrganizationUser) or '.' not in perm:
+            return []
+
+        # the permissions of an object without an organization are exactly
+        # the super role permissions
+        if self._has_permission(self._get_permissions(user_obj, None), perm):
+            return None
+
+        app_label, codename = perm.split('.', 1)
+
+        # roles that have the permission themselves or through a role they
+        # include
+        roles = Role.objects.filter(
+            organizationuser=user_obj.pk,
+            descendant_links__descendant__permissions__content_type__app_label=
+                app_label,
+            descendant_links__descendant__permissions__codename=codename)
 
+        # only count the roles of organizations the user is a member of
+        roles = roles.filter(organization__memberships__user=user_obj.pk)
+
+        # the organizations of those roles, and the organizations below them
+        # for roles that apply to descendants
+        orgs = Organization.objects.filter(
+            Q(ancestor_links__depth=0) |
+            Q(ancestor_links__ancestor__role__applies_to_descendants=True),
+            ancestor_links__ancestor__role__in=roles)
+
+        return orgs.values_list('pk', flat=True)
+
+    @instrumented('has_module_perms')
     def has_module_perms(self, user_obj, app_label, obj=None):
         if not user_obj.is_active:
             return False
 
-        for perm in self.get_all_permissions(user_obj, obj=obj):
-            if perm[:perm.index('.')] == app_label:
-                return True
+        if user_obj.is_superuser:
+            return True
 
-        return False
+        if user_obj.is_anonymous():
+            return False
 
+        compiled = self._get_object_permissions(user_obj, obj)
+        return self._has_module(compiled, app_label)
+
+    @instrumented('get_user')
     def get_user(self, user_id):
+        if self.cache_users:
+            user = get_user_snapshot(user_id)
+            if self.collectors:
+                count_cache(user is not None)
+            if user is not None:
+                return user
+
+        users = OrganizationUser.objects.all()
+
+        if self.user_select_related:
+            users = users.select_related(*self.user_select_related)
+
+        if self.user_defer:
+            # defer() only touching fields of the parent User trips over
+            # select_related() on this Django version, only() doesn't
+            users = users.only(*[f.name for f in OrganizationUser._meta.fields
+                                 if f.name not in self.user_defer])
+
+        if self.collectors:
+            # tell whether the user has memberships besides the primary one
+            # along with the user, so permission checks can be told apart by
+            # membership without a query of their own
+            users = users.extra(select={
+                '_other_memberships': self._other_memberships_sql(users.db)})
+
         try:
-            return OrganizationUser.objects.get(pk=user_id)
+            user = users.get(pk=user_id)
         except OrganizationUser.DoesNotExist:
             return None
+
+        other_memberships = user.__dict__.pop('_other_memberships', True)
+
+        if self.cache_users:
+            set_user_snapshot(user, self.user_cache_timeout)
+
+        # memberships aren't kept in snapshots, those aren't dropped when the
+        # memberships change
+        if not other_memberships:
+            user._organization_ids = frozenset([user.organization_id])
+
+        return user
+
+    def _other_memberships_sql(self, using):
+        """
+        Returns the SQL of a subquery that tells whether the user of a row of
+        `OrganizationUser` is a member of any organization besides its
+        primary organization.
+        """
+
+        qn = connections[using].ops.quote_name
+        opts = OrganizationUser._meta
+        membership = Membership._meta
+
+        return ('EXISTS (SELECT 1 FROM {0} WHERE {0}.{1} = {2}.{3} '
+                'AND {0}.{4} <> {2}.{5})').format(
+            qn(membership.db_table),
+            qn(membership.get_field('user').column),
+            qn(opts.db_table), qn(opts.pk.column),
+            qn(membership.get_field('organization').column),
+            qn(opts.get_field('organization').column))
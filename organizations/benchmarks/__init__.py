@@ -0,0 +1,15 @@
+"""
+Benchmarks of the backend, the models and the admin against synthetic
+tenants, with a query budget for every path. Use the
+`benchmark_organizations` command, or:
+
+    dataset = generate_dataset(organizations=10, users=1000)
+    results = run_benchmarks(dataset, repeat=20)
+"""
+
+from .dataset import Dataset, generate_dataset
+from .runner import PATHS, QUERY_BUDGETS, Result, run_benchmarks
+
+
+__all__ = ('Dataset', 'generate_dataset', 'PATHS', 'QUERY_BUDGETS', 'Result',
+           'run_benchmarks')
@@ -0,0 +1,96 @@
+"""
+Synthetic tenants to benchmark against.
+"""
+
+import random
+
+from django.contrib.auth.models import Permission
+
+from organizations.models import Organization, OrganizationUser, Role
+
+
+PASSWORD = 'benchmark'
+
+
+class Dataset(object):
+    """
+    The primary keys of the rows of a generated dataset, along with the
+    organization code and username of every user, to log in with.
+    """
+
+    def __init__(self, organization_ids, role_ids, users):
+        self.organization_ids = organization_ids
+        self.role_ids = role_ids
+        self.users = users
+        self.password = PASSWORD
+
+    @property
+    def user_ids(self):
+        return [pk for pk, code, username in self.users]
+
+
+def generate_dataset(organizations=10, users=100, roles=5, permissions=10,
+                     memberships=2, roles_per_user=2, prefix='bench',
+                     seed=0, processes=1):
+    """
+    Creates `organizations` organizations with `users` users and `roles`
+    roles each, every role with `permissions` permissions picked among the
+    existing ones. Every user is also a member of `memberships` other
+    organizations, and is given `roles_per_user` roles of his/her
+    organizations. Every user has the same password, `PASSWORD`.
+
+    Organization codes start with `prefix`, and the same `seed` always picks
+    the same relations. Returns a `Dataset`.
+    """
+
+    rand = random.Random(seed)
+
+    perm_ids = list(Permission.objects.values_list('pk', flat=True)
+                                      .order_by('pk'))
+
+    orgs = []
+    for i in range(organizations):
+        code = '%s%d' % (prefix, i)
+        orgs.append(Organization.objects.create(code=code,
+                                                name='Benchmark %d' % i))
+
+    org_roles = {}
+    for org in orgs:
+        org_roles[org.pk] = []
+        for i in range(roles):
+            role = Role.objects.create(organization=org, name='Role %d' % i)
+            role.permissions.add(*rand.sample(perm_ids,
+                                              min(permissions, len(perm_ids))))
+            org_roles[org.pk].append(role.pk)
+
+    def specs():
+        for org in orgs:
+            for i in range(users):
+                others = [o.pk for o in
+                          rand.sample(orgs, min(memberships + 1, len(orgs)))
+                          if o != org][:memberships]
+
+                choices = []
+                for pk in [org.pk] + others:
+                    choices.extend(org_roles[pk])
+
+                yield {
+                    'organization': org,
+                    # unique across organizations, in case the username
+                    # column still is
+                    'username': '%s.%d' % (org.code, i),
+                    'email': 'user%d@%s.example.com' % (i, org.code),
+                    'password': PASSWORD,
+                    'organizations': others,
+                    'roles': rand.sample(choices,
+                                         min(roles_per_user, len(choices))),
+                }
+
+    created = OrganizationUser.objects.bulk_create_users(specs(),
+                                                         processes=processes)
+
+    codes = dict((org.pk, org.code) for org in orgs)
+    return Dataset([org.pk for org in orgs],
+                   [pk for pks in org_roles.values() for pk in pks],
+                   [(user.pk, codes[user.organization_id], user.username)
+                    for user in created])
@@ -0,0 +1,197 @@
+"""
+Times the hot paths of the backend, the models and the admin against a
+generated dataset, and counts their queries.
+"""
+
+import time
+
+from django.contrib import admin
+from django.test.client import RequestFactory
+
+from organizations.backends import OrganizationBackend
+from organizations.instrumentation import QueryCounter
+from organizations.models import Organization, OrganizationUser, Role
+
+
+class Result(object):
+    """
+    The measurements of a path. `queries` is the largest number of queries
+    of a single call, which has to stay within `budget`.
+    """
+
+    def __init__(self, name, budget):
+        self.name = name
+        self.budget = budget
+        self.calls = 0
+        self.time = 0.0
+        self.queries = 0
+
+    @property
+    def time_per_call(self):
+        return self.calls and self.time / self.calls or 0.0
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.queries > self.budget
+
+    def __repr__(self):
+        return '<Result %s: %.6fs, %d queries>' % (
+            self.name, self.time_per_call, self.queries)
+
+
+def _load_user(dataset, i):
+    pk = dataset.user_ids[i % len(dataset.users)]
+    return OrganizationUser.objects.select_related('organization').get(pk=pk)
+
+
+def _other_organization(dataset, user, member):
+    """
+    Returns an organization of the dataset that the user is a member of, other
+    than the primary one, or one that the user isn't a member of.
+    """
+
+    for pk in dataset.organization_ids:
+        if pk != user.organization_id and \
+                (pk in user.organization_ids) == member:
+            return Organization.objects.get(pk=pk)
+
+    return user.organization
+
+
+# Every path takes the dataset, the backend and the iteration, sets up
+# whatever it needs, and returns the call to measure.
+
+def authenticate(dataset, backend, i):
+    pk, code, username = dataset.users[i % len(dataset.users)]
+    return lambda: backend.authenticate(code, username, dataset.password)
+
+
+def get_user(dataset, backend, i):
+    pk = dataset.user_ids[i % len(dataset.users)]
+    return lambda: backend.get_user(pk)
+
+
+def _group_permissions(get_object):
+    def path(dataset, backend, i):
+        user = _load_user(dataset, i)
+        obj = get_object(dataset, user)
+        return lambda: backend.get_group_permissions(user, obj)
+    return path
+
+
+def _organization_object(dataset, user):
+    return _other_organization(dataset, user, True)
+
+
+def _attribute_object(dataset, user):
+    # roles are owned by an organization
+    org = _other_organization(dataset, user, True)
+    return Role(organization_id=org.pk)
+
+
+def _non_member_object(dataset, user):
+    return _other_organization(dataset, user, False)
+
+
+def has_module_perms(dataset, backend, i):
+    user = _load_user(dataset, i)
+    return lambda: backend.has_module_perms(user, 'auth')
+
+
+def all_members(dataset, backend, i):
+    org = Organization.objects.get(
+        pk=dataset.organization_ids[i % len(dataset.organization_ids)])
+    return lambda: list(org.all_members())
+
+
+def get_all_organizations(dataset, backend, i):
+    user = _load_user(dataset, i)
+    return lambda: list(user.get_all_organizations())
+
+
+def _changelist(model):
+    def path(dataset, backend, i):
+        model_admin = admin.site._registry[model]
+
+        # an unsaved change to an existing user, so nothing is written
+        user = _load_user(dataset, i)
+        user.is_staff = user.is_superuser = True
+
+        request = RequestFactory().get('/')
+        request.user = user
+
+        def run():
+            response = model_admin.changelist_view(request)
+            # template responses are rendered lazily
+            getattr(response, 'render', lambda: None)()
+            return response
+
+        return run
+    return path
+
+
+# (name, path, query budget)
+PATHS = (
+    ('authenticate', authenticate, 1),
+    ('get_user', get_user, 1),
+    ('get_group_permissions:none',
+     _group_permissions(lambda dataset, user: None), 1),
+    ('get_group_permissions:organization',
+     _group_permissions(_organization_object), 1),
+    ('get_group_permissions:attribute',
+     _group_permissions(_attribute_object), 1),
+    ('get_group_permissions:non-member',
+     _group_permissions(_non_member_object), 1),
+    ('has_module_perms', has_module_perms, 1),
+    ('all_members', all_members, 1),
+    ('get_all_organizations', get_all_organizations, 1),
+    # counting, the page of results, and the messages of the user
+    ('admin:organizationuser', _changelist(OrganizationUser), 3),
+    ('admin:organization', _changelist(Organization), 3),
+    ('admin:role', _changelist(Role), 3),
+)
+
+QUERY_BUDGETS = dict((name, budget) for name, path, budget in PATHS)
+
+
+def run_benchmarks(dataset, repeat=10, backend=None, names=None):
+    """
+    Runs every path, or the named ones, `repeat` times against the dataset,
+    after running it once to load whatever is loaded once per process, like
+    the permission index. Permission checks start from a fresh user object
+    every time, so nothing is memoized. Admin paths are skipped if the model
+    isn't registered. Returns a list of `Result`.
+    """
+
+    if backend is None:
+        backend = OrganizationBackend()
+
+    results = []
+    for name, path, budget in PATHS:
+        if names is not None and name not in names:
+            continue
+        if name.startswith('admin:') and \
+                name[6:] not in [model._meta.module_name for model in
+                                 admin.site._registry]:
+            continue
+
+        result = Result(name, budget)
+        counter = QueryCounter()
+
+        path(dataset, backend, 0)()
+
+        for i in range(repeat):
+            run = path(dataset, backend, i)
+
+            counter.start()
+            start = time.time()
+            try:
+                run()
+            finally:
+                result.time += time.time() - start
+                result.queries = max(result.queries, counter.stop())
+            result.calls += 1
+
+        results.append(result)
+
+    return results
@@ -0,0 +1,298 @@
+"""
+Versioned cache keys for permission data shared between processes.
+
+Every permission set stored in the cache is keyed by the user, the
+organization and a version. The version is made of a global token, bumped
+whenever a change can affect any number of users (role or super role
+permissions), and a per-user token, bumped whenever the roles or
+organizations of a single user change. Tokens are random, so a version is
+never reused, even if the cache evicts a version key and it has to be
+recreated.
+"""
+
+import threading
+import uuid
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.signals import request_finished
+from django.db import transaction
+
+
+CACHE_ALIAS = getattr(settings, 'ORGANIZATIONS_CACHE', 'default')
+
+KEY_PREFIX = 'organizations'
+
+cache = get_cache(CACHE_ALIAS)
+
+# Everything cached under a version, including the permission digests kept in
+# sessions, is dropped when its version token expires, so tokens are kept at
+# least as long as cached permission sets, and 30 days by default.
+VERSION_TIMEOUT = max(
+    getattr(settings, 'ORGANIZATIONS_PERMISSION_VERSION_TIMEOUT',
+            60 * 60 * 24 * 30),
+    getattr(settings, 'ORGANIZATIONS_PERMISSION_CACHE_TIMEOUT', None) or 0)
+
+_pending = threading.local()
+
+
+def is_shared():
+    """
+    Returns whether the cache is shared between processes, which local memory
+    and dummy caches aren't.
+    """
+
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+def _new_token():
+    return uuid.uuid4().hex[:12]
+
+
+def _version_key(user_id=None):
+    if user_id is None:
+        return '%s:version' % KEY_PREFIX
+    return '%s:version:%s' % (KEY_PREFIX, user_id)
+
+
+def get_permission_version(user_id):
+    """
+    Returns the current permission version for the given user.
+    """
+
+    keys = [_version_key(), _version_key(user_id)]
+    versions = cache.get_many(keys)
+
+    tokens = []
+    for key in keys:
+        token = versions.get(key)
+        if token is None:
+            # somebody else may have created the token in the meantime, in
+            # which case theirs wins
+            token = _new_token()
+            if not cache.add(key, token, VERSION_TIMEOUT):
+                token = cache.get(key, token)
+        tokens.append(token)
+
+    return '.'.join(tokens)
+
+
+def get_permission_key(user_id, organization_key):
+    """
+    Returns the cache key for the permissions of the given user on the given
+    organization key, stamped with the current permission version.
+    """
+
+    version = get_permission_version(user_id)
+    return '%s:perms:%s:%s:%s' % (KEY_PREFIX, user_id, organization_key,
+                                  version)
+
+
+def _bump(user_ids=None):
+    if user_ids is None:
+        cache.set(_version_key(), _new_token(), VERSION_TIMEOUT)
+    else:
+        cache.set_many(dict((_version_key(user_id), _new_token())
+                            for user_id in user_ids), VERSION_TIMEOUT)
+
+
+def bump_permission_version(user_ids=None):
+    """
+    Invalidates cached permissions. If `user_ids` is None, the permissions of
+    every user are invalidated, otherwise only those of the given users.
+
+    Changes made inside a managed transaction aren't visible to other
+    processes until it is committed, and another process could cache the old
+    permissions under the new version in the meantime. The version is bumped
+    again to cover that window, once the block is left if it was entered
+    through `commit_on_success` below, or else once the current request has
+    finished.
+    """
+
+    if user_ids is not None:
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+
+    _bump(user_ids)
+
+    pending = _get_pending()
+    if pending is not None:
+        if user_ids is None:
+            pending.everyone = True
+        else:
+            pending.user_ids.update(user_ids)
+
+
+# Cached copies of user objects, see `OrganizationBackend.get_user`. A
+# snapshot is dropped whenever its user is saved or deleted. Snapshots
+# include the user's primary organization, so they are all invalidated at
+# once, through a generation token, when any organization changes.
+
+def _snapshot_key(user_id):
+    return '%s:user:%s' % (KEY_PREFIX, user_id)
+
+
+def _generation_key():
+    return '%s:user_generation' % KEY_PREFIX
+
+
+def get_user_snapshot(user_id):
+    """
+    Returns the cached copy of the given user, or None.
+    """
+
+    key = _snapshot_key(user_id)
+    values = cache.get_many([key, _generation_key()])
+
+    snapshot = values.get(key)
+    generation = values.get(_generation_key())
+
+    if snapshot is None or generation is None or snapshot[0] != generation:
+        return None
+
+    return snapshot[1]
+
+
+def set_user_snapshot(user, timeout=None):
+    """
+    Caches a copy of the given user.
+    """
+
+    generation = cache.get(_generation_key())
+    if generation is None:
+        generation = _new_token()
+        if not cache.add(_generation_key(), generation, VERSION_TIMEOUT):
+            generation = cache.get(_generation_key(), generation)
+
+    cache.set(_snapshot_key(user.pk), (generation, user), timeout)
+
+
+def invalidate_user_snapshot(user_id=None):
+    """
+    Drops the cached copy of the given user, or of every user if `user_id`
+    is None. Like permission versions, this is repeated after the managed
+    transaction in progress, if any.
+    """
+
+    if user_id is None:
+        cache.set(_generation_key(), _new_token(), VERSION_TIMEOUT)
+    else:
+        cache.delete(_snapshot_key(user_id))
+
+    pending = _get_pending()
+    if pending is not None:
+        if user_id is None:
+            pending.generation = True
+        else:
+            pending.snapshots.add(user_id)
+
+
+def invalidate_user_snapshots(user_ids):
+    """
+    Drops the cached copies of the given users at once.
+    """
+
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    cache.delete_many([_snapshot_key(user_id) for user_id in user_ids])
+
+    pending = _get_pending()
+    if pending is not None:
+        pending.snapshots.update(user_ids)
+
+
+# The invalidations made inside of the managed transaction in progress, to
+# repeat once it's over. Past `_MAX_PENDING` users, everyone is invalidated
+# instead, so long transactions don't keep every user id around.
+_MAX_PENDING = 10000
+
+
+def _get_pending():
+    """
+    Returns the invalidations to repeat after the current managed
+    transaction, or None if changes are committed right away.
+    """
+
+    if not transaction.is_managed():
+        # left over from a managed block that has been left since
+        flush_pending()
+        return None
+
+    if not hasattr(_pending, 'user_ids'):
+        _pending.user_ids = set()
+        _pending.everyone = False
+        _pending.snapshots = set()
+        _pending.generation = False
+
+    if len(_pending.user_ids) > _MAX_PENDING:
+        _pending.user_ids = set()
+        _pending.everyone = True
+    if len(_pending.snapshots) > _MAX_PENDING:
+        _pending.snapshots = set()
+        _pending.generation = True
+
+    return _pending
+
+
+def flush_pending(**kwargs):
+    """
+    Repeats the invalidations made inside of a managed transaction, once it
+    has been committed.
+    """
+
+    if not hasattr(_pending, 'user_ids'):
+        return
+
+    if _pending.everyone:
+        _bump()
+    elif _pending.user_ids:
+        _bump(_pending.user_ids)
+
+    if _pending.generation:
+        cache.set(_generation_key(), _new_token(), VERSION_TIMEOUT)
+    elif _pending.snapshots:
+        cache.delete_many([_snapshot_key(user_id)
+                           for user_id in _pending.snapshots])
+
+    del _pending.user_ids
+    del _pending.everyone
+    del _pending.snapshots
+    del _pending.generation
+
+request_finished.connect(flush_pending)
+
+
+class commit_on_success(object):
+    """
+    Like `django.db.transaction.commit_on_success`, as a decorator or a
+    context manager, but repeats the invalidations made inside of the block
+    once the outermost managed block has been left. Outside of requests,
+    changes to permissions should be committed through it.
+    """
+
+    def __init__(self, using=None):
+        self.using = using
+        self.transaction = transaction.commit_on_success(using=using)
+
+    def __enter__(self):
+        self.transaction.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.transaction.__exit__(exc_type, exc_value, traceback)
+        finally:
+            if not transaction.is_managed(using=self.using):
+                flush_pending()
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return inner
@@ -0,0 +1,277 @@
+"""
+Timings and counters for the hot paths of the authentication backend.
+
+Every call of `authenticate`, `get_user`, `get_group_permissions`, `has_perm`
+and `has_module_perms` is measured and handed to a list of collectors, as a
+`Call` with its wall time, the number of queries it ran, the permission
+cache hits and misses, and the branch taken to resolve the organization of
+the object. Calls made from within another measured call, like
+`has_module_perms` looking up permissions, are part of the outer call.
+
+Collectors are given as dotted paths to collector objects, or to classes to
+instantiate, with a setting:
+
+    ORGANIZATIONS_BACKEND_COLLECTORS = (
+        'organizations.instrumentation.backend_stats',
+        'organizations.instrumentation.SignalCollector',
+    )
+
+Nothing is measured if there are none, which is the default. Counting
+queries puts every database connection in debug mode for the duration of
+each call, so measuring has a cost of its own.
+"""
+
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.dispatch import Signal
+from django.utils.importlib import import_module
+
+
+# The branches taken to resolve the organization of the object of a
+# permission check: an `Organization` object, an object with an organization
+# attribute, no organization at all, an organization the user isn't a member
+# of, superusers, who need no organization, and checks that can't be told
+# apart without loading the memberships of the user.
+ORGANIZATION = 'organization'
+ATTRIBUTE = 'attribute'
+NONE = 'none'
+NON_MEMBER = 'non-member'
+SUPERUSER = 'superuser'
+UNKNOWN = 'unknown'
+
+# sent with every measured call by `SignalCollector`
+backend_call = Signal(providing_args=['call'])
+
+_local = threading.local()
+
+# paths -> collectors
+_collectors = {}
+
+
+class Call(object):
+    """
+    A measured call of a backend method. `duration` is in seconds.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.duration = 0.0
+        self.queries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.branch = None
+
+    def __repr__(self):
+        return '<Call %s %s: %.6fs, %d queries>' % (
+            self.name, self.branch, self.duration, self.queries)
+
+
+class Collector(object):
+    """
+    Receives every measured call through `record`. Any object with a `record`
+    method will do; this one ignores every call.
+    """
+
+    def record(self, call):
+        pass
+
+
+class InMemoryCollector(Collector):
+    """
+    Aggregates calls in memory, per process, by method and by branch.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def _totals(self):
+        return {'calls': 0, 'time': 0.0, 'max_time': 0.0, 'queries': 0,
+                'cache_hits': 0, 'cache_misses': 0}
+
+    def _add(self, totals, call):
+        totals['calls'] += 1
+        totals['time'] += call.duration
+        totals['max_time'] = max(totals['max_time'], call.duration)
+        totals['queries'] += call.queries
+        totals['cache_hits'] += call.cache_hits
+        totals['cache_misses'] += call.cache_misses
+
+    def record(self, call):
+        self._lock.acquire()
+        try:
+            stats = self._stats.get(call.name)
+            if stats is None:
+                stats = self._stats[call.name] = self._totals()
+                stats['branches'] = {}
+
+            self._add(stats, call)
+
+            if call.branch is not None:
+                branch = stats['branches'].get(call.branch)
+                if branch is None:
+                    branch = stats['branches'][call.branch] = self._totals()
+                self._add(branch, call)
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        """
+        Returns {method name: totals} where the totals are the number of
+        `calls`, the total and maximum wall `time` and `max_time`, and the
+        number of `queries`, `cache_hits` and `cache_misses`, along with
+        `branches`, {branch: totals} for the calls that resolved the
+        organization of an object.
+        """
+
+        self._lock.acquire()
+        try:
+            stats = {}
+            for name, totals in self._stats.items():
+                stats[name] = dict(totals)
+                stats[name]['branches'] = dict(
+                    (branch, dict(branch_totals)) for branch, branch_totals
+                    in totals['branches'].items())
+            return stats
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._stats = {}
+        finally:
+            self._lock.release()
+
+
+class SignalCollector(Collector):
+    """
+    Sends the `backend_call` signal for every call, with the call.
+    """
+
+    def record(self, call):
+        backend_call.send(sender=self.__class__, call=call)
+
+
+backend_stats = InMemoryCollector()
+
+
+class QueryCounter(object):
+    """
+    Counts the queries run on every database connection between `start` and
+    `stop`, through debug cursors, whether or not DEBUG is on.
+    """
+
+    def start(self):
+        self._connections = []
+        for connection in connections.all():
+            self._connections.append((connection, connection.use_debug_cursor,
+                                      len(connection.queries)))
+            connection.use_debug_cursor = True
+
+    def stop(self):
+        """
+        Returns the number of queries run since `start`.
+        """
+
+        count = 0
+        for connection, use_debug_cursor, start in self._connections:
+            count += len(connection.queries) - start
+            connection.use_debug_cursor = use_debug_cursor
+
+            # only keep the queries if they were logged anyway
+            if not (use_debug_cursor or (use_debug_cursor is None and
+                                         settings.DEBUG)):
+                del connection.queries[start:]
+
+        self._connections = []
+        return count
+
+
+def get_collectors(paths):
+    """
+    Returns the collectors for the given dotted paths, loaded once.
+    """
+
+    paths = tuple(paths)
+
+    try:
+        return _collectors[paths]
+    except KeyError:
+        pass
+
+    collectors = []
+    for path in paths:
+        module, attr = path.rsplit('.', 1)
+        try:
+            collector = getattr(import_module(module), attr)
+        except (ImportError, AttributeError) as e:
+            raise ImproperlyConfigured("Error loading collector %s: %s"
+                                       % (path, e))
+
+        if isinstance(collector, type):
+            collector = collector()
+        collectors.append(collector)
+
+    _collectors[paths] = collectors
+    return collectors
+
+
+def get_current_call():
+    """
+    Returns the call being measured in this thread, if any.
+    """
+
+    return getattr(_local, 'call', None)
+
+
+def count_cache(hit):
+    """
+    Counts a permission cache hit or miss for the call being measured.
+    """
+
+    call = getattr(_local, 'call', None)
+    if call is None:
+        return
+
+    if hit:
+        call.cache_hits += 1
+    else:
+        call.cache_misses += 1
+
+
+def instrumented(name):
+    """
+    Measures calls of a backend method, if the backend has collectors.
+    """
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.collectors or \
+                    getattr(_local, 'call', None) is not None:
+                return method(self, *args, **kwargs)
+
+            call = _local.call = Call(name)
+            counter = QueryCounter()
+
+            counter.start()
+            start = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                call.duration = time.time() - start
+                call.queries = counter.stop()
+                _local.call = None
+
+                for collector in get_collectors(self.collectors):
+                    collector.record(call)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,89 @@
+"""
+Management utility to benchmark the backend against synthetic tenants.
+
+The dataset is generated in a test database of the default database, created
+for the run and destroyed afterwards, so it runs against SQLite or
+PostgreSQL the same way the test suite does, without touching real data.
+"""
+
+from optparse import make_option
+
+from django.contrib import admin
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from organizations.benchmarks import generate_dataset, run_benchmarks, \
+        QUERY_BUDGETS
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--organizations', dest='organizations', type='int',
+            default=10, help='The number of organizations.'),
+        make_option('--users', dest='users', type='int', default=100,
+            help='The number of users of each organization.'),
+        make_option('--roles', dest='roles', type='int', default=5,
+            help='The number of roles of each organization.'),
+        make_option('--permissions', dest='permissions', type='int',
+            default=10, help='The number of permissions of each role.'),
+        make_option('--memberships', dest='memberships', type='int',
+            default=2,
+            help='The number of additional organizations of each user.'),
+        make_option('--repeat', dest='repeat', type='int', default=10,
+            help='The number of times to run every path.'),
+        make_option('--check-budgets', action='store_true',
+            dest='check_budgets', default=False,
+            help='Fail if a path runs more queries than its budget.'),
+        make_option('--noinput', action='store_false', dest='interactive',
+            default=True,
+            help='Replace an existing test database without asking.'),
+    )
+    args = '[path path ...]'
+    help = ('Times the hot paths of the backend, the models and the admin '
+            'against generated organizations, and counts their queries. '
+            'Runs every path if none is given. Available paths: %s.'
+            % ', '.join(sorted(QUERY_BUDGETS)))
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        for name in args:
+            if name not in QUERY_BUDGETS:
+                raise CommandError("Unknown path: %s" % name)
+
+        # register the admin changelists, like the URLconf would
+        admin.autodiscover()
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=max(verbosity - 1, 0),
+            autoclobber=not options.get('interactive', True))
+
+        try:
+            dataset = generate_dataset(
+                organizations=options.get('organizations') or 1,
+                users=options.get('users') or 1,
+                roles=options.get('roles') or 1,
+                permissions=options.get('permissions') or 0,
+                memberships=options.get('memberships') or 0)
+
+            results = run_benchmarks(dataset, options.get('repeat') or 1,
+                                     names=args or None)
+        finally:
+            connection.creation.destroy_test_db(old_name,
+                                                max(verbosity - 1, 0))
+
+        over = []
+        for result in results:
+            if result.over_budget:
+                over.append(result.name)
+
+            if verbosity >= 1:
+                self.stdout.write("%-36s %10.3f ms %4d queries (budget %d)%s\n"
+                                  % (result.name, result.time_per_call * 1000,
+                                     result.queries, result.budget,
+                                     result.over_budget and ' OVER' or ''))
+
+        if options.get('check_budgets') and over:
+            raise CommandError("Over the query budget: %s"
+                               % ', '.join(over))
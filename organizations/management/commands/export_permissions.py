@@ -0,0 +1,108 @@
+"""
+Management utility to export the effective permissions of every membership.
+"""
+
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from organizations.backends import OrganizationBackend
+from organizations.models import Organization, OrganizationUser
+
+
+def iter_users(chunk_size=1000):
+    """
+    Yields lists of users in primary key order, `chunk_size` at a time. Each
+    chunk starts after the last primary key of the previous one, so it's
+    found through the index no matter how far the export has gone.
+    """
+
+    users = OrganizationUser.objects.only('username', 'is_active',
+                                          'is_superuser', 'organization') \
+                                    .order_by('pk')
+    last = None
+
+    while True:
+        chunk = users
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+
+        yield chunk
+        last = chunk[-1].pk
+
+
+def export_permissions(output, chunk_size=1000, backend=None):
+    """
+    Writes a JSON line for every (user, organization) membership to the given
+    file, with the permissions of the user in that organization, and for
+    every organization below them that inherits some of the user's roles.
+    Returns the number of lines written.
+    """
+
+    if backend is None:
+        backend = OrganizationBackend()
+
+    codes = {}
+    count = 0
+
+    for users in iter_users(chunk_size):
+        perms = backend.get_membership_permissions(users)
+
+        missing = set()
+        for orgs in perms.values():
+            missing.update([pk for pk in orgs if pk not in codes])
+        if missing:
+            codes.update(Organization.objects.filter(pk__in=missing)
+                                             .values_list('pk', 'code'))
+
+        for user in users:
+            for org_id, names in sorted(perms[user.pk].items()):
+                output.write(json.dumps({
+                    'user_id': user.pk,
+                    'username': user.username,
+                    'is_active': user.is_active,
+                    'organization_id': org_id,
+                    'organization': codes[org_id],
+                    'is_primary': org_id == user.organization_id,
+                    'permissions': sorted(names),
+                }, sort_keys=True))
+                output.write('\n')
+                count += 1
+
+    return count
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+            help='The file to write to. Standard output by default.'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=1000,
+            help='The number of users to load at once.'),
+    )
+    help = ('Exports the effective permissions of every user in every '
+            'organization he/she is a member of, as JSON lines.')
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        chunk_size = options.get('chunk_size') or 1000
+        path = options.get('output')
+
+        if path:
+            output = open(path, 'w')
+        else:
+            output = self.stdout
+
+        try:
+            count = export_permissions(output, chunk_size)
+        finally:
+            if path:
+                output.close()
+
+        if path and verbosity >= 1:
+            self.stdout.write("Exported %d memberships.\n" % count)
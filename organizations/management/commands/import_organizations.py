@@ -0,0 +1,564 @@
+"""
+Management utility to import organizations, roles, users and memberships.
+
+Files are read one batch at a time, and every batch is upserted in its own
+transaction, so importing the same file again only fills in what is missing.
+An interrupted import can simply be restarted.
+"""
+
+import csv
+import json
+import multiprocessing
+import os
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from organizations.cache import bump_permission_version, \
+        commit_on_success, invalidate_user_snapshot
+from organizations.models import Membership, Organization, \
+        OrganizationClosure, OrganizationUser, Role, RoleClosure, SuperRole, \
+        insert_rows
+from organizations.permissions import permission_index
+
+
+def _update(model, fields, rows):
+    """
+    Updates the given fields of a model from rows of values, each followed by
+    the primary key of the row to update.
+    """
+
+    if not rows:
+        return
+
+    qn = connection.ops.quote_name
+    fields = [model._meta.get_field(name) for name in fields]
+
+    sql = 'UPDATE %s SET %s WHERE %s = %%s' % (
+        qn(model._meta.db_table),
+        ', '.join(['%s = %%s' % qn(field.column) for field in fields]),
+        qn(model._meta.pk.column))
+
+    connection.cursor().executemany(sql, [
+        [field.get_db_prep_save(value, connection=connection)
+         for field, value in zip(fields, row[:-1])] + [row[-1]]
+        for row in rows])
+
+
+def _split(value):
+    """
+    Returns a list from a JSON list, or from a whitespace separated CSV
+    column.
+    """
+
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        return value.split()
+    return list(value)
+
+
+def _flag(value, default):
+    if value is None or value == '':
+        return default
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y')
+    return bool(value)
+
+
+def _organizations(rows, *columns):
+    """
+    Returns a dict of organization primary keys by lowercased code, for the
+    codes in the given columns of the rows.
+    """
+
+    keys = set()
+    for line, row in rows:
+        for column in columns:
+            if row.get(column):
+                keys.add(row[column].lower())
+
+    orgs = dict(Organization.objects.filter(code_key__in=keys)
+                                    .values_list('code_key', 'pk'))
+
+    for line, row in rows:
+        for column in columns:
+            if row.get(column) and row[column].lower() not in orgs:
+                raise CommandError("Line %d: unknown organization %r."
+                                   % (line, row[column]))
+
+    return orgs
+
+
+def import_organizations(rows, options):
+    """
+    Columns: code, name, parent (a code, empty for none). Parents have to be
+    imported before, or along with, their children. Organizations are only
+    moved if the parent column is given.
+    """
+
+    codes = {}
+    for line, row in rows:
+        codes[row['code'].lower()] = (row['code'], row['name'])
+
+    existing = dict((key, (pk, code, name)) for pk, key, code, name in
+                    Organization.objects.filter(code_key__in=codes.keys())
+                                        .values_list('pk', 'code_key',
+                                                     'code', 'name'))
+
+    new = []
+    changed = []
+    for key, (code, name) in codes.items():
+        if key not in existing:
+            new.append((code, name, key))
+        elif existing[key][1:] != (code, name):
+            changed.append((code, name, existing[key][0]))
+
+    insert_rows(Organization, ('code', 'name', 'code_key'), new)
+    _update(Organization, ('code', 'name'), changed)
+
+    moved = _move_organizations([(line, row) for line, row in rows
+                                 if 'parent' in row])
+
+    new_ids = Organization.objects.filter(
+        code_key__in=[key for code, name, key in new]) \
+        .values_list('pk', flat=True)
+    OrganizationClosure.objects.rebuild(list(new_ids) + moved)
+
+    if changed or moved:
+        # cached users include their primary organization
+        invalidate_user_snapshot()
+    if moved:
+        bump_permission_version()
+
+    return len(new), len(set([pk for code, name, pk in changed] + moved))
+
+
+def _move_organizations(rows):
+    """
+    Sets the parents of the organizations in the given rows. Returns the
+    primary keys of the organizations that moved, and of everything below
+    them.
+    """
+
+    if not rows:
+        return []
+
+    orgs = _organizations(rows, 'code', 'parent')
+    parents = dict(Organization.objects.filter(pk__in=orgs.values())
+                                       .values_list('pk', 'parent'))
+
+    moves = {}
+    for line, row in rows:
+        pk = orgs[row['code'].lower()]
+        parent = row['parent'] and orgs[row['parent'].lower()] or None
+        if parents[pk] != parent:
+            moves[pk] = parent
+
+    if not moves:
+        return []
+
+    # the organizations above each new parent in the current tree, nearest
+    # first, which the closure still has. Organizations created by this
+    # batch don't have rows yet, nor a parent.
+    ancestors = {}
+    for descendant, ancestor in OrganizationClosure.objects.filter(
+            descendant__in=set(moves.values()) - set([None])) \
+            .order_by('depth').values_list('descendant', 'ancestor'):
+        ancestors.setdefault(descendant, []).append(ancestor)
+
+    for line, row in rows:
+        pk = orgs[row['code'].lower()]
+        if pk not in moves:
+            continue
+
+        # go up from the new parent, jumping to the new parent of every
+        # organization that moves on the way
+        parent = moves[pk]
+        seen = set()
+        while parent is not None and parent not in seen:
+            seen.add(parent)
+            for ancestor in ancestors.get(parent, [parent]):
+                if ancestor == pk:
+                    raise CommandError("Line %d: organization %r can't be "
+                                       "placed under %r." % (
+                                           line, row['code'], row['parent']))
+                if ancestor in moves:
+                    parent = moves[ancestor]
+                    break
+            else:
+                parent = None
+
+    # the closure still has the old tree, with the same organizations below
+    # the ones that move
+    descendants = OrganizationClosure.objects.filter(
+        ancestor__in=list(moves)).values_list('descendant', flat=True)
+    moved = set(descendants)
+    moved.update(moves)
+
+    _update(Organization, ('parent',),
+            [(new_parent, org_id) for org_id, new_parent in moves.items()])
+
+    return list(moved)
+
+
+def import_roles(rows, options):
+    """
+    Columns: organization (a code, or empty for a super role), name,
+    permissions (`app_label.codename` strings), applies_to_descendants.
+    """
+
+    orgs = _organizations(rows, 'organization')
+
+    names = set()
+    roles = {}
+    for line, row in rows:
+        perms = _split(row.get('permissions'))
+        names.update(perms)
+
+        org = row.get('organization')
+        org = org and orgs[org.lower()] or None
+        roles[(org, row['name'])] = (line, perms,
+                                     _flag(row.get('applies_to_descendants'),
+                                           False))
+
+    perm_ids = permission_index.ids_for_names(names)
+    for line, row in rows:
+        for name in _split(row.get('permissions')):
+            if name not in perm_ids:
+                raise CommandError("Line %d: unknown permission %r."
+                                   % (line, name))
+
+    # pk -> applies_to_descendants, for existing roles
+    applies = {}
+
+    def get_roles():
+        found = {}
+        role_orgs = set([org for org, name in roles if org is not None])
+        role_names = set([name for org, name in roles if org is not None])
+        for pk, org, name, flag in Role.objects.filter(
+                organization__in=role_orgs, name__in=role_names) \
+                .values_list('pk', 'organization', 'name',
+                             'applies_to_descendants'):
+            found[(org, name)] = pk
+            applies[pk] = flag
+
+        role_names = set([name for org, name in roles if org is None])
+        for pk, name in SuperRole.objects.filter(name__in=role_names) \
+                                         .values_list('pk', 'name'):
+            found[(None, name)] = pk
+
+        return dict((key, pk) for key, pk in found.items() if key in roles)
+
+    existing = get_roles()
+    new = [key for key in roles if key not in existing]
+
+    insert_rows(Role, ('organization', 'name', 'applies_to_descendants'),
+                [(org_id, name, roles[org_id, name][2])
+                 for org_id, name in new if org_id is not None])
+    insert_rows(SuperRole, ('name',),
+                [(name,) for org_id, name in new if org_id is None])
+
+    flagged = [key for key, pk in existing.items()
+               if key[0] is not None and applies[pk] != roles[key][2]]
+    _update(Role, ('applies_to_descendants',),
+            [(roles[key][2], existing[key]) for key in flagged])
+
+    if new:
+        existing = get_roles()
+        RoleClosure.objects.rebuild([existing[key] for key in new
+                                     if key[0] is not None])
+
+    # replace the permissions that changed
+    changed = set(flagged)
+    for model, is_super in ((Role, False), (SuperRole, True)):
+        field = model._meta.get_field('permissions')
+        through = field.rel.through
+        column = field.m2m_field_name()
+
+        pks = dict((pk, key) for key, pk in existing.items()
+                   if (key[0] is None) == is_super)
+        current = dict((pk, set()) for pk in pks)
+        for pk, perm in through.objects.filter(
+                **{'%s__in' % column: list(pks)}) \
+                .values_list(column, field.m2m_reverse_field_name()):
+            current[pk].add(perm)
+
+        stale = []
+        links = []
+        for pk, key in pks.items():
+            perms = set([perm_ids[name] for name in roles[key][1]])
+            if perms != current[pk]:
+                stale.append(pk)
+                links.extend([(pk, perm) for perm in perms])
+
+        through.objects.filter(**{'%s__in' % column: stale}).delete()
+        insert_rows(through, (column, field.m2m_reverse_field_name()), links)
+
+        changed.update([pks[pk] for pk in stale if pks[pk] not in new])
+
+    if changed:
+        bump_permission_version()
+
+    return len(new), len(changed)
+
+
+def import_users(rows, options):
+    """
+    Columns: organization, username, email, password, first_name, last_name,
+    is_staff, is_active, is_superuser. Passwords are only set for new users.
+    """
+
+    orgs = _organizations(rows, 'organization')
+    normalize_email = OrganizationUser.objects.normalize_email
+
+    users = {}
+    for line, row in rows:
+        org = orgs[row['organization'].lower()]
+        users[(org, row['username'].lower())] = row
+
+    existing = {}
+    for values in OrganizationUser.objects.filter(
+            organization__in=set([org_id for org_id, key in users]),
+            username_key__in=set([key for org_id, key in users])) \
+            .values_list('organization', 'username_key', 'pk', 'username',
+                         'email', 'first_name', 'last_name', 'is_staff',
+                         'is_active', 'is_superuser'):
+        existing[values[:2]] = values[2:]
+
+    fields = ('username', 'email', 'first_name', 'last_name', 'is_staff',
+              'is_active', 'is_superuser')
+
+    new = []
+    changed = []
+    for key, row in users.items():
+        values = (row['username'], normalize_email(row['email']),
+                  row.get('first_name') or '', row.get('last_name') or '',
+                  _flag(row.get('is_staff'), False),
+                  _flag(row.get('is_active'), True),
+                  _flag(row.get('is_superuser'), False))
+
+        if key not in existing:
+            spec = dict(zip(fields, values))
+            spec.update(organization=key[0],
+                        password=row.get('password') or None)
+            new.append(spec)
+        elif tuple(existing[key][1:]) != values:
+            changed.append(values + (existing[key][0],))
+
+    if new:
+        OrganizationUser.objects.bulk_create_users(
+            new, batch_size=len(new), pool=options['pool'],
+            processes=options['processes'])
+
+    _update(User, fields, changed)
+
+    if changed:
+        invalidate_user_snapshot()
+
+    return len(new), len(changed)
+
+
+def import_memberships(rows, options):
+    """
+    Columns: organization and username of the user, and any of member_of (an
+    additional organization), role (the name of a role of member_of, or of
+    the primary organization) and super_role (the name of a super role).
+    """
+
+    orgs = _organizations(rows, 'organization', 'member_of')
+
+    users = {}
+    for values in OrganizationUser.objects.filter(
+            organization__in=set(orgs.values()),
+            username_key__in=set([row['username'].lower()
+                                  for line, row in rows])) \
+            .values_list('organization', 'username_key', 'pk'):
+        users[values[:2]] = values[2]
+
+    organizations = set()
+    roles = set()
+    super_roles = set()
+    for line, row in rows:
+        org = orgs[row['organization'].lower()]
+        user = users.get((org, row['username'].lower()))
+        if user is None:
+            raise CommandError("Line %d: unknown user %r."
+                               % (line, row['username']))
+
+        member_of = row.get('member_of')
+        if member_of:
+            member_of = orgs[member_of.lower()]
+            if member_of != org:
+                organizations.add((user, member_of))
+        else:
+            member_of = org
+
+        if row.get('role'):
+            roles.add((user, member_of, row['role'], line))
+        if row.get('super_role'):
+            super_roles.add((user, row['super_role'], line))
+
+    role_ids = dict(((org, name), pk) for pk, org, name in Role.objects.filter(
+        organization__in=set([org for user, org, name, line in roles]),
+        name__in=set([name for user, org, name, line in roles]))
+        .values_list('pk', 'organization', 'name'))
+    super_role_ids = dict((name, pk) for pk, name in SuperRole.objects.filter(
+        name__in=set([name for user, name, line in super_roles]))
+        .values_list('pk', 'name'))
+
+    links = {'organizations': organizations, 'roles': set(),
+             'super_roles': set()}
+
+    for user, org, name, line in roles:
+        if (org, name) not in role_ids:
+            raise CommandError("Line %d: unknown role %r." % (line, name))
+        links['roles'].add((user, role_ids[(org, name)]))
+
+    for user, name, line in super_roles:
+        if name not in super_role_ids:
+            raise CommandError("Line %d: unknown super role %r."
+                               % (line, name))
+        links['super_roles'].add((user, super_role_ids[name]))
+
+    user_ids = set(users.values())
+    changed = set()
+    created = 0
+
+    for name, pairs in links.items():
+        field = OrganizationUser._meta.get_field(name)
+        through = field.rel.through
+        columns = (field.m2m_field_name(), field.m2m_reverse_field_name())
+
+        pairs = pairs - set(through.objects.filter(
+            **{'%s__in' % columns[0]: user_ids}).values_list(*columns))
+
+        insert_rows(through, columns, list(pairs))
+        changed.update([user for user, pk in pairs])
+        created += len(pairs)
+
+    Membership.objects.rebuild(changed)
+    bump_permission_version(changed)
+
+    return created, 0
+
+
+KINDS = (
+    ('organizations', import_organizations),
+    ('roles', import_roles),
+    ('users', import_users),
+    ('memberships', import_memberships),
+)
+
+
+def read_rows(path, format=None):
+    """
+    Yields (line number, row dict) from a CSV or JSONL file, without reading
+    it all at once.
+    """
+
+    if format is None:
+        format = os.path.splitext(path)[1][1:].lower()
+        if format == 'json':
+            format = 'jsonl'
+
+    if format not in ('csv', 'jsonl'):
+        raise CommandError("Unknown format for %s, use --format." % path)
+
+    f = open(path, 'rb')
+    try:
+        if format == 'csv':
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, dict(
+                    (key, value.decode('utf-8')) for key, value in row.items()
+                    if key is not None and value is not None)
+        else:
+            for line, data in enumerate(f):
+                if data.strip():
+                    yield line + 1, json.loads(data.decode('utf-8'))
+    finally:
+        f.close()
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            help='The format of the files, csv or jsonl. Guessed from the '
+                 'file extension by default.'),
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=1000,
+            help='The number of rows to import in each transaction.'),
+        make_option('--processes', dest='processes', type='int',
+            default=None,
+            help='The number of processes hashing passwords. One per CPU '
+                 'by default.'),
+    )
+    args = 'kind file [file ...]'
+    help = ('Imports organizations, roles, users or memberships from CSV or '
+            'JSONL files. Safe to run again on the same files. Available '
+            'kinds: %s.' % ', '.join([name for name, load in KINDS]))
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        format = options.get('format')
+        batch_size = options.get('batch_size') or 1000
+        processes = options.get('processes')
+
+        if len(args) < 2:
+            raise CommandError("Give a kind and at least one file.")
+
+        kind, paths = args[0], args[1:]
+        load = dict(KINDS).get(kind)
+        if load is None:
+            raise CommandError("Unknown kind: %s" % kind)
+
+        pool = None
+        if kind == 'users' and processes != 1:
+            pool = multiprocessing.Pool(processes)
+
+        load_options = {'pool': pool, 'processes': processes}
+        start = time.time()
+        counts = [0, 0, 0]
+
+        def flush(batch):
+            created, updated = commit_on_success()(load)(batch, load_options)
+
+            counts[0] += len(batch)
+            counts[1] += created
+            counts[2] += updated
+
+            if verbosity >= 2:
+                self.stdout.write("%d rows, %d created, %d updated "
+                                  "(%.0f rows/s)\n"
+                                  % (counts[0], counts[1], counts[2],
+                                     counts[0] / max(time.time() - start,
+                                                     0.001)))
+
+        try:
+            for path in paths:
+                batch = []
+                for row in read_rows(path, format):
+                    batch.append(row)
+
+                    if len(batch) >= batch_size:
+                        flush(batch)
+                        batch = []
+
+                if batch:
+                    flush(batch)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if verbosity >= 1:
+            elapsed = time.time() - start
+            self.stdout.write("Imported %d %s rows in %.1fs (%.0f rows/s): "
+                              "%d created, %d updated.\n"
+                              % (counts[0], kind, elapsed,
+                                 counts[0] / max(elapsed, 0.001),
+                                 counts[1], counts[2]))
@@ -0,0 +1,88 @@
+"""
+Management utility to rebuild denormalized organization data.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from organizations.cache import commit_on_success
+from organizations.models import Membership, Organization, \
+        OrganizationClosure, OrganizationUser, RoleClosure
+
+
+def rebuild_memberships():
+    Membership.objects.rebuild()
+
+
+def rebuild_organization_closure():
+    OrganizationClosure.objects.rebuild()
+
+
+def rebuild_role_closure():
+    RoleClosure.objects.rebuild()
+
+
+def _update_keys(model, field, rows, batch_size=1000):
+    """
+    Sets the given key field from (value, pk) rows, lowercasing the values in
+    Python so they match what `save` stores.
+    """
+
+    qn = connection.ops.quote_name
+    sql = 'UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+        qn(model._meta.db_table), qn(model._meta.get_field(field).column),
+        qn(model._meta.pk.column))
+
+    cursor = connection.cursor()
+    batch = []
+
+    for value, pk in rows:
+        batch.append((value.lower(), pk))
+
+        if len(batch) >= batch_size:
+            cursor.executemany(sql, batch)
+            batch = []
+
+    if batch:
+        cursor.executemany(sql, batch)
+
+
+def rebuild_lookup_keys():
+    orgs = Organization.objects.values_list('code', 'pk').order_by()
+    _update_keys(Organization, 'code_key', orgs.iterator())
+
+    users = OrganizationUser.objects.values_list('username', 'pk').order_by()
+    _update_keys(OrganizationUser, 'username_key', users.iterator())
+
+
+INDEXES = (
+    ('memberships', rebuild_memberships),
+    ('lookup_keys', rebuild_lookup_keys),
+    ('organization_closure', rebuild_organization_closure),
+    ('role_closure', rebuild_role_closure),
+)
+
+
+class Command(BaseCommand):
+    args = '[index index ...]'
+    help = ('Rebuilds denormalized organization data from scratch, for '
+            'example after importing data without the ORM. Rebuilds '
+            'everything if no index is given. Available indexes: %s.'
+            % ', '.join([name for name, rebuild in INDEXES]))
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        indexes = dict(INDEXES)
+
+        for name in args:
+            if name not in indexes:
+                raise CommandError("Unknown index: %s" % name)
+
+        for name, rebuild in INDEXES:
+            if args and name not in args:
+                continue
+
+            commit_on_success()(rebuild)()
+
+            if verbosity >= 1:
+                self.stdout.write("Rebuilt %s.\n" % name)
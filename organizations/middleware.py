@@ -0,0 +1,78 @@
+"""
+Answers permission checks from the session.
+
+With `PermissionDigestMiddleware` installed, the permissions of a user are
+computed once at login, stored in the session as a digest of bitmasks (see
+`OrganizationBackend.get_permission_digest`), and used for every permission
+check of later requests, until the permissions of the user change. Add it
+after the authentication middleware:
+
+    MIDDLEWARE_CLASSES = (
+        # ...
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'organizations.middleware.PermissionDigestMiddleware',
+    )
+
+Digests are checked against the permission versions of `organizations.cache`,
+so its cache has to be shared by every process, or changes made in one process
+would go unnoticed by the others. The middleware refuses to start with a local
+memory or dummy cache, unless ORGANIZATIONS_DIGEST_LOCAL_CACHE is set, which
+is only safe with a single process, like the development server.
+"""
+
+from django.conf import settings
+from django.contrib.auth import get_backends
+from django.contrib.auth.signals import user_logged_in
+from django.core.exceptions import ImproperlyConfigured
+
+from .backends import OrganizationBackend
+from .cache import is_shared
+from .models import OrganizationUser
+
+
+SESSION_KEY = '_organizations_permissions'
+
+
+def _get_backend():
+    backends = [b for b in get_backends()
+                if isinstance(b, OrganizationBackend)]
+    return backends and backends[0] or OrganizationBackend()
+
+
+def _store_digest(sender, request, user, **kwargs):
+    if isinstance(user, OrganizationUser) and not user.is_superuser:
+        request.session[SESSION_KEY] = _get_backend().get_permission_digest(
+            user)
+
+user_logged_in.connect(_store_digest)
+
+
+class PermissionDigestMiddleware(object):
+
+    allow_local_cache = getattr(settings, 'ORGANIZATIONS_DIGEST_LOCAL_CACHE',
+                                False)
+
+    def __init__(self):
+        if not self.allow_local_cache and not is_shared():
+            raise ImproperlyConfigured(
+                "PermissionDigestMiddleware needs a cache shared by every "
+                "process, set ORGANIZATIONS_CACHE to one.")
+
+    def process_request(self, request):
+        user = request.user
+
+        # superusers don't need their permissions looked up
+        if not isinstance(user, OrganizationUser) or user.is_superuser:
+            return None
+
+        backend = _get_backend()
+        digest = request.session.get(SESSION_KEY)
+
+        if digest is None or not backend.load_permission_digest(user, digest):
+            # permissions changed, or the session predates the middleware
+            digest = backend.get_permission_digest(user)
+            request.session[SESSION_KEY] = digest
+            backend.load_permission_digest(user, digest, check_version=False)
+
+        return None
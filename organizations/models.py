@@ -1,14 +1,98 @@
 import datetime
+import multiprocessing
 
 from django.contrib.auth.models import User, Permission
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import connections, models, transaction
+from django.db.models.query import QuerySet
+from django.db.models.signals import m2m_changed, pre_save, post_save, \
+        pre_delete, post_delete
 from django.utils.translation import ugettext_lazy as _
 
+from .cache import bump_permission_version, commit_on_success, \
+        invalidate_user_snapshot, invalidate_user_snapshots
 
-__all__ = ('Organization', 'SuperRole', 'Role', 'OrganizationUser')
+
+__all__ = ('Organization', 'SuperRole', 'Role', 'OrganizationUser',
+           'Membership', 'OrganizationOwnedQuerySet',
+           'OrganizationOwnedManager', 'OrganizationUserQuerySet',
+           'RoleClosure', 'OrganizationClosure')
 
 _EMPTY = object()
 
+# the number of users to handle at once in bulk changes
+_CHUNK_SIZE = 500
+
+# the number of rows of a multi-row insert, which keeps the number of
+# parameters of a single statement reasonable
+_INSERT_BATCH_SIZE = 1000
+
+
+def _hash_password(raw_password):
+    # module level, so it can be sent to a worker process
+    user = User()
+    user.set_password(raw_password)
+    return user.password
+
+
+def _can_return_ids(connection):
+    """
+    Returns whether the database can return the keys of the rows of a
+    multi-row insert. Only PostgreSQL can, among the backends of this version
+    of Django, which doesn't tell it apart from returning a single key.
+    """
+
+    return getattr(connection.features, 'can_return_ids_from_bulk_insert',
+                   connection.vendor == 'postgresql' and
+                   connection.features.can_return_id_from_insert)
+
+
+def insert_rows(model, fields, rows, using=None, return_ids=False):
+    """
+    Inserts rows of values for the fields of a model, given by name, without
+    sending any signals. Values are prepared for the database like the ORM
+    does. If `return_ids` is set, returns the primary keys of the new rows,
+    which are inserted `_INSERT_BATCH_SIZE` at a time with a multi-row
+    INSERT ... RETURNING where the database supports it, and one at a time
+    otherwise.
+    """
+
+    connection = connections[using or 'default']
+    qn = connection.ops.quote_name
+    opts = model._meta
+    fields = [opts.get_field(name) for name in fields]
+
+    sql = 'INSERT INTO %s (%s) VALUES ' % (
+        qn(opts.db_table), ', '.join([qn(field.column) for field in fields]))
+    values = '(%s)' % ', '.join(['%s'] * len(fields))
+    params = [[field.get_db_prep_save(value, connection=connection)
+               for field, value in zip(fields, row)] for row in rows]
+
+    if not return_ids:
+        if params:
+            connection.cursor().executemany(sql + values, params)
+        return None
+
+    cursor = connection.cursor()
+    ids = []
+
+    if _can_return_ids(connection):
+        returning = ' RETURNING %s' % qn(opts.pk.column)
+
+        for i in range(0, len(params), _INSERT_BATCH_SIZE):
+            batch = params[i:i + _INSERT_BATCH_SIZE]
+            cursor.execute(sql + ', '.join([values] * len(batch)) + returning,
+                           [value for row in batch for value in row])
+            # rows come back in the order of the VALUES list
+            ids.extend([row[0] for row in cursor.fetchall()])
+        return ids
+
+    for row in params:
+        cursor.execute(sql + values, row)
+        ids.append(connection.ops.last_insert_id(cursor, opts.db_table,
+                                                 opts.pk.column))
+    return ids
+
 
 class Organization(models.Model):
     """
@@ -18,8 +102,36 @@ class Organization(models.Model):
     code = models.CharField(max_length=80, unique=True)
     name = models.CharField(max_length=80)
 
+    # organizations can be grouped under a parent organization, for example
+    # the subsidiaries of a holding company
+    parent = models.ForeignKey('self', null=True, blank=True,
+                               related_name='children',
+                               on_delete=models.SET_NULL)
+
+    # the lowercased code, for case-insensitive lookups that can use an index
+    code_key = models.CharField(max_length=80, unique=True, editable=False)
+
     def all_members(self):
-        return self.primary_members.all() | self.members.all()
+        return OrganizationUser.objects.filter(memberships__organization=self)
+
+    def get_descendants(self, include_self=False):
+        """
+        Returns the organizations below this one, at any depth.
+        """
+
+        orgs = Organization.objects.filter(ancestor_links__ancestor=self)
+        if not include_self:
+            orgs = orgs.exclude(pk=self.pk)
+        return orgs
+
+    def clean(self):
+        if _is_own_ancestor(self):
+            raise ValidationError("An organization can't be placed under "
+                                  "itself or one of its descendants.")
+
+    def save(self, *args, **kwargs):
+        self.code_key = self.code.lower()
+        super(Organization, self).save(*args, **kwargs)
 
     def __unicode__(self):
         return self.name
@@ -28,6 +140,166 @@ class Organization(models.Model):
         ordering = ['code']
 
 
+def _is_own_ancestor(organization):
+    if organization.parent_id is None or organization.pk is None:
+        return False
+
+    return organization.parent_id == organization.pk or \
+        OrganizationClosure.objects.filter(
+            ancestor=organization.pk,
+            descendant=organization.parent_id).exists()
+
+
+class OrganizationClosureManager(models.Manager):
+
+    def add(self, organization):
+        """
+        Adds the rows of a new organization, which has nothing below it yet:
+        its row with itself, and a row one level further from each ancestor
+        of its parent.
+        """
+
+        db = self._db or 'default'
+
+        rows = [(organization.pk, organization.pk, 0)]
+        if organization.parent_id is not None:
+            ancestors = self.using(db).filter(
+                descendant=organization.parent_id)
+            rows.extend([(ancestor, organization.pk, depth + 1)
+                         for ancestor, depth
+                         in ancestors.values_list('ancestor', 'depth')])
+
+        insert_rows(self.model, ('ancestor', 'descendant', 'depth'), rows,
+                    using=db)
+
+        transaction.commit_unless_managed(using=db)
+
+    def rebuild(self, organization_ids=None):
+        """
+        Recomputes the rows of the given organizations as descendants, or of
+        every organization if `organization_ids` is None. Only the parents of
+        the given organizations are loaded; the rows of the organizations
+        they hang from are taken as they are, so those have to be up to date.
+        """
+
+        db = self._db or 'default'
+        orgs = Organization.objects.using(db)
+
+        # the rows of the organizations above the given ones, by descendant
+        ancestors = {}
+
+        everything = organization_ids is None
+        if everything:
+            parents = dict(orgs.values_list('pk', 'parent'))
+            organization_ids = list(parents)
+        else:
+            organization_ids = list(set(organization_ids))
+
+            parents = {}
+            for i in range(0, len(organization_ids), 500):
+                parents.update(orgs.filter(pk__in=organization_ids[i:i + 500])
+                                   .values_list('pk', 'parent'))
+            organization_ids = [pk for pk in organization_ids
+                                if pk in parents]
+
+            above = list(set(parents.values()) - set(parents) - set([None]))
+            for i in range(0, len(above), 500):
+                for descendant, ancestor, depth in self.using(db).filter(
+                        descendant__in=above[i:i + 500]).values_list(
+                        'descendant', 'ancestor', 'depth'):
+                    ancestors.setdefault(descendant, []).append(
+                        (ancestor, depth))
+
+        rows = []
+        for descendant in organization_ids:
+            ancestor = descendant
+            depth = 0
+            # stop at cycles, which can only come from changes made without
+            # the ORM
+            while ancestor is not None and depth <= len(parents):
+                if ancestor not in parents:
+                    rows.extend([(pk, descendant, depth + distance)
+                                 for pk, distance
+                                 in ancestors.get(ancestor, ())])
+                    break
+                rows.append((ancestor, descendant, depth))
+                ancestor = parents[ancestor]
+                depth += 1
+
+        if everything:
+            self.using(db).all().delete()
+        else:
+            for i in range(0, len(organization_ids), 500):
+                self.using(db).filter(
+                    descendant__in=organization_ids[i:i + 500]).delete()
+
+        insert_rows(self.model, ('ancestor', 'descendant', 'depth'), rows,
+                    using=db)
+
+        transaction.commit_unless_managed(using=db)
+
+
+class OrganizationClosure(models.Model):
+    """
+    The transitive closure of `Organization.parent`: a row for every
+    organization above an organization, with their distance, and a row for
+    every organization with itself at depth 0. Roles that apply to the
+    descendants of their organization are found with a single join, however
+    deep the organization is. This is kept up to date automatically; use the
+    `rebuild_organization_indexes` command to fill it for existing
+    organizations.
+    """
+
+    ancestor = models.ForeignKey(Organization, related_name='descendant_links')
+    descendant = models.ForeignKey(Organization, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+
+    objects = OrganizationClosureManager()
+
+    class Meta:
+        unique_together = [('ancestor', 'descendant')]
+
+
+class OrganizationOwnedQuerySet(QuerySet):
+    """
+    A queryset for models that are owned by an organization, through an
+    `organization` foreign key (or the foreign key named by the model's
+    _ORGANIZATION_ATTRIBUTE attribute), like the authentication backend
+    expects.
+    """
+
+    def permitted_for(self, user, perm):
+        """
+        Limits the queryset to the objects the user has the given permission
+        on, without checking every object separately.
+        """
+
+        from django.contrib.auth import get_backends
+        from .backends import OrganizationBackend
+
+        backends = [b for b in get_backends()
+                    if isinstance(b, OrganizationBackend)]
+        backend = backends and backends[0] or OrganizationBackend()
+
+        orgs = backend.get_permitted_organizations(user, perm)
+
+        if orgs is None:
+            return self._clone()
+
+        attname = getattr(self.model, '_ORGANIZATION_ATTRIBUTE',
+                          'organization')
+        return self.filter(**{'%s__in' % attname: orgs})
+
+
+class OrganizationOwnedManager(models.Manager):
+
+    def get_query_set(self):
+        return OrganizationOwnedQuerySet(self.model, using=self._db)
+
+    def permitted_for(self, user, perm):
+        return self.get_query_set().permitted_for(user, perm)
+
+
 class SuperRole(models.Model):
 
     name = models.CharField(_('name'), max_length=80, unique=True)
@@ -43,6 +315,15 @@ class Role(models.Model):
     organization = models.ForeignKey(Organization)
     permissions = models.ManyToManyField(Permission, blank=True)
 
+    # whether the role also grants its permissions in every organization
+    # below its own
+    applies_to_descendants = models.BooleanField(default=False)
+
+    # other roles of the same organization whose permissions this role
+    # includes, directly or through the roles they include in turn
+    includes = models.ManyToManyField('self', symmetrical=False, blank=True,
+                                      related_name='included_by')
+
     def __unicode__(self):
         return '{0} {1}'.format(self.organization, self.name)
 
@@ -50,13 +331,195 @@ class Role(models.Model):
         unique_together = [('name', 'organization')]
 
 
+class RoleClosureManager(models.Manager):
+
+    def rebuild(self, role_ids=None):
+        """
+        Recomputes the rows of the given roles as ancestors, or of every role
+        if `role_ids` is None, from the `Role.includes` edges of their
+        organizations.
+        """
+
+        db = self._db or 'default'
+
+        roles = Role.objects.using(db)
+        if role_ids is not None:
+            role_ids = set(role_ids)
+            roles = roles.filter(pk__in=role_ids)
+
+        ancestors = list(roles.values_list('pk', 'organization'))
+        if not ancestors:
+            return
+
+        # roles only include roles of their own organization
+        field = Role._meta.get_field('includes')
+        edges = {}
+        for from_role, to_role in field.rel.through.objects.using(db).filter(
+                **{'%s__organization__in' % field.m2m_field_name():
+                   set([org for pk, org in ancestors])}).values_list(
+                field.m2m_field_name(), field.m2m_reverse_field_name()):
+            edges.setdefault(from_role, []).append(to_role)
+
+        rows = []
+        for ancestor, org in ancestors:
+            # breadth first, so every role gets its shortest depth
+            depths = {ancestor: 0}
+            level = [ancestor]
+            while level:
+                next_level = []
+                for role in level:
+                    for included in edges.get(role, ()):
+                        if included not in depths:
+                            depths[included] = depths[role] + 1
+                            next_level.append(included)
+                level = next_level
+
+            rows.extend([(ancestor, descendant, depth)
+                         for descendant, depth in depths.items()])
+
+        if role_ids is None:
+            self.using(db).all().delete()
+        else:
+            role_ids = list(role_ids)
+            for i in range(0, len(role_ids), 500):
+                self.using(db).filter(
+                    ancestor__in=role_ids[i:i + 500]).delete()
+
+        insert_rows(self.model, ('ancestor', 'descendant', 'depth'), rows,
+                    using=db)
+
+        transaction.commit_unless_managed(using=db)
+
+
+class RoleClosure(models.Model):
+    """
+    The transitive closure of `Role.includes`: a row for every role a role
+    includes, directly or not, with the depth of the shortest path between
+    them, and a row for every role with itself at depth 0. The permissions of
+    a role are those of all of its descendants, found with a single join.
+    This is kept up to date automatically; use the
+    `rebuild_organization_indexes` command to fill it for existing roles.
+    """
+
+    ancestor = models.ForeignKey(Role, related_name='descendant_links')
+    descendant = models.ForeignKey(Role, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+
+    objects = RoleClosureManager()
+
+    class Meta:
+        unique_together = [('ancestor', 'descendant')]
+
+
+class OrganizationUserQuerySet(QuerySet):
+    """
+    A queryset of users that can load the super roles, organizations and
+    roles of the users along with them.
+    """
+
+    # the number of users to load the roles of at once, if enabled
+    _role_matrix = None
+
+    def with_role_matrix(self, chunk_size=500):
+        """
+        Loads the super roles, organizations and roles of the users, with
+        three queries per `chunk_size` users, no matter how many
+        organizations they are members of. Every user gets:
+
+        * `super_role_list`, the list of his/her super roles, by name
+        * `role_matrix`, a list of (organization, list of roles) for each of
+          his/her organizations, by code, with the roles by name
+
+        Users are still fetched one chunk at a time, so a large queryset can
+        be streamed with `iterator()` without holding every user in memory.
+        Their primary organization is selected along with them, since it's
+        part of how users are displayed.
+        """
+
+        return self._clone(_role_matrix=chunk_size) \
+                   .select_related('organization')
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        if klass is None or issubclass(klass, OrganizationUserQuerySet):
+            kwargs.setdefault('_role_matrix', self._role_matrix)
+        return super(OrganizationUserQuerySet, self)._clone(klass, setup,
+                                                            **kwargs)
+
+    def iterator(self):
+        users = super(OrganizationUserQuerySet, self).iterator()
+
+        if not self._role_matrix:
+            for user in users:
+                yield user
+            return
+
+        chunk = []
+        for user in users:
+            chunk.append(user)
+
+            if len(chunk) >= self._role_matrix:
+                for user in self._load_role_matrix(chunk):
+                    yield user
+                chunk = []
+
+        for user in self._load_role_matrix(chunk):
+            yield user
+
+    def _load_role_matrix(self, users):
+        if not users:
+            return users
+
+        by_id = dict((user.pk, user) for user in users)
+        organizations = dict((user.pk, []) for user in users)
+        super_roles = dict((user.pk, []) for user in users)
+        roles = {}
+
+        memberships = Membership.objects.filter(user__in=list(by_id)) \
+                                        .select_related('organization') \
+                                        .order_by('organization__code')
+        for membership in memberships:
+            organizations[membership.user_id].append(membership.organization)
+
+        through = OrganizationUser.super_roles.through.objects.filter(
+            organizationuser__in=list(by_id)).select_related('superrole') \
+            .order_by('superrole__name')
+        for row in through:
+            super_roles[row.organizationuser_id].append(row.superrole)
+
+        through = OrganizationUser.roles.through.objects.filter(
+            organizationuser__in=list(by_id)).select_related('role') \
+            .order_by('role__name')
+        for row in through:
+            key = (row.organizationuser_id, row.role.organization_id)
+            roles.setdefault(key, []).append(row.role)
+
+        for user in users:
+            orgs = organizations[user.pk]
+            user._organization_ids = frozenset([org.pk for org in orgs])
+            user.super_role_list = super_roles[user.pk]
+
+            # roles of organizations the user isn't a member of don't count
+            user.role_matrix = [(org, roles.get((user.pk, org.pk), []))
+                                for org in orgs]
+
+        return users
+
+
 class OrganizationUserManager(models.Manager):
 
-    def create_user(self, organization, username, email, password=None):
-        now = datetime.datetime.now()
+    def get_query_set(self):
+        return OrganizationUserQuerySet(self.model, using=self._db)
+
+    def with_role_matrix(self, chunk_size=500):
+        return self.get_query_set().with_role_matrix(chunk_size)
+
+    @classmethod
+    def normalize_email(cls, email):
+        """
+        Normalizes the address by lowercasing the domain part of the email
+        address.
+        """
 
-        # Normalize the address by lowercasing the domain part of the email
-        # address.
         try:
             email_name, domain_part = email.strip().split('@', 1)
         except ValueError:
@@ -64,6 +527,12 @@ class OrganizationUserManager(models.Manager):
         else:
             email = '@'.join([email_name, domain_part.lower()])
 
+        return email
+
+    def create_user(self, organization, username, email, password=None):
+        now = datetime.datetime.now()
+        email = self.normalize_email(email)
+
         user = self.model(organization=organization, username=username,
                           email=email, is_staff=False, is_active=True,
                           is_superuser=False, last_login=now,
@@ -81,6 +550,238 @@ class OrganizationUserManager(models.Manager):
         u.save(using=self._db)
         return u
 
+    def bulk_create_users(self, users, processes=None, batch_size=500,
+                          pool=None):
+        """
+        Creates many users at once, from an iterable of dicts with the
+        arguments of `create_user`, optionally along with `first_name`,
+        `last_name`, `is_staff`, `is_active` and `is_superuser`, and lists of
+        additional `organizations`, `roles` and `super_roles` (objects or
+        primary keys).
+
+        Passwords are hashed in a pool of `processes` worker processes (one
+        per CPU by default, none if 1), or in an existing `pool`, and rows are
+        inserted `batch_size` users at a time, each batch in its own
+        transaction, unless a managed transaction is in progress, which every
+        batch is then a part of. No signals are sent. Returns the list of
+        created users.
+        """
+
+        own_pool = pool is None and processes != 1
+        if own_pool:
+            pool = multiprocessing.Pool(processes)
+
+        created = []
+        batch = []
+
+        try:
+            for spec in users:
+                batch.append(spec)
+
+                if len(batch) >= batch_size:
+                    created.extend(self._bulk_create_users(batch, pool))
+                    batch = []
+
+            if batch:
+                created.extend(self._bulk_create_users(batch, pool))
+        finally:
+            if own_pool:
+                pool.close()
+                pool.join()
+
+        return created
+
+    def _bulk_create_users(self, specs, pool):
+        db = self._db or 'default'
+        now = datetime.datetime.now()
+
+        passwords = [spec.get('password') for spec in specs]
+        if pool is not None:
+            passwords = pool.map(_hash_password, passwords)
+        else:
+            passwords = [_hash_password(password) for password in passwords]
+
+        users = []
+        for spec, password in zip(specs, passwords):
+            user = self.model(
+                organization_id=getattr(spec['organization'], 'pk',
+                                        spec['organization']),
+                username=spec['username'],
+                email=self.normalize_email(spec['email']),
+                password=password,
+                first_name=spec.get('first_name', ''),
+                last_name=spec.get('last_name', ''),
+                is_staff=spec.get('is_staff', False),
+                is_active=spec.get('is_active', True),
+                is_superuser=spec.get('is_superuser', False),
+                last_login=now, date_joined=now)
+            user.username_key = user.username.lower()
+            users.append(user)
+
+        def insert(model, fields, objs, **kwargs):
+            return insert_rows(model, [field.name for field in fields],
+                               [[field.pre_save(obj, True) for field in fields]
+                                for obj in objs], using=db, **kwargs)
+
+        def insert_related(name):
+            field = self.model._meta.get_field(name)
+            rows = []
+            for user, spec in zip(users, specs):
+                for obj in spec.get(name, ()):
+                    rows.append((user.pk, getattr(obj, 'pk', obj)))
+            insert_rows(field.rel.through, (field.m2m_field_name(),
+                                            field.m2m_reverse_field_name()),
+                        rows, using=db)
+
+        parent_fields = [f for f in User._meta.local_fields
+                         if not f.primary_key]
+        child_fields = self.model._meta.local_fields
+
+        def save():
+            ids = insert(User, parent_fields, users, return_ids=True)
+            for user, pk in zip(users, ids):
+                user.id = user.user_id = pk
+
+            insert(self.model, child_fields, users)
+
+            for name in ('organizations', 'roles', 'super_roles'):
+                insert_related(name)
+
+            Membership.objects.db_manager(db).rebuild(
+                [user.pk for user in users])
+
+        if transaction.is_managed(using=db):
+            # a part of the transaction of the caller, like an import batch,
+            # which a block of its own would commit early
+            save()
+        else:
+            commit_on_success(using=db)(save)()
+
+        return users
+
+    # Bulk changes to the organizations and roles of many users, through the
+    # through tables. No signals are sent, the memberships and caches are
+    # updated once for all of the users. `user_ids` can also be a queryset.
+
+    def grant_role(self, user_ids, role):
+        """
+        Gives a role to the given users that are members of its organization.
+        Returns the number of users that got the role.
+        """
+
+        members = Membership.objects.filter(organization=role.organization_id)
+        user_ids = self._filter(members, 'user', self._user_ids(user_ids))
+
+        return self._link('roles', user_ids, role.pk)
+
+    def revoke_role(self, user_ids, role):
+        return self._unlink('roles', self._user_ids(user_ids), role.pk)
+
+    def grant_super_role(self, user_ids, super_role):
+        return self._link('super_roles', self._user_ids(user_ids),
+                          super_role.pk)
+
+    def revoke_super_role(self, user_ids, super_role):
+        return self._unlink('super_roles', self._user_ids(user_ids),
+                            super_role.pk)
+
+    def add_organization(self, user_ids, organization):
+        """
+        Adds an additional organization to the given users, unless it's
+        already their primary organization.
+        """
+
+        users = self.exclude(organization=organization)
+        user_ids = self._filter(users, 'pk', self._user_ids(user_ids))
+
+        return self._link('organizations', user_ids, organization.pk)
+
+    def move_organization(self, user_ids, organization):
+        """
+        Makes the given organization the primary organization of the given
+        users, in place of their current one.
+        """
+
+        user_ids = self._user_ids(user_ids)
+
+        for chunk in self._chunks(user_ids):
+            self.filter(pk__in=chunk).update(organization=organization)
+
+        # it isn't an additional organization anymore
+        self._unlink('organizations', user_ids, organization.pk)
+        self._changed(user_ids)
+
+        return len(user_ids)
+
+    def _user_ids(self, user_ids):
+        if isinstance(user_ids, QuerySet):
+            user_ids = user_ids.values_list('pk', flat=True).order_by()
+        return list(user_ids)
+
+    def _chunks(self, user_ids):
+        for i in range(0, len(user_ids), _CHUNK_SIZE):
+            yield user_ids[i:i + _CHUNK_SIZE]
+
+    def _filter(self, queryset, column, user_ids):
+        """
+        Returns the given user ids that are in `column` of the queryset.
+        """
+
+        found = []
+        for chunk in self._chunks(user_ids):
+            found.extend(queryset.filter(**{'%s__in' % column: chunk})
+                                 .values_list(column, flat=True))
+        return found
+
+    def _link(self, name, user_ids, pk):
+        field = self.model._meta.get_field(name)
+        through = field.rel.through
+        user_column = field.m2m_field_name()
+        related_column = field.m2m_reverse_field_name()
+
+        links = through.objects.filter(**{related_column: pk})
+        new = set(user_ids) - set(self._filter(links, user_column, user_ids))
+
+        if new:
+            db = self._db or 'default'
+            insert_rows(through, (user_column, related_column),
+                        [(user_id, pk) for user_id in new], using=db)
+            transaction.commit_unless_managed(using=db)
+
+        self._changed(new, memberships=name == 'organizations')
+        return len(new)
+
+    def _unlink(self, name, user_ids, pk):
+        field = self.model._meta.get_field(name)
+        through = field.rel.through
+        user_column = field.m2m_field_name()
+        related_column = field.m2m_reverse_field_name()
+
+        links = through.objects.filter(**{related_column: pk})
+        removed = self._filter(links, user_column, user_ids)
+
+        for chunk in self._chunks(removed):
+            links.filter(**{'%s__in' % user_column: chunk}).delete()
+
+        self._changed(removed, memberships=name == 'organizations')
+        return len(removed)
+
+    def _changed(self, user_ids, memberships=True):
+        """
+        Updates the memberships and invalidates the caches of the given
+        users, after a bulk change.
+        """
+
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+
+        if memberships:
+            Membership.objects.db_manager(self._db).rebuild(user_ids)
+            invalidate_user_snapshots(user_ids)
+
+        bump_permission_version(user_ids)
+
     def make_random_password(self, length=10, allowed_chars=_EMPTY):
         """
         Generates a random password with the given length and given allowed_chars
@@ -109,12 +810,63 @@ class OrganizationUser(User):
     super_roles = models.ManyToManyField(SuperRole, blank=True)
     roles = models.ManyToManyField(Role, blank=True)
 
+    # the lowercased username, for case-insensitive lookups that can use an
+    # index. Usernames are unique within an organization, regardless of case.
+    username_key = models.CharField(max_length=80, editable=False)
+
     objects = OrganizationUserManager()
 
-    def get_all_organizations(self):
-        primary_org = Organization.objects.filter(primary_members=self)
-        orgs = self.organizations.all() | primary_org
-        return orgs
+    class Meta:
+        unique_together = [('organization', 'username_key')]
+
+    def save(self, *args, **kwargs):
+        self.username_key = self.username.lower()
+        super(OrganizationUser, self).save(*args, **kwargs)
+
+    def get_all_organizations(self, include_descendants=False):
+        """
+        Returns the organizations this user is a member of, along with every
+        organization below them if `include_descendants` is set.
+        """
+
+        # filter on the primary key, looking up a user object would fetch its
+        # parent User row first
+        if include_descendants:
+            return Organization.objects.filter(
+                ancestor_links__ancestor__memberships__user=self.pk).distinct()
+
+        return Organization.objects.filter(memberships__user=self.pk)
+
+    @property
+    def organization_ids(self):
+        """
+        A frozenset of the primary keys of all of the organizations this user
+        is a member of, computed once per user object.
+        """
+
+        if not hasattr(self, '_organization_ids'):
+            ids = Membership.objects.filter(user=self.pk) \
+                                    .values_list('organization', flat=True)
+            self._organization_ids = frozenset(ids)
+
+        return self._organization_ids
+
+    def is_member_of(self, organization):
+        """
+        Returns whether this user is a member of the given organization, which
+        can also be given as a primary key.
+        """
+
+        organization_id = getattr(organization, 'pk', organization)
+
+        if organization_id == self.organization_id:
+            return True
+
+        if hasattr(self, '_organization_ids'):
+            return organization_id in self._organization_ids
+
+        return Membership.objects.filter(
+            user=self.pk, organization=organization_id).exists()
 
     @property
     def full_name(self):
@@ -131,3 +883,334 @@ class OrganizationUser(User):
             return fmt.format(self.full_name, self.organization)
         else:
             return fmt.format(self.username, self.organization)
+
+
+class MembershipManager(models.Manager):
+
+    def rebuild(self, user_ids=None):
+        """
+        Recreates the memberships of the given users, or of every user if
+        `user_ids` is None, from their primary and additional organizations.
+        """
+
+        if user_ids is None:
+            self._rebuild(None)
+            return
+
+        user_ids = list(user_ids)
+        for i in range(0, len(user_ids), 500):
+            self._rebuild(user_ids[i:i + 500])
+
+    def _rebuild(self, user_ids):
+        db = self._db or 'default'
+        qn = connections[db].ops.quote_name
+
+        users = OrganizationUser._meta
+        through = OrganizationUser.organizations.through._meta
+
+        tables = {
+            'membership': qn(self.model._meta.db_table),
+            'user': qn(users.db_table),
+            'user_pk': qn(users.pk.column),
+            'user_org': qn(users.get_field('organization').column),
+            'through': qn(through.db_table),
+            'through_user': qn(through.get_field('organizationuser').column),
+            'through_org': qn(through.get_field('organization').column),
+        }
+
+        if user_ids is None:
+            self.using(db).all().delete()
+            where = ''
+            params = []
+        else:
+            self.using(db).filter(user__in=user_ids).delete()
+            where = 'AND u.%s IN (%s)' % (tables['user_pk'],
+                                          ', '.join(['%s'] * len(user_ids)))
+            params = list(user_ids)
+
+        cursor = connections[db].cursor()
+
+        # primary organizations
+        cursor.execute(
+            'INSERT INTO %(membership)s (user_id, organization_id, is_primary) '
+            'SELECT u.%(user_pk)s, u.%(user_org)s, %%s '
+            'FROM %(user)s u '
+            'WHERE 1 = 1 %(where)s' % dict(tables, where=where),
+            [True] + params)
+
+        # additional organizations, except for the primary one
+        cursor.execute(
+            'INSERT INTO %(membership)s (user_id, organization_id, is_primary) '
+            'SELECT u.%(user_pk)s, m.%(through_org)s, %%s '
+            'FROM %(through)s m '
+            'INNER JOIN %(user)s u ON u.%(user_pk)s = m.%(through_user)s '
+            'WHERE m.%(through_org)s <> u.%(user_org)s %(where)s'
+            % dict(tables, where=where),
+            [False] + params)
+
+        transaction.commit_unless_managed(using=db)
+
+
+class Membership(models.Model):
+    """
+    A membership of a user in one of his/her organizations, primary or
+    additional. This is a denormalized copy of `OrganizationUser.organization`
+    and `OrganizationUser.organizations`, kept up to date automatically, so
+    membership can be looked up with a single indexed join. Use the
+    `rebuild_organization_indexes` command to fill it for existing users.
+    """
+
+    user = models.ForeignKey(OrganizationUser, related_name='memberships')
+    organization = models.ForeignKey(Organization, related_name='memberships')
+    is_primary = models.BooleanField(default=False)
+
+    objects = MembershipManager()
+
+    class Meta:
+        unique_together = [('user', 'organization')]
+
+
+# Keep the memberships in sync with the organizations of each user.
+
+def _sync_primary_membership(sender, instance, created, **kwargs):
+    if not isinstance(instance, OrganizationUser):
+        return
+
+    instance.__dict__.pop('_organization_ids', None)
+
+    primary = Membership.objects.filter(user=instance.pk, is_primary=True,
+                                        organization=instance.organization_id)
+
+    if created or not primary.exists():
+        Membership.objects.rebuild([instance.pk])
+
+
+def _sync_memberships(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        memberships = Membership.objects.filter(organization=instance.pk)
+        if pk_set is not None:
+            memberships = memberships.filter(user__in=pk_set)
+    else:
+        instance.__dict__.pop('_organization_ids', None)
+        memberships = Membership.objects.filter(user=instance.pk)
+        if pk_set is not None:
+            memberships = memberships.filter(organization__in=pk_set)
+
+    if action in ('post_remove', 'post_clear'):
+        # the primary membership stays, even if the primary organization
+        # was also one of the additional organizations
+        memberships.filter(is_primary=False).delete()
+
+    elif action == 'post_add':
+        existing = set(memberships.values_list('user', 'organization'))
+
+        for pk in pk_set:
+            if reverse:
+                key = (pk, instance.pk)
+            else:
+                key = (instance.pk, pk)
+
+            if key not in existing:
+                Membership.objects.create(user_id=key[0],
+                                          organization_id=key[1])
+
+# Handlers of saved and deleted users are connected for every sender: users
+# loaded with only() or defer() are instances of a proxy class, which their
+# signals are sent for.
+
+post_save.connect(_sync_primary_membership)
+m2m_changed.connect(_sync_memberships,
+                    sender=OrganizationUser.organizations.through)
+
+
+# Keep the organization closure in sync with the parent of each
+# organization. Moving an organization moves everything below it.
+
+def _check_organization_parent(sender, instance, raw=False, **kwargs):
+    if not raw and _is_own_ancestor(instance):
+        raise ValueError("An organization can't be placed under itself or "
+                         "one of its descendants.")
+
+
+def _sync_organization_closure(sender, instance, created, **kwargs):
+    if created:
+        OrganizationClosure.objects.add(instance)
+        return
+
+    parents = OrganizationClosure.objects.filter(descendant=instance.pk,
+                                                 depth=1)
+    parent_ids = list(parents.values_list('ancestor', flat=True))
+
+    if parent_ids != [pk for pk in [instance.parent_id] if pk is not None]:
+        descendants = OrganizationClosure.objects.filter(ancestor=instance.pk)
+        OrganizationClosure.objects.rebuild(
+            list(descendants.values_list('descendant', flat=True)) +
+            [instance.pk])
+
+        # roles of the old and new ancestors apply differently now
+        bump_permission_version()
+
+
+def _stash_deleted_organization_descendants(sender, instance, **kwargs):
+    descendants = OrganizationClosure.objects.filter(ancestor=instance.pk,
+                                                     depth__gt=0)
+    instance._closure_descendants = list(
+        descendants.values_list('descendant', flat=True))
+
+
+def _sync_deleted_organization_closure(sender, instance, **kwargs):
+    # the children of the organization no longer have a parent
+    descendants = getattr(instance, '_closure_descendants', ())
+    OrganizationClosure.objects.rebuild(descendants)
+
+    if descendants:
+        bump_permission_version()
+
+pre_save.connect(_check_organization_parent, sender=Organization)
+post_save.connect(_sync_organization_closure, sender=Organization)
+pre_delete.connect(_stash_deleted_organization_descendants,
+                   sender=Organization)
+post_delete.connect(_sync_deleted_organization_closure, sender=Organization)
+
+
+# Keep the role closure in sync with the roles each role includes. A change
+# to the roles included by a role affects the closure of that role and of
+# every role that includes it.
+
+def _check_role_includes(sender, instance, action, reverse, pk_set, **kwargs):
+    if action != 'pre_add' or not pk_set:
+        return
+
+    roles = Role.objects.filter(pk__in=pk_set)
+    if roles.exclude(organization=instance.organization_id).exists():
+        raise ValueError("Roles can only include roles of the same "
+                         "organization.")
+
+    if reverse:
+        cycles = RoleClosure.objects.filter(ancestor=instance,
+                                            descendant__in=pk_set)
+    else:
+        cycles = RoleClosure.objects.filter(ancestor__in=pk_set,
+                                            descendant=instance)
+
+    if instance.pk in pk_set or cycles.exists():
+        raise ValueError("Roles can't include themselves.")
+
+
+def _sync_role_closure(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('pre_remove', 'pre_clear'):
+        # the roles that included the removed roles are only known before
+        instance._closure_ancestors = _role_ancestors([instance.pk])
+
+    elif action == 'post_add':
+        if reverse:
+            # the given roles now include the instance
+            RoleClosure.objects.rebuild(_role_ancestors(pk_set))
+        else:
+            RoleClosure.objects.rebuild(_role_ancestors([instance.pk]))
+
+    elif action in ('post_remove', 'post_clear'):
+        ancestors = instance.__dict__.pop('_closure_ancestors', None)
+        if ancestors is None:
+            ancestors = _role_ancestors([instance.pk])
+        RoleClosure.objects.rebuild(ancestors)
+
+
+def _role_ancestors(role_ids):
+    """
+    Returns the given roles along with every role that includes them.
+    """
+
+    ancestors = set(RoleClosure.objects.filter(descendant__in=role_ids)
+                                       .values_list('ancestor', flat=True))
+    ancestors.update(role_ids)
+    return ancestors
+
+
+def _create_role_closure(sender, instance, created, raw=False, **kwargs):
+    if created:
+        RoleClosure.objects.rebuild([instance.pk])
+
+
+def _stash_deleted_role_ancestors(sender, instance, **kwargs):
+    instance._closure_ancestors = _role_ancestors([instance.pk])
+    instance._closure_ancestors.discard(instance.pk)
+
+
+def _sync_deleted_role_closure(sender, instance, **kwargs):
+    # the role may have linked its ancestors to other roles
+    RoleClosure.objects.rebuild(getattr(instance, '_closure_ancestors', ()))
+
+m2m_changed.connect(_check_role_includes, sender=Role.includes.through)
+m2m_changed.connect(_sync_role_closure, sender=Role.includes.through)
+post_save.connect(_create_role_closure, sender=Role)
+pre_delete.connect(_stash_deleted_role_ancestors, sender=Role)
+post_delete.connect(_sync_deleted_role_closure, sender=Role)
+
+
+# Keep cached permissions from going stale. Changes to the permissions of a
+# role or super role can affect any number of users, so they invalidate the
+# cached permissions of everybody; changes to a single user only invalidate
+# that user.
+
+def _invalidate_all_permissions(sender, **kwargs):
+    action = kwargs.get('action')
+    if action is None or action.startswith('post_'):
+        bump_permission_version()
+
+
+def _invalidate_user_permissions(sender, instance, action, reverse, pk_set,
+                                 **kwargs):
+    if not action.startswith('post_'):
+        return
+
+    if not reverse:
+        bump_permission_version([instance.pk])
+    elif pk_set is not None:
+        # the users were added to or removed from a role/organization
+        bump_permission_version(pk_set)
+    else:
+        # a role/organization was cleared of all of its users, which we no
+        # longer know about
+        bump_permission_version()
+
+
+def _invalidate_saved_user_permissions(sender, instance, **kwargs):
+    if isinstance(instance, OrganizationUser):
+        bump_permission_version([instance.pk])
+
+
+for _through in (Role.permissions.through, SuperRole.permissions.through,
+                 Role.includes.through):
+    m2m_changed.connect(_invalidate_all_permissions, sender=_through)
+
+for _through in (OrganizationUser.roles.through,
+                 OrganizationUser.super_roles.through,
+                 OrganizationUser.organizations.through):
+    m2m_changed.connect(_invalidate_user_permissions, sender=_through)
+
+for _model in (Role, SuperRole, Permission):
+    post_save.connect(_invalidate_all_permissions, sender=_model)
+    post_delete.connect(_invalidate_all_permissions, sender=_model)
+
+post_save.connect(_invalidate_saved_user_permissions)
+post_delete.connect(_invalidate_saved_user_permissions)
+
+
+# Keep cached user objects from going stale.
+
+def _invalidate_user_snapshot(sender, instance, **kwargs):
+    if isinstance(instance, User):
+        invalidate_user_snapshot(instance.pk)
+
+
+def _invalidate_all_user_snapshots(sender, **kwargs):
+    invalidate_user_snapshot()
+
+
+# plain users as well, the parent rows of users
+post_save.connect(_invalidate_user_snapshot)
+post_delete.connect(_invalidate_user_snapshot)
+
+post_save.connect(_invalidate_all_user_snapshots, sender=Organization)
+post_delete.connect(_invalidate_all_user_snapshots, sender=Organization)
@@ -34,9 +34,14 @@ def patch_admin_login():
         message = ERROR_MESSAGE
 
         if all([organization, username, password]):
+            client = None
+            if self.request is not None:
+                client = self.request.META.get('REMOTE_ADDR')
+
             self.user_cache = auth.authenticate(organization=organization,
                                                 username=username,
-                                                password=password)
+                                                password=password,
+                                                client=client)
             if not self.user_cache:
                 raise forms.ValidationError(message)
             if not self.user_cache.is_active or not self.user_cache.is_staff:
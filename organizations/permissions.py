@@ -0,0 +1,223 @@
+"""
+Compiled permission sets.
+
+Permission strings (`app_label.codename`) are resolved from an in-process
+registry of every permission, so permission queries only have to fetch
+primary keys, without joining the content type table. Every permission
+string is built once, and shared by all of the sets that contain it.
+
+Every permission is also given a bit position, its primary key, so a set of
+permissions can be stored as a single integer bitmask. Unions of role
+permissions become bitwise ORs, checking a permission is a single bit test,
+and masks are small enough to be cached cheaply. Because the bit positions
+are primary keys, masks mean the same thing in every process.
+
+Module checks are answered without scanning permission strings: masks are
+tested against the mask of every permission of the app, and sets of strings
+carry an index of their codenames by app label.
+"""
+
+import threading
+
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_save, post_delete, post_syncdb
+
+
+class PermissionSet(frozenset):
+    """
+    A frozenset of permission strings, which indexes its codenames by app
+    label the first time it's asked about an app.
+    """
+
+    def by_app_label(self):
+        """
+        Returns a dict of {app label: frozenset of codenames}.
+        """
+
+        try:
+            return self._by_app_label
+        except AttributeError:
+            pass
+
+        index = {}
+        for name in self:
+            app_label, codename = name.split('.', 1)
+            index.setdefault(app_label, set()).add(codename)
+
+        self._by_app_label = dict((app_label, frozenset(codenames))
+                                  for app_label, codenames in index.items())
+        return self._by_app_label
+
+    def has_module(self, app_label):
+        """
+        Returns whether the set contains any permission of the given app.
+        """
+
+        return app_label in self.by_app_label()
+
+
+class PermissionIndex(object):
+    """
+    A process-wide index of every permission, mapping permission primary
+    keys (and bit positions) to permission strings and back. It is loaded
+    lazily, reset whenever a permission or content type changes in this
+    process or the database is synced, and reloaded when it runs into a
+    permission created by another process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = None
+
+    def reset(self):
+        self._state = None
+
+    def _load(self):
+        with self._lock:
+            perms = Permission.objects.values_list(
+                'pk', 'content_type__app_label', 'codename').order_by()
+
+            names = {}
+            app_masks = {}
+            for pk, app_label, codename in perms:
+                names[pk] = '%s.%s' % (app_label, codename)
+                app_masks[app_label] = app_masks.get(app_label, 0) | 1 << pk
+
+            ids = dict((name, pk) for pk, name in names.items())
+
+            # swap everything at once, other threads may be reading
+            self._state = (names, ids, self.mask(names),
+                           PermissionSet(ids), app_masks)
+            return self._state
+
+    def _get_state(self, mask=0):
+        state = self._state
+
+        # reload if we haven't loaded yet, or if the mask contains
+        # permissions we have never seen
+        if state is None or mask & ~state[2]:
+            state = self._load()
+
+        return state
+
+    def all_names(self):
+        """
+        Returns the set of every permission string. The same set is shared
+        until the index is reset.
+        """
+
+        return self._get_state()[3]
+
+    def all_mask(self):
+        """
+        Returns the bitmask of every permission.
+        """
+
+        return self._get_state()[2]
+
+    def mask(self, ids):
+        """
+        Returns the bitmask for the given permission primary keys.
+        """
+
+        mask = 0
+        for pk in ids:
+            mask |= 1 << pk
+        return mask
+
+    def ids(self, mask):
+        """
+        Returns the permission primary keys in the given bitmask.
+        """
+
+        ids = []
+        while mask:
+            bit = mask & -mask
+            ids.append(bit.bit_length() - 1)
+            mask ^= bit
+        return ids
+
+    def names(self, mask):
+        """
+        Returns the set of permission strings in the given bitmask.
+        """
+
+        state = self._get_state(mask)
+        if mask == state[2]:
+            return state[3]
+
+        return self.names_for_ids(self.ids(mask))
+
+    def names_for_ids(self, ids):
+        """
+        Returns the set of permission strings for the given permission
+        primary keys.
+        """
+
+        names = self._get_state()[0]
+
+        try:
+            return PermissionSet([names[pk] for pk in ids])
+        except KeyError:
+            pass
+
+        # a permission we have never seen, reload and skip anything that
+        # has been deleted since
+        names = self._load()[0]
+        return PermissionSet([names[pk] for pk in ids if pk in names])
+
+    def ids_for_names(self, names):
+        """
+        Returns a dict of the primary keys of the given permission strings.
+        Unknown permissions are left out.
+        """
+
+        ids = self._get_state()[1]
+
+        if [name for name in names if name not in ids]:
+            # maybe created by another process
+            ids = self._load()[1]
+
+        return dict((name, ids[name]) for name in names if name in ids)
+
+    def has(self, mask, name):
+        """
+        Returns whether the given bitmask contains the given permission.
+        """
+
+        names, ids, known, all_names, app_masks = self._get_state()
+        pk = ids.get(name)
+
+        if pk is None and mask & ~known:
+            pk = self._load()[1].get(name)
+
+        return pk is not None and bool(mask >> pk & 1)
+
+    def has_module(self, mask, app_label):
+        """
+        Returns whether the given bitmask contains any permission of the
+        given app.
+        """
+
+        return bool(mask & self._get_state(mask)[4].get(app_label, 0))
+
+
+permission_index = PermissionIndex()
+
+
+def _reset_index(sender, **kwargs):
+    permission_index.reset()
+
+for _model in (Permission, ContentType):
+    post_save.connect(_reset_index, sender=_model)
+    post_delete.connect(_reset_index, sender=_model)
+
+post_syncdb.connect(_reset_index)
+
+try:
+    from south.signals import post_migrate
+except ImportError:
+    pass
+else:
+    post_migrate.connect(_reset_index)
@@ -0,0 +1,68 @@
+// Search boxes for AutocompleteSelectMultiple widgets. Results are fetched a
+// page at a time from the url in the data-autocomplete-url attribute of the
+// select; picking one adds it to the select, double clicking a selected
+// option removes it.
+(function($) {
+    $(function() {
+        $('select[data-autocomplete-url]').each(function() {
+            var select = $(this);
+            var input = $('#' + this.id + '_search');
+            var results = $('<ul class="autocomplete-results"></ul>');
+            var url = select.attr('data-autocomplete-url');
+            var timer = null;
+
+            input.after(results);
+
+            function search(page) {
+                var params = {q: input.val(), page: page};
+                $.getJSON(url, params, function(data) {
+                    if (page == 1) {
+                        results.empty();
+                    }
+                    results.find('li.more').remove();
+
+                    $.each(data.results, function(i, result) {
+                        var item = $('<li><a href="#"></a></li>');
+                        item.find('a').text(result.text).click(function() {
+                            if (!select.find('option[value="' + result.id + '"]').length) {
+                                $('<option selected="selected"></option>')
+                                    .val(result.id).text(result.text)
+                                    .appendTo(select);
+                            }
+                            return false;
+                        });
+                        results.append(item);
+                    });
+
+                    if (data.more) {
+                        var more = $('<li class="more"><a href="#">More</a></li>');
+                        more.find('a').click(function() {
+                            search(page + 1);
+                            return false;
+                        });
+                        results.append(more);
+                    }
+                });
+            }
+
+            input.keyup(function() {
+                clearTimeout(timer);
+                timer = setTimeout(function() { search(1); }, 250);
+            });
+
+            // don't submit the form from the search box
+            input.keydown(function(e) {
+                return e.keyCode != 13;
+            });
+
+            select.dblclick(function(e) {
+                $(e.target).filter('option').remove();
+            });
+
+            // everything left in the select is submitted
+            select.closest('form').submit(function() {
+                select.find('option').attr('selected', 'selected');
+            });
+        });
+    });
+})(django.jQuery);
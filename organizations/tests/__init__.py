@@ -5,14 +5,35 @@ from .testmodels import TestModelDefaultAttribute, TestModelCustomAttribute, \
 
 
 # import actual test cases
-from .models import OrganizationUserModelTest, OrganizationModelTest
-from .backends import PermissionTestCase
+from .models import OrganizationUserModelTest, \
+        OrganizationUserTransactionTest, OrganizationModelTest, \
+        OrganizationClosureModelTest, MembershipModelTest, \
+        RoleClosureModelTest
+from .backends import AuthenticationTestCase, LoginThrottleTestCase, \
+        PermissionTestCase, CompiledPermissionTestCase, \
+        SharedPermissionCacheTestCase, PendingInvalidationTestCase, \
+        GetUserTestCase, PermissionDigestTestCase, \
+        CompiledPermissionDigestTestCase, PermittedQuerySetTestCase
+from .commands import ImportCommandTestCase, ExportCommandTestCase
+from .admin import OrganizationUserAdminTestCase
+from .instrumentation import InstrumentationTestCase
+from .budgets import QueryBudgetTestCase
 
 # stop pyflakes from freaking out
 {
     'testmodels': (TestModelDefaultAttribute, TestModelCustomAttribute,
                    TestModelInvalidCustomAttribute, TestModelNoAttribute,
                    TestModelInvalidFK),
-    'models': (OrganizationUserModelTest, OrganizationModelTest),
-    'backends': (PermissionTestCase,)
+    'models': (OrganizationUserModelTest, OrganizationUserTransactionTest,
+               OrganizationModelTest, OrganizationClosureModelTest,
+               MembershipModelTest, RoleClosureModelTest),
+    'backends': (AuthenticationTestCase, LoginThrottleTestCase,
+                 PermissionTestCase, CompiledPermissionTestCase,
+                 SharedPermissionCacheTestCase, PendingInvalidationTestCase,
+                 GetUserTestCase, PermissionDigestTestCase,
+                 CompiledPermissionDigestTestCase, PermittedQuerySetTestCase),
+    'commands': (ImportCommandTestCase, ExportCommandTestCase),
+    'admin': (OrganizationUserAdminTestCase,),
+    'instrumentation': (InstrumentationTestCase,),
+    'budgets': (QueryBudgetTestCase,)
 }
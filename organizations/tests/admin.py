@@ -0,0 +1,188 @@
+import json
+
+from django.contrib import admin
+from django.forms.models import model_to_dict
+from django.http import Http404
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from ..admin import OrganizationUserChangeForm, \
+        OrganizationUserCreationForm
+from ..instrumentation import QueryCounter
+from ..models import Organization, OrganizationUser, Role, SuperRole
+
+
+class OrganizationUserAdminTestCase(TestCase):
+    "Test that the admin scales with the number of organizations and roles."
+
+    urls = 'organizations.tests.urls'
+
+    def setUp(self):
+        self.org = Organization.objects.create(code='testorg', name='Test Org')
+        self.org2 = Organization.objects.create(code='testorg2',
+                                                name='Test Org2')
+        self.org3 = Organization.objects.create(code='testorg3',
+                                                name='Test Org3')
+
+        self.admin = OrganizationUser.objects.create_superuser(
+            self.org, 'admin', 'admin@test.com', 'secret')
+        self.assertTrue(self.client.login(organization='testorg',
+                                          username='admin',
+                                          password='secret'))
+
+        self.u = OrganizationUser.objects.create_user(organization=self.org,
+                                                      username='testuser',
+                                                      email='test@test.com')
+        self.u.organizations.add(self.org2)
+
+        self.roles = []
+        for org in (self.org, self.org2, self.org3):
+            for name in ('Editor', 'Viewer'):
+                self.roles.append(Role.objects.create(organization=org,
+                                                      name=name))
+        self.u.roles.add(self.roles[0])
+
+        SuperRole.objects.create(name='SuperRole')
+
+        self.url = '/admin/organizations/organizationuser/'
+
+    def autocomplete(self, field, **params):
+        params.setdefault('user', self.u.pk)
+        response = self.client.get('%sautocomplete/%s/' % (self.url, field),
+                                   params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_change_page(self):
+        "Only the selected options should be rendered"
+
+        response = self.client.get('%s%d/' % (self.url, self.u.pk))
+        self.assertEqual(response.status_code, 200)
+
+        self.assertContains(response, unicode(self.roles[0]))
+        self.assertNotContains(response, unicode(self.roles[1]))
+        self.assertNotContains(response, 'Test Org3')
+
+    def test_role_change_page(self):
+        "Included role options should not cost a query each"
+
+        url = '/admin/organizations/role/%d/' % self.roles[0].pk
+        counter = QueryCounter()
+
+        def count():
+            counter.start()
+            response = self.client.get(url)
+            queries = counter.stop()
+            self.assertEqual(response.status_code, 200)
+            return queries
+
+        # the first request loads what is loaded once
+        count()
+        queries = count()
+        for i in range(3):
+            Role.objects.create(organization=self.org, name='Role %d' % i)
+        self.assertEqual(count(), queries)
+
+    def test_changelist(self):
+        response = self.client.get(self.url, {'q': 'testuser'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'testuser')
+
+    def test_autocomplete(self):
+        "Autocomplete lookups should be scoped like the change form"
+
+        data = self.autocomplete('roles')
+        self.assertEqual([r['id'] for r in data['results']],
+                         [r.pk for r in self.roles[:4]])
+        self.assertFalse(data['more'])
+
+        data = self.autocomplete('roles', q='view testorg2')
+        self.assertEqual([r['id'] for r in data['results']],
+                         [self.roles[3].pk])
+
+        data = self.autocomplete('organizations')
+        self.assertEqual([r['id'] for r in data['results']],
+                         [self.org2.pk, self.org3.pk])
+
+        data = self.autocomplete('super_roles', q='super')
+        self.assertEqual([r['text'] for r in data['results']],
+                         ['SuperRole'])
+
+    def test_autocomplete_pages(self):
+        for i in range(25):
+            Organization.objects.create(code='org%02d' % i, name='Org')
+
+        data = self.autocomplete('organizations', q='org')
+        self.assertEqual(len(data['results']), 20)
+        self.assertTrue(data['more'])
+
+        data = self.autocomplete('organizations', q='org', page=2)
+        self.assertEqual(len(data['results']), 7)
+        self.assertFalse(data['more'])
+
+    def test_autocomplete_errors(self):
+        model_admin = admin.site._registry[OrganizationUser]
+
+        request = RequestFactory().get('/', {'user': self.u.pk})
+        request.user = self.admin
+        self.assertRaises(Http404, model_admin.autocomplete_view, request,
+                          'username')
+
+        request = RequestFactory().get('/')
+        request.user = self.admin
+        self.assertRaises(Http404, model_admin.autocomplete_view, request,
+                          'roles')
+
+    def test_actions(self):
+        "Bulk actions should change every selected user"
+
+        u2 = OrganizationUser.objects.create_user(organization=self.org,
+                                                  username='testuser2',
+                                                  email='test2@test.com')
+        role = self.roles[1]
+
+        def act(action, **data):
+            data.update({'action': action, 'index': 0,
+                         '_selected_action': [self.u.pk, u2.pk]})
+            response = self.client.post(self.url, data)
+            self.assertEqual(response.status_code, 302)
+
+        act('grant_role', organization='TESTORG', role=role.name)
+        self.assertEqual(set(role.organizationuser_set.all()),
+                         set([self.u, u2]))
+
+        act('revoke_role', organization='testorg', role=role.name)
+        self.assertEqual(role.organizationuser_set.count(), 0)
+
+        act('move_organization', organization='testorg3')
+        self.assertEqual(self.org3.primary_members.count(), 2)
+
+        # unknown targets don't change anything
+        act('add_organization', organization='nope')
+        self.assertEqual(self.org.members.count(), 0)
+
+    def test_username_case(self):
+        "Forms should reject usernames taken in the organization in any case"
+
+        data = {'organization': self.org.pk, 'username': 'TestUser',
+                'password1': 'secret', 'password2': 'secret'}
+        form = OrganizationUserCreationForm(data)
+        self.assertFalse(form.is_valid())
+        self.assertTrue('username' in form.errors)
+
+        data['organization'] = self.org2.pk
+        self.assertTrue(OrganizationUserCreationForm(data).is_valid())
+
+        other = OrganizationUser.objects.create_user(organization=self.org,
+                                                     username='other',
+                                                     email='other@test.com')
+        data = model_to_dict(other)
+        data['username'] = 'TESTUSER'
+        form = OrganizationUserChangeForm(data, instance=other)
+        self.assertFalse(form.is_valid())
+        self.assertTrue('username' in form.errors)
+
+        # changing the case of its own username
+        data['username'] = 'Other'
+        form = OrganizationUserChangeForm(data, instance=other)
+        self.assertTrue(form.is_valid(), form.errors)
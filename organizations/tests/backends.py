@@ -1,9 +1,154 @@
-from django.test import TestCase
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
 
 from django.contrib.auth.models import Permission
 
 from ..backends import OrganizationBackend
-from ..models import Organization, Role, SuperRole, OrganizationUser
+from ..cache import _MAX_PENDING, _pending, bump_permission_version, \
+        cache, commit_on_success, get_permission_version, is_shared
+from ..middleware import PermissionDigestMiddleware, SESSION_KEY
+from ..permissions import permission_index
+from ..throttling import login_throttle
+from ..models import Organization, Role, SuperRole, OrganizationUser, \
+        OrganizationOwnedQuerySet
+from .testmodels import TestModelDefaultAttribute, TestModelCustomAttribute
+
+
+class AuthenticationTestCase(TestCase):
+    "Test that users are authenticated through their organization."
+
+    def setUp(self):
+        self.org = Organization.objects.create(code='TestOrg', name='Test Org')
+        self.backend = OrganizationBackend()
+
+        self.user = OrganizationUser.objects.create_user(
+            organization=self.org, username='TestUser',
+            email='test@test.com', password='secret')
+
+    def test_authenticate(self):
+        "Organization codes and usernames are case insensitive."
+
+        for org, username in (('TestOrg', 'TestUser'), ('testorg', 'testuser'),
+                              ('TESTORG', 'testUSER')):
+            self.assertNumQueries(1, self.backend.authenticate,
+                                  org, username, 'secret')
+            user = self.backend.authenticate(org, username, 'secret')
+            self.assertEqual(user, self.user)
+
+        # the organization is already loaded
+        self.assertNumQueries(0, lambda: user.organization)
+
+        self.assertEqual(self.backend.authenticate('testorg', 'testuser',
+                                                   'wrong'), None)
+        self.assertEqual(self.backend.authenticate('otherorg', 'testuser',
+                                                   'secret'), None)
+        self.assertEqual(self.backend.authenticate(None, 'testuser',
+                                                   'secret'), None)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.backend.authenticate('testorg', 'testuser',
+                                                   'secret'), None)
+
+    def test_unique_username(self):
+        "Usernames are unique within an organization, regardless of case."
+
+        org2 = Organization.objects.create(code='testorg2', name='Test Org2')
+        OrganizationUser.objects.create_user(organization=org2,
+                                             username='testuser',
+                                             email='test@test.com')
+
+        self.assertRaises(IntegrityError,
+                          OrganizationUser.objects.create_user,
+                          organization=self.org, username='testuser',
+                          email='test@test.com')
+
+    def test_rebuild(self):
+        "The rebuild command should fill in missing lookup keys."
+
+        Organization.objects.update(code_key='')
+        OrganizationUser.objects.update(username_key='')
+
+        call_command('rebuild_organization_indexes', 'lookup_keys',
+                     verbosity=0)
+
+        self.assertEqual(self.backend.authenticate('testorg', 'testuser',
+                                                   'secret'), self.user)
+
+
+class LoginThrottleTestCase(TestCase):
+    "Test that failed logins are throttled before hashing passwords."
+
+    def setUp(self):
+        cache.clear()
+
+        self.org = Organization.objects.create(code='testorg', name='Test Org')
+        self.backend = OrganizationBackend()
+        self.backend.throttle_logins = True
+
+        self.user = OrganizationUser.objects.create_user(
+            organization=self.org, username='testuser',
+            email='test@test.com', password='secret')
+
+        self.limits = (login_throttle.limit, login_throttle.client_limit,
+                       login_throttle.organization_limits)
+        login_throttle.limit = (3, 300)
+        login_throttle.client_limit = (5, 300)
+        login_throttle.organization_limits = {}
+
+    def tearDown(self):
+        (login_throttle.limit, login_throttle.client_limit,
+         login_throttle.organization_limits) = self.limits
+
+    def login(self, password, username='testuser', client='127.0.0.1'):
+        return self.backend.authenticate('testorg', username, password,
+                                         client=client)
+
+    def test_user_limit(self):
+        "Too many failures for a user should reject even valid passwords."
+
+        for i in range(2):
+            self.assertEqual(self.login('wrong'), None)
+
+        # a successful login forgets the failures
+        self.assertEqual(self.login('secret'), self.user)
+
+        for i in range(3):
+            self.assertEqual(self.login('wrong', client=None), None)
+
+        # rejected without even looking the user up
+        self.assertNumQueries(0, self.login, 'secret')
+        self.assertEqual(self.login('secret'), None)
+
+        # case doesn't get around the limit
+        self.assertEqual(self.backend.authenticate('TESTORG', 'TestUser',
+                                                   'secret'), None)
+
+        stats = login_throttle.get_stats()
+        self.assertEqual(stats['failures'], 5)
+        self.assertEqual(stats['rejected'], 3)
+
+    def test_client_limit(self):
+        "Too many failures from a client should reject any user."
+
+        for i in range(5):
+            self.assertEqual(self.login('wrong', username='user%d' % i), None)
+
+        self.assertEqual(self.login('secret'), None)
+        self.assertEqual(self.login('secret', client='10.0.0.1'), self.user)
+
+    def test_organization_limit(self):
+        "Limits can be configured per organization."
+
+        login_throttle.organization_limits = {'testorg': (1, 60)}
+
+        self.assertEqual(self.login('wrong'), None)
+        self.assertEqual(self.login('secret'), None)
 
 
 class PermissionTestCase(TestCase):
@@ -16,6 +161,15 @@ class PermissionTestCase(TestCase):
         self.org = Organization.objects.create(code='testorg', name='Test Org')
         self.backend = OrganizationBackend()
 
+        # load the permission index up front, so query counts only cover
+        # the permission lookups
+        permission_index.reset()
+        permission_index.names(0)
+
+    def tearDown(self):
+        # the index outlives the test transaction
+        permission_index.reset()
+
     def test_superuser_permissions(self):
         "Superusers get all permissions."
 
@@ -34,6 +188,43 @@ class PermissionTestCase(TestCase):
         for perm in self.permstr(perms):
             self.assertTrue(self.backend.has_perm(u, perm))
 
+    def test_superuser_fast_path(self):
+        "Superuser checks should not hit the database."
+
+        u = OrganizationUser.objects.create_superuser(organization=self.org,
+                                                      username='superuser',
+                                                      email='super@super.com',
+                                                      password='superuser')
+        u2 = OrganizationUser.objects.create_superuser(organization=self.org,
+                                                       username='superuser2',
+                                                       email='super@super.com',
+                                                       password='superuser')
+
+        perm = self.permstr([Permission.objects.all()[0]]).pop()
+
+        def check():
+            self.assertTrue(self.backend.has_perm(u, perm, self.org))
+            self.assertTrue(self.backend.has_module_perms(u, 'auth'))
+            self.assertTrue(perm in self.backend.get_all_permissions(u))
+
+        self.assertNumQueries(0, check)
+
+        # every superuser shares the same set
+        self.assertTrue(self.backend.get_all_permissions(u) is
+                        self.backend.get_all_permissions(u2))
+
+        # until permissions change
+        ct = Permission.objects.all()[0].content_type
+        Permission.objects.create(codename='new_perm', name='New',
+                                  content_type=ct)
+
+        self.assertTrue('%s.new_perm' % ct.app_label in
+                        self.backend.get_all_permissions(u))
+
+        u.is_active = False
+        self.assertFalse(self.backend.has_perm(u, perm))
+        self.assertFalse(self.backend.has_module_perms(u, 'auth'))
+
     def test_superrole_permissions(self):
         "SuperRole permissions should apply regardless of Organization"
 
@@ -151,6 +342,7 @@ class PermissionTestCase(TestCase):
         # add an additional permission to just the super role
         perm = Permission.objects.all()[4]
         superrole.permissions.add(perm)
+        self.backend.clear_permission_cache(u)
 
         perms.append(perm)
 
@@ -163,6 +355,7 @@ class PermissionTestCase(TestCase):
         # add an additional permission to just the regular role
         perm = Permission.objects.all()[5]
         role.permissions.add(perm)
+        self.backend.clear_permission_cache(u)
         new_permstr = self.permstr([perm]).pop()
 
         # ensure they still have full access to all permissions
@@ -242,3 +435,771 @@ class PermissionTestCase(TestCase):
         # org is not the org they are a part of
         for perm in self.permstr(perms):
             self.assertFalse(self.backend.has_perm(u, perm, org2))
+
+    def test_permission_cache(self):
+        "Repeated checks for the same organization should not hit the database."
+
+        role = Role.objects.create(organization=self.org, name='Role')
+
+        perms = list(Permission.objects.all()[0:2])
+        role.permissions.add(perms[0])
+
+        u = OrganizationUser.objects.create_user(organization=self.org,
+                                                 username='testuser',
+                                                 email='test@test.com')
+        u.roles.add(role)
+
+        org2 = Organization.objects.create(code='testorg2', name='Test Org2')
+
+        class T1(object):
+            organization = self.org
+        class T2(object):
+            organization = org2
+
+        perm1, perm2 = [self.permstr([p]).pop() for p in perms]
+
+        # prime the cache for every kind of object
+        for obj in (None, T1(), T2(), self.org):
+            self.backend.has_perm(u, perm1, obj=obj)
+
+        def check():
+            self.assertTrue(self.backend.has_perm(u, perm1))
+            self.assertTrue(self.backend.has_perm(u, perm1, obj=T1()))
+            self.assertTrue(self.backend.has_perm(u, perm1, obj=self.org))
+            self.assertFalse(self.backend.has_perm(u, perm1, obj=T2()))
+
+        self.assertNumQueries(0, check)
+
+        # role changes are only picked up once the cache is cleared
+        role.permissions.add(perms[1])
+        self.assertFalse(self.backend.has_perm(u, perm2, obj=T1()))
+
+        self.backend.clear_permission_cache(u)
+        self.assertTrue(self.backend.has_perm(u, perm2, obj=T1()))
+
+    def test_single_query(self):
+        "Permissions for any object should be resolved in one query."
+
+        superrole = SuperRole.objects.create(name='SuperRole')
+        role = Role.objects.create(organization=self.org, name='Role')
+
+        perms = list(Permission.objects.all()[0:2])
+        superrole.permissions.add(perms[0])
+        role.permissions.add(perms[1])
+
+        u = OrganizationUser.objects.create_user(organization=self.org,
+                                                 username='testuser',
+                                                 email='test@test.com')
+        u.super_roles.add(superrole)
+        u.roles.add(role)
+
+        # a secondary organization requires a database membership check
+        org2 = Organization.objects.create(code='testorg2', name='Test Org2')
+        role2 = Role.objects.create(organization=org2, name='Role')
+        role2.permissions.add(perms[1])
+        u.organizations.add(org2)
+        u.roles.add(role2)
+
+        class T(object):
+            organization = org2
+
+        for obj in (None, self.org, org2, T()):
+            self.backend.clear_permission_cache(u)
+            self.assertNumQueries(1, self.backend.get_all_permissions, u, obj)
+            self.assertEqual(len(self.backend.get_all_permissions(u, obj)), 2)
+
+        # once the user leaves the organization, its roles no longer apply
+        u.organizations.remove(org2)
+        self.backend.clear_permission_cache(u)
+        self.assertEqual(len(self.backend.get_all_permissions(u, T())), 1)
+
+    def test_included_roles(self):
+        "Roles should have the permissions of the roles they include."
+
+        perms = list(Permission.objects.all()[0:3])
+        manager, editor, writer = [
+            Role.objects.create(organization=self.org, name=name)
+            for name in ('Manager', 'Editor', 'Writer')]
+        for role, perm in zip((manager, editor, writer), perms):
+            role.permissions.add(perm)
+        manager.includes.add(editor)
+        editor.includes.add(writer)
+
+        u = OrganizationUser.objects.create_user(organization=self.org,
+                                                 username='testuser',
+                                                 email='test@test.com')
+        u.roles.add(manager)
+
+        for obj in (None, self.org):
+            self.backend.clear_permission_cache(u)
+            self.assertNumQueries(1, self.backend.get_all_permissions, u, obj)
+            self.assertEqual(self.backend.get_all_permissions(u, obj),
+                             self.permstr(perms))
+
+        permstr = self.permstr(perms[2:]).pop()
+        self.assertEqual(list(self.backend.get_permitted_organizations(
+            u, permstr)), [self.org.pk])
+        self.assertEqual(
+            self.backend.get_membership_permissions([u])[u.pk][self.org.pk],
+            frozenset(self.permstr(perms)))
+
+        editor.includes.remove(writer)
+        self.backend.clear_permission_cache(u)
+        self.assertEqual(self.backend.get_all_permissions(u),
+                         self.permstr(perms[:2]))
+
+    def test_descendant_roles(self):
+        "Roles can apply to the organizations below their own."
+
+        sub = Organization.objects.create(code='sub', name='Sub',
+                                          parent=self.org)
+        subsub = Organization.objects.create(code='subsub', name='SubSub',
+                                             parent=sub)
+        other = Organization.objects.create(code='other', name='Other')
+
+        perms = list(Permission.objects.all()[0:2])
+        inherited = Role.objects.create(organization=self.org, name='Manager',
+                                        applies_to_descendants=True)
+        inherited.permissions.add(perms[0])
+        local = Role.objects.create(organization=self.org, name='Editor')
+        local.permissions.add(perms[1])
+
+        u = OrganizationUser.objects.create_user(organization=other,
+                                                 username='testuser',
+                                                 email='test@test.com')
+        u.roles.add(inherited, local)
+
+        class T(object):
+            organization = subsub
+
+        # the roles of an organization the user isn't a member of don't count
+        self.assertEqual(self.backend.get_all_permissions(u, T()), set())
+
+        u.organizations.add(self.org)
+        for obj in (self.org, sub, T()):
+            self.backend.clear_permission_cache(u)
+            self.assertNumQueries(1, self.backend.get_all_permissions, u, obj)
+
+        self.backend.clear_permission_cache(u)
+        self.assertEqual(self.backend.get_all_permissions(u, self.org),
+                         self.permstr(perms))
+        self.assertEqual(self.backend.get_all_permissions(u, T()),
+                         self.permstr(perms[:1]))
+        self.assertEqual(self.backend.get_all_permissions(u, other), set())
+
+        permstr = self.permstr(perms[:1]).pop()
+        self.assertEqual(sorted(self.backend.get_permitted_organizations(
+            u, permstr)), [self.org.pk, sub.pk, subsub.pk])
+
+        orgs = self.backend.get_membership_permissions([u])[u.pk]
+        self.assertEqual(orgs[subsub.pk], frozenset(self.permstr(perms[:1])))
+        self.assertEqual(orgs[other.pk], frozenset())
+
+        # inherited roles also apply below the primary organization
+        u = OrganizationUser.objects.create_user(organization=self.org,
+                                                 username='testuser2',
+                                                 email='test2@test.com')
+        u.roles.add(inherited)
+        self.assertTrue(self.backend.has_perm(u, permstr, subsub))
+
+        # moving the organization out of the tree drops the inherited roles
+        sub.parent = None
+        sub.save()
+        self.backend.clear_permission_cache(u)
+        self.assertFalse(self.backend.has_perm(u, permstr, subsub))
+
+    def test_included_descendant_roles(self):
+        "The roles a user holds should decide where included roles apply."
+
+        sub = Organization.objects.create(code='sub', name='Sub',
+                                          parent=self.org)
+
+        perms = list(Permission.objects.all()[0:2])
+        manager = Role.objects.create(organization=self.org, name='Manager',
+                                      applies_to_descendants=True)
+        editor = Role.objects.create(organization=self.org, name='Editor')
+        editor.permissions.add(perms[0])
+        manager.includes.add(editor)
+
+        # a role that applies to descendants, only included by a local role
+        owner = Role.objects.create(organization=self.org, name='Owner')
+        writer = Role.objects.create(organization=self.org, name='Writer',
+                                     applies_to_descendants=True)
+        writer.permissions.add(perms[1])
+        owner.includes.add(writer)
+
+        u = OrganizationUser.objects.create_user(organization=self.org,
+                                                 username='testuser',
+                                                 email='test@test.com')
+        u.roles.add(manager, owner)
+
+        self.assertEqual(self.backend.get_all_permissions(u, self.org),
+                         self.permstr(perms))
+        self.assertEqual(self.backend.get_all_permissions(u, sub),
+                         self.permstr(perms[:1]))
+
+        self.assertEqual(sorted(self.backend.get_permitted_organizations(
+            u, self.permstr(perms[:1]).pop())), [self.org.pk, sub.pk])
+        self.assertEqual(list(self.backend.get_permitted_organizations(
+            u, self.permstr(perms[1:]).pop())), [self.org.pk])
+
+        orgs = self.backend.get_membership_permissions([u])[u.pk]
+        self.assertEqual(orgs[self.org.pk], frozenset(self.permstr(perms)))
+        self.assertEqual(orgs[sub.pk], frozenset(self.permstr(perms[:1])))
+
+    def test_module_perms(self):
+        "Module checks should use the app label index of the permissions."
+
+        perm = Permission.objects.select_related('content_type')[0]
+        app_label = perm.content_type.app_label
+        role = Role.objects.create(organization=self.org, name='Role')
+        role.permissions.add(perm)
+
+        u = OrganizationUser.objects.create_user(organization=self.org,
+                                                 username='testuser',
+                                                 email='test@test.com')
+        self.assertFalse(self.backend.has_module_perms(u, app_label))
+
+        u.roles.add(role)
+        self.backend.clear_permission_cache(u)
+        self.assertNumQueries(1, self.backend.has_module_perms, u, app_label)
+
+        # every app is answered from the same resolution
+        self.assertNumQueries(0, lambda: self.assertEqual(
+            [self.backend.has_module_perms(u, label)
+             for label in (app_label, 'nonexistent')], [True, False]))
+
+        perms = self.backend.get_group_permissions(u, self.org)
+        self.assertEqual(perms.by_app_label(),
+                         {app_label: frozenset([perm.codename])})
+        self.assertTrue(perms.by_app_label() is perms.by_app_label())
+
+    def test_has_perm_for_objects(self):
+        "Bulk checks should resolve each organization once."
+
+        role = Role.objects.create(organization=self.org, name='Role')
+        perm = Permission.objects.all()[0]
+        role.permissions.add(perm)
+        permstr = self.permstr([perm]).pop()
+
+        u = OrganizationUser.objects.create_user(organization=self.org,
+                                                 username='testuser',
+                                                 email='test@test.com')
+        u.roles.add(role)
+
+        org2 = Organization.objects.create(code='testorg2', name='Test Org2')
+
+        # only set the foreign key columns, like rows loaded from a queryset
+        objs = [TestModelDefaultAttribute(organization_id=self.org.pk)
+                for i in range(5)]
+        objs += [TestModelCustomAttribute(org_id=org2.pk) for i in range(5)]
+
+        # one query per distinct organization, none to fetch organizations
+        self.assertNumQueries(2, self.backend.has_perm_for_objects,
+                              u, permstr, objs)
+
+        allowed = self.backend.has_perm_for_objects(u, permstr, objs)
+        self.assertEqual(allowed, [True] * 5 + [False] * 5)
+
+        self.assertEqual(self.backend.has_perm_for_objects(u, permstr, []), [])
+
+    def test_permission_strings(self):
+        "Permission strings should come from the index, not the database."
+
+        perms = list(Permission.objects.all()[0:3])
+        names = set(['%s.%s' % (p.content_type.app_label, p.codename)
+                     for p in perms])
+
+        perms = list(Permission.objects.all()[0:3])
+        self.assertNumQueries(0, lambda: self.assertEqual(
+            self.permstr(perms), names))
+
+        # renaming an app resets the index
+        ct = perms[0].content_type
+        ct.app_label = 'renamed'
+        ct.save()
+
+        self.assertTrue('renamed.%s' % perms[0].codename in
+                        self.permstr(perms))
+
+
+class CompiledPermissionTestCase(PermissionTestCase):
+    "Test that permissions compiled to bitmasks behave the same."
+
+    def setUp(self):
+        super(CompiledPermissionTestCase, self).setUp()
+        self.backend.compile_permissions = True
+
+    def test_permission_index(self):
+        "Bitmasks should round trip through the permission index."
+
+        perms = list(Permission.objects.all()[0:3])
+        mask = permission_index.mask([p.pk for p in perms])
+
+        self.assertEqual(permission_index.ids(mask),
+                         sorted([p.pk for p in perms]))
+        self.assertEqual(permission_index.names(mask), self.permstr(perms))
+
+        for perm in self.permstr(perms):
+            self.assertTrue(permission_index.has(mask, perm))
+
+        other = self.permstr([Permission.objects.all()[3]]).pop()
+        self.assertFalse(permission_index.has(mask, other))
+        self.assertFalse(permission_index.has(mask, 'nonexistent.perm'))
+
+        for perm in perms:
+            self.assertTrue(permission_index.has_module(
+                mask, perm.content_type.app_label))
+        self.assertFalse(permission_index.has_module(mask, 'nonexistent'))
+
+    def test_unknown_permission(self):
+        "Permissions the index hasn't seen yet should be loaded on demand."
+
+        # pretend another process created the permission, so the index
+        # wasn't reset
+        stale = permission_index._state
+
+        ct = Permission.objects.all()[0].content_type
+        perm = Permission.objects.create(codename='new_perm', name='New',
+                                         content_type=ct)
+
+        permission_index._state = stale
+
+        mask = permission_index.mask([perm.pk])
+        name = '%s.new_perm' % ct.app_label
+
+        self.assertTrue(permission_index.has(mask, name))
+        self.assertEqual(permission_index.names(mask), frozenset([name]))
+
+
+class SharedPermissionCacheTestCase(TestCase):
+    "Test that permissions are shared through the cache framework."
+
+    def setUp(self):
+        cache.clear()
+
+        self.org = Organization.objects.create(code='testorg', name='Test Org')
+        self.backend = OrganizationBackend()
+        self.backend.cache_permissions = True
+
+        self.role = Role.objects.create(organization=self.org, name='Role')
+        self.perms = list(Permission.objects.all()[0:3])
+        self.role.permissions.add(self.perms[0])
+
+        u = OrganizationUser.objects.create_user(organization=self.org,
+                                                 username='testuser',
+                                                 email='test@test.com')
+        u.roles.add(self.role)
+
+        self.permstrs = [self.backend._create_permission_set([p]).pop()
+                         for p in self.perms]
+
+    def get_user(self):
+        return OrganizationUser.objects.get(username='testuser')
+
+    def test_cache_hit(self):
+        "A fresh user object should reuse the cached permissions."
+
+        self.assertTrue(self.backend.has_perm(self.get_user(),
+                                              self.permstrs[0], self.org))
+
+        u = self.get_user()
+        self.assertNumQueries(0, lambda: self.assertTrue(
+            self.backend.has_perm(u, self.permstrs[0], self.org)))
+
+    def test_role_permission_change(self):
+        "Changing the permissions of a role should invalidate the cache."
+
+        self.assertFalse(self.backend.has_perm(self.get_user(),
+                                               self.permstrs[1], self.org))
+
+        self.role.permissions.add(self.perms[1])
+        self.assertTrue(self.backend.has_perm(self.get_user(),
+                                              self.permstrs[1], self.org))
+
+        self.role.permissions.remove(self.perms[1])
+        self.assertFalse(self.backend.has_perm(self.get_user(),
+                                               self.permstrs[1], self.org))
+
+    def test_user_role_change(self):
+        "Changing the roles of a user should invalidate the cache."
+
+        superrole = SuperRole.objects.create(name='SuperRole')
+        superrole.permissions.add(self.perms[2])
+
+        self.assertFalse(self.backend.has_perm(self.get_user(),
+                                               self.permstrs[2]))
+
+        self.get_user().super_roles.add(superrole)
+        self.assertTrue(self.backend.has_perm(self.get_user(),
+                                              self.permstrs[2]))
+
+        # and from the other side of the relation
+        superrole.organizationuser_set.clear()
+        self.assertFalse(self.backend.has_perm(self.get_user(),
+                                               self.permstrs[2]))
+
+        self.get_user().roles.remove(self.role)
+        self.assertFalse(self.backend.has_perm(self.get_user(),
+                                               self.permstrs[0]))
+
+    def test_version_timeout(self):
+        "Versions should outlive the default timeout of the cache."
+
+        self.backend.permission_cache_timeout = cache.default_timeout * 2
+
+        u = self.get_user()
+        self.assertTrue(self.backend.has_perm(u, self.permstrs[0], self.org))
+        version = get_permission_version(u.pk)
+
+        # move the clock of the cache past its default timeout
+        now = time.time
+        time.time = lambda: now() + cache.default_timeout + 1
+        try:
+            self.assertEqual(get_permission_version(u.pk), version)
+            u = self.get_user()
+            self.assertNumQueries(0, lambda: self.assertTrue(
+                self.backend.has_perm(u, self.permstrs[0], self.org)))
+        finally:
+            time.time = now
+
+
+class PendingInvalidationTestCase(TransactionTestCase):
+    "Test that invalidations are repeated once transactions are committed."
+
+    def setUp(self):
+        cache.clear()
+
+        self.org = Organization.objects.create(code='testorg', name='Test Org')
+        self.role = Role.objects.create(organization=self.org, name='Role')
+        self.u = OrganizationUser.objects.create_user(organization=self.org,
+                                                      username='testuser',
+                                                      email='test@test.com')
+
+    def test_commit_on_success(self):
+        "The version should be bumped again once the block is left."
+
+        with commit_on_success():
+            OrganizationUser.objects.grant_role([self.u.pk], self.role)
+            # what another process could cache the old permissions under
+            version = get_permission_version(self.u.pk)
+
+        self.assertNotEqual(get_permission_version(self.u.pk), version)
+        self.assertFalse(hasattr(_pending, 'user_ids'))
+
+    def test_many_users(self):
+        "Past a limit, everyone should be invalidated instead."
+
+        with commit_on_success():
+            bump_permission_version(range(_MAX_PENDING + 1))
+            bump_permission_version([self.u.pk])
+
+            self.assertTrue(_pending.everyone)
+            self.assertEqual(_pending.user_ids, set([self.u.pk]))
+            version = get_permission_version(self.u.pk)
+
+        self.assertNotEqual(get_permission_version(self.u.pk), version)
+
+
+class GetUserTestCase(TestCase):
+    "Test loading the user of a request."
+
+    def setUp(self):
+        cache.clear()
+
+        self.org = Organization.objects.create(code='testorg', name='Test Org')
+        self.u = OrganizationUser.objects.create_user(organization=self.org,
+                                                      username='testuser',
+                                                      email='test@test.com')
+        self.backend = OrganizationBackend()
+
+    def test_get_user(self):
+        "The organization should be loaded along with the user."
+
+        self.assertEqual(self.backend.get_user(0), None)
+
+        def get_user():
+            u = self.backend.get_user(self.u.pk)
+            self.assertEqual(u, self.u)
+            self.assertEqual(u.organization, self.org)
+        self.assertNumQueries(1, get_user)
+
+    def test_defer(self):
+        "Deferred columns should be loaded on access."
+
+        self.backend.user_defer = ('password', 'last_login')
+        u = self.backend.get_user(self.u.pk)
+
+        self.assertNumQueries(0, lambda: u.organization)
+        self.assertNumQueries(1, lambda: u.password)
+        self.assertEqual(u.password, self.u.password)
+
+        # deferred users can be cached as well
+        self.backend.cache_users = True
+        self.backend.get_user(self.u.pk)
+        self.assertNumQueries(0, lambda: self.backend.get_user(self.u.pk))
+
+    def test_save_deferred(self):
+        "Saving a deferred user should keep memberships and caches current."
+
+        org2 = Organization.objects.create(code='testorg2', name='Test Org2')
+        self.backend.user_defer = ('password', 'last_login')
+        self.backend.cache_users = True
+
+        u = self.backend.get_user(self.u.pk)
+        self.assertFalse(u.__class__ is OrganizationUser)
+        version = get_permission_version(u.pk)
+
+        u.organization = org2
+        u.save()
+
+        self.assertNotEqual(get_permission_version(u.pk), version)
+        self.assertEqual(OrganizationUser.objects.get(pk=u.pk)
+                                         .organization_ids,
+                         frozenset([org2.pk]))
+        self.assertEqual(self.backend.get_user(u.pk).organization, org2)
+
+    def test_snapshot(self):
+        "Cached users should be dropped when they change."
+
+        self.backend.cache_users = True
+        self.backend.get_user(self.u.pk)
+
+        def get_user():
+            u = self.backend.get_user(self.u.pk)
+            self.assertEqual(u.organization, self.org)
+            return u
+        self.assertNumQueries(0, get_user)
+
+        self.u.first_name = 'Test'
+        self.u.save()
+        self.assertEqual(self.backend.get_user(self.u.pk).first_name, 'Test')
+
+        self.org.name = 'Renamed'
+        self.org.save()
+        self.assertEqual(self.backend.get_user(self.u.pk).organization.name,
+                         'Renamed')
+
+        self.u.delete()
+        self.assertEqual(self.backend.get_user(self.u.pk), None)
+
+
+class LocalPermissionDigestMiddleware(PermissionDigestMiddleware):
+    # the tests run in a single process, whatever the cache
+    allow_local_cache = True
+
+
+class PermissionDigestTestCase(TestCase):
+    "Test answering permission checks from a session digest."
+
+    compile_permissions = False
+
+    def setUp(self):
+        cache.clear()
+        permission_index.reset()
+
+        self.org = Organization.objects.create(code='testorg', name='Test Org')
+        self.org2 = Organization.objects.create(code='testorg2',
+                                                name='Test Org2')
+        self.org3 = Organization.objects.create(code='testorg3',
+                                                name='Test Org3')
+        self.backend = OrganizationBackend()
+        self.backend.compile_permissions = self.compile_permissions
+
+        self.perms = list(Permission.objects.order_by('pk')[0:4])
+        self.permstrs = [self.backend._create_permission_set([p]).pop()
+                         for p in self.perms]
+
+        self.role = Role.objects.create(organization=self.org, name='Role')
+        self.role.permissions.add(self.perms[0])
+        role2 = Role.objects.create(organization=self.org2, name='Role')
+        role2.permissions.add(self.perms[1])
+        role3 = Role.objects.create(organization=self.org3, name='Role')
+        role3.permissions.add(self.perms[2])
+        superrole = SuperRole.objects.create(name='SuperRole')
+        superrole.permissions.add(self.perms[3])
+
+        self.u = OrganizationUser.objects.create_user(organization=self.org,
+                                                      username='testuser',
+                                                      email='test@test.com')
+        self.u.organizations.add(self.org2)
+        self.u.roles.add(self.role, role2, role3)
+        self.u.super_roles.add(superrole)
+
+        # every kind of object the backend tells apart
+        self.objs = [None, self.org, self.org2, self.org3,
+                     TestModelDefaultAttribute(organization_id=None)]
+
+    def tearDown(self):
+        permission_index.reset()
+
+    def get_user(self):
+        return OrganizationUser.objects.get(pk=self.u.pk)
+
+    def test_digest(self):
+        "Permissions from a digest should match the database"
+
+        digest = self.backend.get_permission_digest(self.get_user())
+
+        u = self.get_user()
+        self.assertTrue(self.backend.load_permission_digest(u, digest))
+
+        def check():
+            return [self.backend.get_all_permissions(u, obj)
+                    for obj in self.objs]
+        self.assertNumQueries(0, check)
+
+        u2 = self.get_user()
+        self.assertEqual(check(), [self.backend.get_all_permissions(u2, obj)
+                                   for obj in self.objs])
+
+        self.assertTrue(self.backend.has_perm(u, self.permstrs[1], self.org2))
+        self.assertFalse(self.backend.has_perm(u, self.permstrs[2],
+                                               self.org3))
+
+    def test_stale_digest(self):
+        "Digests should not be used once permissions change"
+
+        digest = self.backend.get_permission_digest(self.get_user())
+
+        self.role.permissions.add(self.perms[1])
+        self.assertFalse(self.backend.load_permission_digest(self.get_user(),
+                                                             digest))
+
+        other = OrganizationUser.objects.create_user(organization=self.org,
+                                                     username='other',
+                                                     email='other@test.com')
+        digest = self.backend.get_permission_digest(self.get_user())
+        self.assertFalse(self.backend.load_permission_digest(other, digest))
+
+    def test_middleware(self):
+        "The middleware should refresh stale digests"
+
+        request = RequestFactory().get('/')
+        request.session = {}
+        middleware = LocalPermissionDigestMiddleware()
+
+        request.user = self.get_user()
+        middleware.process_request(request)
+        digest = request.session[SESSION_KEY]
+
+        request.user = self.get_user()
+        middleware.process_request(request)
+        self.assertNumQueries(0, lambda: self.backend.has_perm(
+            request.user, self.permstrs[0], self.org))
+        self.assertTrue(request.session[SESSION_KEY] is digest)
+
+        self.u.roles.remove(self.role)
+        request.user = self.get_user()
+        middleware.process_request(request)
+        self.assertFalse(self.backend.has_perm(request.user,
+                                               self.permstrs[0], self.org))
+        self.assertFalse(request.session[SESSION_KEY] is digest)
+
+    def test_local_cache(self):
+        "The middleware should refuse caches that aren't shared"
+
+        if not is_shared():
+            self.assertRaises(ImproperlyConfigured, PermissionDigestMiddleware)
+
+    def test_compact_digest(self):
+        "Digests should only keep the organizations with role permissions"
+
+        org4 = Organization.objects.create(code='testorg4', name='Test Org4')
+        role4 = Role.objects.create(organization=org4, name='Role')
+        role4.permissions.add(self.perms[0])
+        self.u.organizations.add(self.org3, org4)
+        self.u.roles.add(role4)
+
+        others = [Organization.objects.create(code='other%d' % i,
+                                              name='Other %d' % i)
+                  for i in range(3)]
+        self.u.organizations.add(*others)
+
+        digest = self.backend.get_permission_digest(self.get_user())
+
+        # the same permissions as the primary organization
+        self.assertEqual(digest['organizations'][org4.pk],
+                         digest['organizations'][self.org.pk])
+        self.assertEqual(len(digest['masks']), 3)
+        for org in others:
+            self.assertFalse(org.pk in digest['organizations'])
+
+        u = self.get_user()
+        self.assertTrue(self.backend.load_permission_digest(u, digest))
+        self.assertTrue(self.backend.has_perm(u, self.permstrs[0], org4))
+        self.assertTrue(self.backend.has_perm(u, self.permstrs[3], others[0]))
+        self.assertFalse(self.backend.has_perm(u, self.permstrs[0],
+                                               others[0]))
+
+        # digests of an older layout are recomputed
+        del digest['masks']
+        self.assertFalse(self.backend.load_permission_digest(u, digest))
+
+
+class CompiledPermissionDigestTestCase(PermissionDigestTestCase):
+    "Test session digests with permission sets compiled to bitmasks."
+
+    compile_permissions = True
+
+
+class PermittedQuerySetTestCase(TestCase):
+    "Test that querysets can be limited to permitted objects."
+
+    def setUp(self):
+        self.org = Organization.objects.create(code='testorg', name='Test Org')
+        self.org2 = Organization.objects.create(code='testorg2',
+                                                name='Test Org2')
+        self.org3 = Organization.objects.create(code='testorg3',
+                                                name='Test Org3')
+
+        self.perm = Permission.objects.all()[0]
+        self.permstr = OrganizationBackend()._create_permission_set(
+            [self.perm]).pop()
+
+        self.u = OrganizationUser.objects.create_user(organization=self.org,
+                                                      username='testuser',
+                                                      email='test@test.com')
+        self.u.organizations.add(self.org2)
+
+        # roles are owned by an organization, so use them as the objects
+        self.roles = []
+        for org in (self.org, self.org2, self.org3):
+            role = Role.objects.create(organization=org, name='Role')
+            role.permissions.add(self.perm)
+            self.roles.append(role)
+
+    def permitted(self):
+        qs = OrganizationOwnedQuerySet(Role).order_by('pk')
+        return list(qs.permitted_for(self.u, self.permstr))
+
+    def test_role_permissions(self):
+        "Only organizations the user holds the permission in are included."
+
+        self.assertEqual(self.permitted(), [])
+
+        self.u.roles.add(self.roles[0], self.roles[1])
+        self.assertEqual(self.permitted(), self.roles[:2])
+
+        # roles of organizations the user isn't a member of don't count
+        self.u.roles.add(self.roles[2])
+        self.assertEqual(self.permitted(), self.roles[:2])
+
+        self.u.organizations.remove(self.org2)
+        self.assertEqual(self.permitted(), self.roles[:1])
+
+    def test_unrestricted(self):
+        "Superusers and super roles get every object."
+
+        superrole = SuperRole.objects.create(name='SuperRole')
+        superrole.permissions.add(self.perm)
+        self.u.super_roles.add(superrole)
+        self.assertEqual(self.permitted(), self.roles)
+
+        self.u = OrganizationUser.objects.create_superuser(
+            organization=self.org, username='superuser',
+            email='super@super.com', password='superuser')
+        self.assertEqual(self.permitted(), self.roles)
+
+        self.u.is_active = False
+        self.assertEqual(self.permitted(), [])
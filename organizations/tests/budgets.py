@@ -0,0 +1,40 @@
+from django.contrib import admin
+from django.test import TestCase
+
+from ..benchmarks import generate_dataset, run_benchmarks, PATHS
+from ..permissions import permission_index
+
+
+class QueryBudgetTestCase(TestCase):
+    "Test that every hot path stays within its query budget."
+
+    urls = 'organizations.tests.urls'
+
+    def setUp(self):
+        admin.autodiscover()
+        permission_index.reset()
+
+    def tearDown(self):
+        permission_index.reset()
+
+    def test_budgets(self):
+        "No path should run more queries than its budget, at any size"
+
+        dataset = generate_dataset(organizations=3, users=3, roles=2,
+                                   permissions=3, memberships=1)
+        small = dict((r.name, r.queries)
+                     for r in run_benchmarks(dataset, repeat=3))
+
+        dataset = generate_dataset(organizations=6, users=10, roles=4,
+                                   permissions=6, memberships=3,
+                                   prefix='large')
+        results = run_benchmarks(dataset, repeat=3)
+
+        self.assertEqual([r.name for r in results],
+                         [name for name, path, budget in PATHS])
+        for result in results:
+            self.assertFalse(result.over_budget,
+                             "%s ran %d queries, the budget is %d"
+                             % (result.name, result.queries, result.budget))
+            self.assertEqual(result.queries, small[result.name], result.name)
+            self.assertEqual(result.calls, 3)
@@ -0,0 +1,231 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from django.contrib.auth.models import Permission
+
+from ..backends import OrganizationBackend
+from ..management.commands.import_organizations import import_organizations
+from ..models import Organization, OrganizationUser, Role, SuperRole
+from ..permissions import permission_index
+
+
+class ImportCommandTestCase(TestCase):
+    "Test importing organizations, roles, users and memberships."
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        permission_index.reset()
+
+        perms = Permission.objects.select_related('content_type') \
+                                  .order_by('pk')[0:2]
+        self.perms = ['%s.%s' % (p.content_type.app_label, p.codename)
+                      for p in perms]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        permission_index.reset()
+
+    def write(self, name, content):
+        path = os.path.join(self.dir, name)
+        f = open(path, 'wb')
+        f.write(content.encode('utf-8'))
+        f.close()
+        return path
+
+    def load(self, kind, path, **options):
+        options.setdefault('verbosity', 0)
+        options.setdefault('processes', 1)
+        call_command('import_organizations', kind, path, **options)
+
+    def test_import(self):
+        "Every kind of row should be imported, and importing is repeatable"
+
+        orgs = self.write('orgs.csv', u'code,name\n'
+                                      u'acme,Acme\n'
+                                      u'other,Other\n')
+        roles = self.write('roles.jsonl', u'\n'.join([
+            json.dumps({'organization': 'ACME', 'name': 'Editors',
+                        'permissions': self.perms}),
+            json.dumps({'organization': 'other', 'name': 'Editors',
+                        'permissions': self.perms[:1]}),
+            json.dumps({'name': 'Admins', 'permissions': self.perms[1:]}),
+        ]))
+        users = self.write('users.csv',
+                           u'organization,username,email,password,is_staff\n'
+                           u'acme,jdoe,jdoe@ACME.com,secret,true\n'
+                           u'acme,asmith,asmith@acme.com,,\n')
+        memberships = self.write('memberships.csv',
+                                 u'organization,username,member_of,role,'
+                                 u'super_role\n'
+                                 u'acme,jdoe,,Editors,\n'
+                                 u'acme,JDOE,other,Editors,Admins\n')
+
+        for i in range(2):
+            self.load('organizations', orgs, batch_size=1)
+            self.load('roles', roles)
+            self.load('users', users)
+            self.load('memberships', memberships)
+
+            self.assertEqual(Organization.objects.count(), 2)
+            self.assertEqual(Role.objects.count(), 2)
+            self.assertEqual(SuperRole.objects.count(), 1)
+            self.assertEqual(OrganizationUser.objects.count(), 2)
+
+            acme = Organization.objects.get(code='acme')
+            other = Organization.objects.get(code='other')
+
+            role = Role.objects.get(organization=acme)
+            self.assertEqual(role.permissions.count(), 2)
+
+            user = OrganizationUser.objects.get(username='jdoe')
+            self.assertTrue(user.check_password('secret'))
+            self.assertTrue(user.is_staff)
+            self.assertEqual(user.email, 'jdoe@acme.com')
+            self.assertEqual(user.organization_ids,
+                             frozenset([acme.pk, other.pk]))
+            self.assertEqual(user.roles.count(), 2)
+            self.assertEqual(user.super_roles.count(), 1)
+
+            user = OrganizationUser.objects.get(username='asmith')
+            self.assertFalse(user.has_usable_password())
+
+    def test_update(self):
+        "Changed rows should be updated"
+
+        self.load('organizations', self.write('orgs.jsonl',
+            u'{"code": "acme", "name": "Acme"}\n'))
+        self.load('roles', self.write('roles.jsonl',
+            u'{"organization": "acme", "name": "Editors", "permissions": []}'))
+
+        self.load('organizations', self.write('orgs.jsonl',
+            u'{"code": "ACME", "name": "Acme Inc."}\n'))
+        self.load('roles', self.write('roles.jsonl', json.dumps(
+            {'organization': 'acme', 'name': 'Editors',
+             'permissions': self.perms})))
+
+        org = Organization.objects.get()
+        self.assertEqual((org.code, org.code_key, org.name),
+                         ('ACME', 'acme', 'Acme Inc.'))
+        self.assertEqual(Role.objects.get().permissions.count(), 2)
+
+    def test_organization_tree(self):
+        "Parents should be set and moved, without cycles"
+
+        self.load('organizations', self.write('orgs.csv',
+            u'code,name,parent\n'
+            u'holding,Holding,\n'
+            u'sub,Sub,holding\n'
+            u'subsub,SubSub,sub\n'))
+        self.load('roles', self.write('roles.jsonl', json.dumps(
+            {'organization': 'holding', 'name': 'Managers',
+             'permissions': self.perms, 'applies_to_descendants': True})))
+
+        subsub = Organization.objects.get(code='subsub')
+        self.assertEqual(
+            sorted(subsub.ancestor_links.values_list('ancestor__code',
+                                                     'depth')),
+            [('holding', 2), ('sub', 1), ('subsub', 0)])
+        self.assertTrue(Role.objects.get().applies_to_descendants)
+
+        self.load('organizations', self.write('orgs.csv',
+            u'code,name,parent\n'
+            u'holding,Holding,\n'
+            u'sub,Sub,\n'))
+        self.assertEqual(
+            sorted(subsub.ancestor_links.values_list('ancestor__code',
+                                                     'depth')),
+            [('sub', 1), ('subsub', 0)])
+
+        # call the loader itself, the command exits on errors
+        self.assertRaises(CommandError, import_organizations,
+                          [(2, {'code': 'sub', 'name': 'Sub',
+                                'parent': 'subsub'})], {})
+        # cycles through other organizations moved along
+        self.assertRaises(CommandError, import_organizations,
+                          [(2, {'code': 'holding', 'name': 'Holding',
+                                'parent': 'subsub'}),
+                           (3, {'code': 'sub', 'name': 'Sub',
+                                'parent': 'holding'})], {})
+
+        # organizations can be moved under ones created along
+        self.load('organizations', self.write('orgs.csv',
+            u'code,name,parent\n'
+            u'top,Top,\n'
+            u'holding,Holding,top\n'
+            u'sub,Sub,holding\n'))
+        self.assertEqual(
+            sorted(subsub.ancestor_links.values_list('ancestor__code',
+                                                     'depth')),
+            [('holding', 2), ('sub', 1), ('subsub', 0), ('top', 3)])
+
+
+class ExportCommandTestCase(TestCase):
+    "Test exporting the permissions of every membership."
+
+    def setUp(self):
+        permission_index.reset()
+
+        self.org = Organization.objects.create(code='testorg', name='Test Org')
+        self.org2 = Organization.objects.create(code='testorg2',
+                                                name='Test Org2')
+        perms = list(Permission.objects.order_by('pk')[0:3])
+
+        role = Role.objects.create(organization=self.org, name='Role')
+        role.permissions.add(perms[0])
+        role2 = Role.objects.create(organization=self.org2, name='Role')
+        role2.permissions.add(perms[1])
+        superrole = SuperRole.objects.create(name='SuperRole')
+        superrole.permissions.add(perms[2])
+
+        self.users = []
+        for i in range(5):
+            u = OrganizationUser.objects.create_user(organization=self.org,
+                                                     username='user%d' % i,
+                                                     email='u%d@test.com' % i)
+            self.users.append(u)
+
+        self.users[0].roles.add(role)
+        self.users[1].roles.add(role, role2)
+        self.users[1].organizations.add(self.org2)
+        # not a member of the organization of the role
+        self.users[2].roles.add(role2)
+        self.users[3].super_roles.add(superrole)
+        self.users[3].organizations.add(self.org2)
+        self.users[4].is_superuser = True
+        self.users[4].save()
+
+        self.path = tempfile.mktemp()
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        permission_index.reset()
+
+    def test_export(self):
+        "Exported permissions should match the backend"
+
+        call_command('export_permissions', output=self.path, chunk_size=2,
+                     verbosity=0)
+
+        f = open(self.path)
+        records = [json.loads(line) for line in f]
+        f.close()
+
+        backend = OrganizationBackend()
+        expected = []
+        for u in self.users:
+            u = OrganizationUser.objects.get(pk=u.pk)
+            for org in u.get_all_organizations().order_by('pk'):
+                expected.append((u.pk, org.code, org == u.organization,
+                                 sorted(backend.get_group_permissions(u,
+                                                                      org))))
+
+        self.assertEqual([(r['user_id'], r['organization'], r['is_primary'],
+                           r['permissions']) for r in records], expected)
+        self.assertEqual(len(records), 7)
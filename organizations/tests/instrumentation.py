@@ -0,0 +1,136 @@
+from django.test import TestCase
+
+from django.contrib.auth.models import Permission
+
+from ..backends import OrganizationBackend
+from ..instrumentation import backend_call, backend_stats
+from ..models import Organization, OrganizationUser, Role
+from ..permissions import permission_index
+from .testmodels import TestModelDefaultAttribute
+
+
+class InstrumentationTestCase(TestCase):
+    "Test that backend calls are measured and collected."
+
+    def setUp(self):
+        self.org = Organization.objects.create(code='testorg', name='Test Org')
+        self.org2 = Organization.objects.create(code='testorg2',
+                                                name='Test Org2')
+
+        self.backend = OrganizationBackend()
+        self.backend.collectors = (
+            'organizations.instrumentation.backend_stats',
+            'organizations.instrumentation.SignalCollector')
+
+        role = Role.objects.create(organization=self.org, name='Role')
+        perm = Permission.objects.all()[0]
+        role.permissions.add(perm)
+        self.permstr = self.backend._create_permission_set([perm]).pop()
+
+        self.u = OrganizationUser.objects.create_user(organization=self.org,
+                                                      username='testuser',
+                                                      email='test@test.com',
+                                                      password='secret')
+        self.u.roles.add(role)
+
+        permission_index.reset()
+        permission_index.names(0)
+        backend_stats.reset()
+
+    def tearDown(self):
+        permission_index.reset()
+        backend_stats.reset()
+
+    def test_branches(self):
+        "Permission checks should be counted by branch, with their queries"
+
+        u = self.backend.get_user(self.u.pk)
+        # load the memberships up front
+        u.organization_ids
+
+        objs = [None, self.org, self.org2,
+                TestModelDefaultAttribute(organization_id=self.org.pk)]
+        for obj in objs * 2:
+            self.backend.has_perm(u, self.permstr, obj)
+
+        stats = backend_stats.get_stats()
+
+        self.assertEqual(stats['get_user']['calls'], 1)
+        self.assertEqual(stats['get_user']['queries'], 1)
+
+        has_perm = stats['has_perm']
+        self.assertEqual(has_perm['calls'], 8)
+        # one query per organization key, the second round is memoized
+        self.assertEqual(has_perm['queries'], 3)
+        self.assertEqual((has_perm['cache_hits'], has_perm['cache_misses']),
+                         (5, 3))
+        self.assertTrue(has_perm['time'] >= has_perm['max_time'] > 0)
+
+        self.assertEqual(dict((branch, totals['calls']) for branch, totals
+                              in has_perm['branches'].items()),
+                         {'none': 2, 'organization': 2, 'non-member': 2,
+                          'attribute': 2})
+        self.assertEqual(has_perm['branches']['organization']['queries'], 1)
+
+    def test_branch_queries(self):
+        "Branches should be told apart without queries of their own"
+
+        child = Organization.objects.create(code='child', name='Child',
+                                            parent=self.org)
+
+        # the user has a single membership, loaded along with the user
+        u = self.backend.get_user(self.u.pk)
+        self.assertNumQueries(1, self.backend.has_perm, u, self.permstr,
+                              self.org2)
+
+        # roles of the organizations above the object can apply
+        self.assertNumQueries(1, self.backend.has_perm, u, self.permstr,
+                              child)
+
+        # other memberships are only told apart once they are loaded
+        self.u.organizations.add(self.org2)
+        u = self.backend.get_user(self.u.pk)
+        self.assertNumQueries(1, self.backend.has_perm, u, self.permstr,
+                              child)
+        u.organization_ids
+        self.assertNumQueries(0, self.backend.has_perm, u, self.permstr,
+                              child)
+
+        stats = backend_stats.get_stats()['has_perm']
+        self.assertEqual(stats['queries'], 3)
+        self.assertEqual(dict((branch, totals['calls']) for branch, totals
+                              in stats['branches'].items()),
+                         {'non-member': 1, 'organization': 2, 'unknown': 1})
+
+    def test_nested_calls(self):
+        "Calls made by other measured calls should be part of them"
+
+        calls = []
+
+        def receiver(sender, call, **kwargs):
+            calls.append(call)
+
+        backend_call.connect(receiver)
+        try:
+            self.assertTrue(self.backend.has_module_perms(
+                self.u, self.permstr.split('.')[0]))
+            self.assertEqual(self.backend.authenticate('testorg', 'testuser',
+                                                       'secret'), self.u)
+        finally:
+            backend_call.disconnect(receiver)
+
+        self.assertEqual([call.name for call in calls],
+                         ['has_module_perms', 'authenticate'])
+        self.assertEqual(calls[0].branch, 'none')
+        self.assertEqual(calls[0].queries, 1)
+        self.assertEqual(calls[1].branch, None)
+
+        self.assertEqual(sorted(backend_stats.get_stats()),
+                         ['authenticate', 'has_module_perms'])
+
+    def test_disabled(self):
+        "Nothing should be measured without collectors"
+
+        self.backend.collectors = ()
+        self.backend.has_perm(self.u, self.permstr, self.org)
+        self.assertEqual(backend_stats.get_stats(), {})
@@ -1,6 +1,16 @@
-from django.test import TestCase
+import sqlite3
 
-from ..models import Organization, OrganizationUser
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from django.contrib.auth.models import User
+
+from ..cache import commit_on_success
+from ..instrumentation import QueryCounter
+from ..models import Organization, OrganizationClosure, OrganizationUser, \
+        Membership, Role, RoleClosure, SuperRole
 
 
 class OrganizationUserModelTest(TestCase):
@@ -35,6 +45,218 @@ class OrganizationUserModelTest(TestCase):
         self.assertEqual(get_orgs().count(), 2)
         self.assertQuerysetEqual(get_orgs(), map(repr, [org, org2]))
 
+    def test_is_member_of(self):
+        "Membership checks should be cheap"
+
+        org, org2, org3 = self.orgs[0], self.orgs[1], self.orgs[2]
+
+        user = OrganizationUser.objects.create_user(organization=org,
+                                                    username='testuser',
+                                                    email='test@test.com')
+        user.organizations.add(org2)
+
+        user = OrganizationUser.objects.get(pk=user.pk)
+
+        # the primary organization doesn't need a query
+        self.assertNumQueries(0, lambda: self.assertTrue(
+            user.is_member_of(org)))
+        self.assertNumQueries(1, lambda: self.assertTrue(
+            user.is_member_of(org2.pk)))
+
+        self.assertEqual(user.organization_ids,
+                         frozenset([org.pk, org2.pk]))
+
+        # once the organizations are known, no more queries are needed
+        self.assertNumQueries(0, lambda: self.assertFalse(
+            user.is_member_of(org3)))
+
+        user.organizations.add(org3)
+        self.assertTrue(user.is_member_of(org3))
+        self.assertEqual(user.organization_ids,
+                         frozenset([org.pk, org2.pk, org3.pk]))
+
+    def test_bulk_create_users(self):
+        "Users should be created in bulk like they are one at a time"
+
+        org, org2 = self.orgs[0], self.orgs[1]
+        role = Role.objects.create(organization=org2, name='Role')
+        superrole = SuperRole.objects.create(name='SuperRole')
+
+        specs = [dict(organization=org, username='User%d' % i,
+                      email='user%d@EXAMPLE.com' % i, password='pw%d' % i)
+                 for i in range(5)]
+        specs[0].update(organizations=[org2.pk], roles=[role],
+                        super_roles=[superrole], first_name='First')
+        specs[1]['password'] = None
+
+        users = OrganizationUser.objects.bulk_create_users(
+            specs, processes=1, batch_size=2)
+
+        self.assertEqual([u.username for u in users],
+                         ['User%d' % i for i in range(5)])
+
+        user = OrganizationUser.objects.get(pk=users[0].pk)
+        self.assertEqual(user.first_name, 'First')
+        self.assertEqual(user.email, 'user0@example.com')
+        self.assertEqual(user.username_key, 'user0')
+        self.assertTrue(user.check_password('pw0'))
+        self.assertEqual(user.organization_ids, frozenset([org.pk, org2.pk]))
+        self.assertEqual(list(user.roles.all()), [role])
+        self.assertEqual(list(user.super_roles.all()), [superrole])
+
+        user = OrganizationUser.objects.get(pk=users[1].pk)
+        self.assertFalse(user.has_usable_password())
+        self.assertEqual(user.organization_ids, frozenset([org.pk]))
+
+    def test_bulk_create_users_returning(self):
+        "Users should be inserted at once where their keys can be returned"
+
+        if connection.vendor == 'sqlite' and \
+                sqlite3.sqlite_version_info < (3, 35):
+            return
+        if connection.vendor not in ('sqlite', 'postgresql'):
+            return
+
+        counter = QueryCounter()
+
+        def create(prefix):
+            specs = [dict(organization=self.orgs[0],
+                          username='%s%d' % (prefix, i),
+                          email='%s%d@example.com' % (prefix, i))
+                     for i in range(5)]
+            counter.start()
+            users = OrganizationUser.objects.bulk_create_users(specs,
+                                                               processes=1)
+            return users, counter.stop()
+
+        users, queries = create('single')
+
+        features = connection.features
+        features.can_return_ids_from_bulk_insert = True
+        try:
+            bulk_users, bulk_queries = create('bulk')
+        finally:
+            del features.can_return_ids_from_bulk_insert
+
+        # one statement for the parent rows instead of one per user
+        self.assertEqual(bulk_queries, queries - 4)
+        for user in bulk_users:
+            self.assertEqual(OrganizationUser.objects.get(pk=user.pk).username,
+                             user.username)
+
+    def test_bulk_create_users_processes(self):
+        "Passwords can be hashed by worker processes"
+
+        specs = [dict(organization=self.orgs[0], username='user%d' % i,
+                      email='user%d@example.com' % i, password='pw%d' % i)
+                 for i in range(3)]
+
+        OrganizationUser.objects.bulk_create_users(specs, processes=2)
+
+        for i in range(3):
+            user = OrganizationUser.objects.get(username='user%d' % i)
+            self.assertTrue(user.check_password('pw%d' % i))
+
+    def test_bulk_changes(self):
+        "Roles and organizations can be changed for many users at once"
+
+        org, org2, org3 = self.orgs[0], self.orgs[1], self.orgs[2]
+        role = Role.objects.create(organization=org2, name='Role')
+        superrole = SuperRole.objects.create(name='SuperRole')
+
+        users = [OrganizationUser.objects.create_user(
+                     organization=org, username='user%d' % i,
+                     email='user%d@test.com' % i) for i in range(3)]
+        users[0].organizations.add(org2)
+        ids = [u.pk for u in users]
+        manager = OrganizationUser.objects
+
+        # only members of the organization of the role get it
+        self.assertEqual(manager.grant_role(ids, role), 1)
+        self.assertEqual(manager.grant_role(ids, role), 0)
+        self.assertEqual(list(role.organizationuser_set.all()), users[:1])
+
+        self.assertEqual(manager.add_organization(ids, org2), 2)
+        self.assertEqual(manager.grant_role(ids, role), 2)
+        self.assertEqual(manager.revoke_role(ids[:2], role), 2)
+        self.assertEqual(list(role.organizationuser_set.all()), users[2:])
+
+        qs = manager.filter(pk__in=ids)
+        self.assertEqual(manager.grant_super_role(qs, superrole), 3)
+        self.assertEqual(manager.revoke_super_role(qs, superrole), 3)
+        self.assertEqual(superrole.organizationuser_set.count(), 0)
+
+        self.assertEqual(manager.move_organization(ids, org2), 3)
+        self.assertEqual(manager.add_organization(ids, org3), 3)
+        for u in manager.filter(pk__in=ids):
+            self.assertEqual(u.organization, org2)
+            self.assertEqual(list(u.organizations.all()), [org3])
+            self.assertEqual(u.organization_ids, frozenset([org2.pk, org3.pk]))
+
+    def test_role_matrix(self):
+        "Roles should be loaded by organization with a few queries"
+
+        org, org2, org3 = self.orgs[0], self.orgs[1], self.orgs[2]
+        superrole = SuperRole.objects.create(name='SuperRole')
+        roles = [Role.objects.create(organization=o, name='Role')
+                 for o in (org, org2, org3)]
+
+        users = []
+        for i in range(5):
+            u = OrganizationUser.objects.create_user(
+                organization=org, username='user%d' % i,
+                email='user%d@test.com' % i)
+            u.organizations.add(org2)
+            # not a member of org3, so that role doesn't count
+            u.roles.add(*roles)
+            users.append(u)
+        users[0].super_roles.add(superrole)
+
+        qs = OrganizationUser.objects.with_role_matrix(chunk_size=2) \
+                                     .order_by('pk')
+
+        def render():
+            return [("{0}".format(u), [r.name for r in u.super_role_list],
+                     [(o.name, [r.name for r in org_roles])
+                      for o, org_roles in u.role_matrix])
+                    for u in qs.iterator()]
+
+        # the users, then super roles, organizations and roles of 3 chunks
+        self.assertNumQueries(10, render)
+
+        users = list(qs.all())
+        self.assertEqual(users[0].super_role_list, [superrole])
+        self.assertEqual(users[1].super_role_list, [])
+
+        for u in users:
+            self.assertEqual(u.role_matrix,
+                             [(org, [roles[0]]), (org2, [roles[1]])])
+            self.assertEqual(u.organization_ids, frozenset([org.pk, org2.pk]))
+
+
+class OrganizationUserTransactionTest(TransactionTestCase):
+
+    def test_bulk_create_users_transaction(self):
+        "Bulk created users should be a part of a transaction in progress"
+
+        org = Organization.objects.create(code='testorg', name='TestOrg')
+        specs = [dict(organization=org, username='user%d' % i,
+                      email='user%d@example.com' % i) for i in range(3)]
+
+        def create():
+            OrganizationUser.objects.bulk_create_users(specs, processes=1,
+                                                       batch_size=2)
+            raise ValueError
+
+        self.assertRaises(ValueError, commit_on_success()(create))
+        self.assertFalse(User.objects.filter(username__in=[
+            spec['username'] for spec in specs]).exists())
+        self.assertFalse(OrganizationUser.objects.exists())
+
+        # batches commit on their own otherwise
+        OrganizationUser.objects.bulk_create_users(specs, processes=1)
+        self.assertEqual(OrganizationUser.objects.count(), 3)
+
 
 class OrganizationModelTest(TestCase):
 
@@ -69,5 +291,234 @@ class OrganizationModelTest(TestCase):
         self.assertQuerysetEqual(self.org.members.all(),
                                  map(repr, self.users[:2]))
 
-        self.assertQuerysetEqual(self.org.all_members().all(),
-                                 map(repr, self.users))
+        self.assertQuerysetEqual(self.org.all_members().order_by('pk'),
+                                 map(repr, self.users.order_by('pk')))
+
+
+class OrganizationClosureModelTest(TestCase):
+
+    def setUp(self):
+        self.holding = Organization.objects.create(code='holding',
+                                                   name='Holding')
+        self.sub = Organization.objects.create(code='sub', name='Sub',
+                                               parent=self.holding)
+        self.subsub = Organization.objects.create(code='subsub', name='SubSub',
+                                                  parent=self.sub)
+        self.other = Organization.objects.create(code='other', name='Other')
+
+    def closure(self):
+        return sorted(OrganizationClosure.objects.exclude(depth=0)
+                      .values_list('ancestor__code', 'descendant__code',
+                                   'depth'))
+
+    def test_sync(self):
+        "The closure should follow the parent of each organization"
+
+        self.assertEqual(OrganizationClosure.objects.filter(depth=0).count(),
+                         4)
+        self.assertEqual(self.closure(), [
+            ('holding', 'sub', 1), ('holding', 'subsub', 2),
+            ('sub', 'subsub', 1)])
+
+        # moving an organization moves everything below it
+        self.sub.parent = self.other
+        self.sub.save()
+        self.assertEqual(self.closure(), [
+            ('other', 'sub', 1), ('other', 'subsub', 2),
+            ('sub', 'subsub', 1)])
+
+        self.sub.parent = None
+        self.sub.save()
+        self.assertEqual(self.closure(), [('sub', 'subsub', 1)])
+
+    def test_sync_queries(self):
+        "Keeping the closure up to date should not load every organization"
+
+        for i in range(5):
+            Organization.objects.create(code='org%d' % i, name='Org %d' % i)
+
+        # the rows of the parent, and the new rows
+        self.assertNumQueries(3, Organization.objects.create, code='leaf',
+                              name='Leaf', parent=self.subsub)
+        self.assertEqual([row for row in self.closure() if row[1] == 'leaf'],
+                         [('holding', 'leaf', 3), ('sub', 'leaf', 2),
+                          ('subsub', 'leaf', 1)])
+
+        # moving loads the moved organizations and the rows above them
+        self.sub.parent = self.other
+        self.assertNumQueries(10, self.sub.save)
+        self.assertEqual(self.closure(), [
+            ('other', 'leaf', 3), ('other', 'sub', 1), ('other', 'subsub', 2),
+            ('sub', 'leaf', 2), ('sub', 'subsub', 1), ('subsub', 'leaf', 1)])
+
+    def test_invalid_parent(self):
+        "Organizations should not be placed under their own descendants"
+
+        for parent in (self.holding, self.subsub):
+            self.holding.parent = parent
+            self.assertRaises(ValidationError, self.holding.clean)
+            self.assertRaises(ValueError, self.holding.save)
+
+        self.assertEqual(len(self.closure()), 3)
+
+    def test_descendants(self):
+        "Users should list the organizations below theirs on request"
+
+        user = OrganizationUser.objects.create_user(
+            organization=self.sub, username='testuser',
+            email='test@test.com')
+        user.organizations.add(self.other)
+
+        self.assertEqual(list(self.holding.get_descendants()),
+                         [self.sub, self.subsub])
+        self.assertEqual(list(user.get_all_organizations()),
+                         [self.other, self.sub])
+        self.assertEqual(list(user.get_all_organizations(
+            include_descendants=True)), [self.other, self.sub, self.subsub])
+
+    def test_rebuild(self):
+        "The rebuild command should recreate the closure"
+
+        expected = self.closure()
+
+        OrganizationClosure.objects.all().delete()
+        call_command('rebuild_organization_indexes', 'organization_closure',
+                     verbosity=0)
+
+        self.assertEqual(self.closure(), expected)
+        self.assertEqual(OrganizationClosure.objects.filter(depth=0).count(),
+                         4)
+
+
+class MembershipModelTest(TestCase):
+
+    def setUp(self):
+        self.org = Organization.objects.create(code='testorg', name='TestOrg')
+        self.org2 = Organization.objects.create(code='testorg2',
+                                                name='TestOrg2')
+        self.org3 = Organization.objects.create(code='testorg3',
+                                                name='TestOrg3')
+
+        self.user = OrganizationUser.objects.create_user(
+            organization=self.org, username='testuser', email='test@test.com')
+
+    def memberships(self):
+        return sorted(Membership.objects.values_list('user', 'organization',
+                                                     'is_primary'))
+
+    def test_sync(self):
+        "Memberships should follow the organizations of the user"
+
+        u = self.user.pk
+        org, org2, org3 = self.org.pk, self.org2.pk, self.org3.pk
+
+        self.assertEqual(self.memberships(), [(u, org, True)])
+
+        self.user.organizations.add(self.org2, self.org3)
+        self.assertEqual(self.memberships(),
+                         [(u, org, True), (u, org2, False), (u, org3, False)])
+
+        self.user.organizations.remove(self.org3)
+        self.assertEqual(self.memberships(),
+                         [(u, org, True), (u, org2, False)])
+
+        # the other side of the relation
+        self.org3.members.add(self.user)
+        self.org2.members.clear()
+        self.assertEqual(self.memberships(),
+                         [(u, org, True), (u, org3, False)])
+
+        # switching the primary organization to one of the additional ones
+        self.user.organization = self.org3
+        self.user.save()
+        self.assertEqual(self.memberships(), [(u, org3, True)])
+
+        self.user.organizations.add(self.org)
+        self.user.organizations.clear()
+        self.assertEqual(self.memberships(), [(u, org3, True)])
+
+    def test_rebuild(self):
+        "The rebuild command should recreate every membership"
+
+        self.user.organizations.add(self.org2)
+        expected = self.memberships()
+
+        Membership.objects.all().delete()
+        call_command('rebuild_organization_indexes', 'memberships',
+                     verbosity=0)
+
+        self.assertEqual(self.memberships(), expected)
+
+
+class RoleClosureModelTest(TestCase):
+
+    def setUp(self):
+        self.org = Organization.objects.create(code='testorg', name='TestOrg')
+        self.manager, self.editor, self.writer, self.reader = [
+            Role.objects.create(organization=self.org, name=name)
+            for name in ('Manager', 'Editor', 'Writer', 'Reader')]
+
+    def closure(self):
+        return sorted(RoleClosure.objects.exclude(depth=0).values_list(
+            'ancestor__name', 'descendant__name', 'depth'))
+
+    def test_sync(self):
+        "The closure should follow the roles each role includes"
+
+        self.assertEqual(RoleClosure.objects.filter(depth=0).count(), 4)
+        self.assertEqual(self.closure(), [])
+
+        self.editor.includes.add(self.writer)
+        self.manager.includes.add(self.editor)
+        # the other side of the relation
+        self.reader.included_by.add(self.writer)
+        self.assertEqual(self.closure(), [
+            ('Editor', 'Reader', 2), ('Editor', 'Writer', 1),
+            ('Manager', 'Editor', 1), ('Manager', 'Reader', 3),
+            ('Manager', 'Writer', 2), ('Writer', 'Reader', 1)])
+
+        # a shortcut shortens the path
+        self.manager.includes.add(self.reader)
+        self.assertTrue(('Manager', 'Reader', 1) in self.closure())
+
+        self.editor.includes.remove(self.writer)
+        self.assertEqual(self.closure(), [
+            ('Manager', 'Editor', 1), ('Manager', 'Reader', 1),
+            ('Writer', 'Reader', 1)])
+
+        self.writer.included_by.add(self.editor)
+        self.writer.delete()
+        self.manager.includes.clear()
+        self.assertEqual(self.closure(), [])
+
+    def test_invalid_includes(self):
+        "Roles should not include themselves or other organizations\' roles"
+
+        self.manager.includes.add(self.editor)
+        self.editor.includes.add(self.writer)
+
+        for role, included in ((self.writer, self.manager),
+                               (self.editor, self.editor)):
+            self.assertRaises(ValueError, role.includes.add, included)
+        self.assertRaises(ValueError, self.manager.included_by.add,
+                          self.writer)
+
+        org2 = Organization.objects.create(code='testorg2', name='TestOrg2')
+        other = Role.objects.create(organization=org2, name='Reader')
+        self.assertRaises(ValueError, self.reader.includes.add, other)
+
+        self.assertEqual(len(self.closure()), 3)
+
+    def test_rebuild(self):
+        "The rebuild command should recreate the closure"
+
+        self.manager.includes.add(self.editor)
+        self.editor.includes.add(self.writer, self.reader)
+        expected = self.closure()
+
+        RoleClosure.objects.all().delete()
+        call_command('rebuild_organization_indexes', 'role_closure',
+                     verbosity=0)
+
+        self.assertEqual(self.closure(), expected)
+        self.assertEqual(RoleClosure.objects.filter(depth=0).count(), 4)
@@ -0,0 +1,169 @@
+"""
+Limits failed login attempts before any password is hashed.
+
+Failed attempts are counted in the cache framework per (organization code,
+username) pair and per client (usually the remote address), over sliding
+windows. Once either count goes over its limit, further attempts are
+rejected without looking the user up or checking the password, which is the
+expensive part of a login.
+
+Limits are (attempts, seconds) tuples, configured with settings:
+
+    ORGANIZATIONS_LOGIN_LIMIT = (5, 300)            # per organization/username
+    ORGANIZATIONS_CLIENT_LOGIN_LIMIT = (100, 300)   # per client
+    ORGANIZATIONS_ORGANIZATION_LOGIN_LIMITS = {     # per organization code
+        'acme': (10, 60),
+    }
+
+A limit of None disables that check.
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+
+from .cache import KEY_PREFIX, cache
+
+
+# keep the statistics for as long as memcached allows
+STATS_TIMEOUT = 60 * 60 * 24 * 30
+
+
+class LoginThrottle(object):
+    """
+    Counts failed logins and tells when a login should be rejected. The
+    sliding window is approximated with two fixed windows, weighting the
+    previous one by how much of it still overlaps the sliding window.
+    """
+
+    def __init__(self, limit=(5, 300), client_limit=(100, 300),
+                 organization_limits=None):
+        self.limit = limit
+        self.client_limit = client_limit
+        self.organization_limits = dict(
+            (code.lower(), limit)
+            for code, limit in (organization_limits or {}).items())
+
+    def _hash(self, *parts):
+        value = u'\0'.join([part.lower() for part in parts])
+        return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+    def _limits(self, organization, username, client):
+        """
+        Returns a list of (key, (attempts, seconds)) for every limit that
+        applies to the given login.
+        """
+
+        limits = []
+
+        limit = self.organization_limits.get(organization.lower(), self.limit)
+        if limit is not None:
+            key = 'user:%s' % self._hash(organization, username)
+            limits.append((key, limit))
+
+        if client is not None and self.client_limit is not None:
+            key = 'client:%s' % self._hash(client)
+            limits.append((key, self.client_limit))
+
+        return limits
+
+    def _windows(self, key, seconds, now):
+        """
+        Returns the cache keys of the current and previous windows, and the
+        weight of the previous window.
+        """
+
+        window = int(now // seconds)
+        overlap = 1 - (now % seconds) / float(seconds)
+
+        current = '%s:throttle:%s:%d' % (KEY_PREFIX, key, window)
+        previous = '%s:throttle:%s:%d' % (KEY_PREFIX, key, window - 1)
+        return current, previous, overlap
+
+    def _incr(self, key, timeout):
+        cache.add(key, 0, timeout)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # the key expired in between
+            cache.set(key, 1, timeout)
+            return 1
+
+    def is_throttled(self, organization, username, client=None):
+        """
+        Returns whether a login attempt should be rejected without checking
+        the password.
+        """
+
+        now = time.time()
+        limits = self._limits(organization, username, client)
+
+        windows = [self._windows(key, seconds, now)
+                   for key, (attempts, seconds) in limits]
+
+        keys = []
+        for current, previous, overlap in windows:
+            keys.extend([current, previous])
+        counts = cache.get_many(keys)
+
+        for (key, (attempts, seconds)), window in zip(limits, windows):
+            current, previous, overlap = window
+            count = counts.get(current, 0) + counts.get(previous, 0) * overlap
+
+            if count >= attempts:
+                self._incr(self._stat_key('rejected'), STATS_TIMEOUT)
+                return True
+
+        return False
+
+    def record_failure(self, organization, username, client=None):
+        """
+        Counts a failed login attempt.
+        """
+
+        now = time.time()
+
+        for key, (attempts, seconds) in self._limits(organization, username,
+                                                     client):
+            current = self._windows(key, seconds, now)[0]
+            # keep the window around while it's still the previous one
+            self._incr(current, seconds * 2)
+
+        self._incr(self._stat_key('failures'), STATS_TIMEOUT)
+
+    def reset(self, organization, username):
+        """
+        Forgets the failed attempts for an organization and username, after
+        a successful login.
+        """
+
+        limit = self.organization_limits.get(organization.lower(), self.limit)
+        if limit is None:
+            return
+
+        key = 'user:%s' % self._hash(organization, username)
+        current, previous, overlap = self._windows(key, limit[1], time.time())
+        cache.delete_many([current, previous])
+
+    def _stat_key(self, name):
+        return '%s:throttle:stats:%s' % (KEY_PREFIX, name)
+
+    def get_stats(self):
+        """
+        Returns the number of failed logins, and the number of logins that
+        were rejected without hashing a password.
+        """
+
+        names = ('failures', 'rejected')
+        counts = cache.get_many([self._stat_key(name) for name in names])
+        return dict((name, counts.get(self._stat_key(name), 0))
+                    for name in names)
+
+
+login_throttle = LoginThrottle(
+    limit=getattr(settings, 'ORGANIZATIONS_LOGIN_LIMIT', (5, 300)),
+    client_limit=getattr(settings, 'ORGANIZATIONS_CLIENT_LOGIN_LIMIT',
+                         (100, 300)),
+    organization_limits=getattr(settings,
+                                'ORGANIZATIONS_ORGANIZATION_LOGIN_LIMITS', {}))
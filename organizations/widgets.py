@@ -0,0 +1,55 @@
+from django import forms
+from django.forms.util import flatatt
+from django.utils.encoding import force_unicode
+from django.utils.html import escape
+from django.utils.http import urlencode
+from django.utils.safestring import mark_safe
+
+
+class AutocompleteSelectMultiple(forms.SelectMultiple):
+    """
+    A multiple select that only renders the selected options, along with a
+    search box that looks further options up from `url`, a page at a time.
+    The choices are never iterated, so the field can have any number of
+    them. `params` are added to the query string of every lookup.
+    """
+
+    class Media:
+        js = ('organizations/js/autocomplete.js',)
+
+    def __init__(self, url, attrs=None, params=None):
+        super(AutocompleteSelectMultiple, self).__init__(attrs)
+        self.url = url
+        self.params = params or {}
+
+    def __deepcopy__(self, memo):
+        obj = super(AutocompleteSelectMultiple, self).__deepcopy__(memo)
+        obj.params = self.params.copy()
+        return obj
+
+    def render(self, name, value, attrs=None, choices=()):
+        attrs = dict(attrs or {})
+        url = self.url
+        if self.params:
+            url = '%s?%s' % (url, urlencode(self.params))
+        attrs['data-autocomplete-url'] = url
+
+        # only look up the selected objects
+        selected = []
+        if value:
+            queryset = self.choices.queryset.filter(pk__in=list(value)) \
+                                            .select_related()
+            selected = [(obj.pk, force_unicode(obj)) for obj in queryset]
+
+        final_attrs = self.build_attrs(attrs, name=name)
+        output = [u'<select multiple="multiple"%s>'
+                  % flatatt(final_attrs)]
+        for pk, label in selected:
+            output.append(u'<option value="%s" selected="selected">%s</option>'
+                          % (escape(pk), escape(label)))
+        output.append(u'</select>')
+        output.append(u'<input type="text" class="vTextField autocomplete" '
+                      u'id="%s_search" placeholder="Search" />'
+                      % escape(final_attrs.get('id', name)))
+
+        return mark_safe(u'\n'.join(output))